@@ -1,153 +1,409 @@
 import os
-import json
-from openai import OpenAI
+import asyncio
+import threading
 import pandas as pd
 import sqlite3
-from config import OPENAI_API_KEY, MODEL_NAME, HISTORY_FILE, FILES_DIR
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import (MODEL_NAME, LLM_TEMPERATURE, FILES_DIR, INGEST_CHUNK_SIZE,
+                    BODY_STORAGE, BODY_COMPRESSION_LEVEL,
+                    HISTORY_DB, HISTORY_LOAD_LIMIT, DEFAULT_SESSION_ID,
+                    CONTEXT_TOKEN_BUDGET, CONTEXT_KEEP_RECENT, CONTEXT_SUMMARY_CHARS,
+                    DB_MMAP_SIZE, DB_CACHE_SIZE_KIB, DB_CACHED_STATEMENTS,
+                    SQL_CACHE_MAX_ENTRIES, SQL_CACHE_MAX_SIZE, SQL_CACHE_TTL,
+                    ACTION_WORKERS, MAX_ACTIONS_PER_TURN, ACTION_OBSERVATION_BUDGET, PROMPT_DUMP,
+                    SQL_MAX_INSTRUCTIONS, SQL_TIMEOUT_SECONDS, SQL_SCAN_MAX_ROWS, SQL_SCAN_MAX_BYTES)
 import re
+from ingest import ingest_csv_files, format_ingest_report
+from search import search_fts, split_terms, format_search_results
+from law_index import parse_law_query, lookup_cases, format_law_results
+from snippets import paragraph_tables, parse_snippet_query, find_snippets, format_snippets
+from similar import load_vector_indexes, format_similar_results
+from stats import STATS_DIMENSIONS, STATS_TOTAL, stats_tables, query_stats, format_stats_results
+from db import get_connection_manager
+from sql_render import fetch_preview, render_rows, strip_statement
+from sql_guard import QueryRejected, guard_query, reject_full_scans, large_tables
+from cache import LRUCache, normalize_sql
+from llm_backend import get_default_backend
+from history_store import get_history_store
+from context_window import ContextWindow
+from telemetry import metrics, log, dump_prompt, CycleTrace, QuestionTrace
 
-class Agent:
-    def __init__(self):
-        self.client = OpenAI(api_key=OPENAI_API_KEY)
-        self.cycle_count = 0
-        self.conversation_history = []
-        # 不再自動載入歷史，而是在需要時載入
+def parse_decision(response):
+    """取出 <if_finish> 的決定（'finish' / 'continue'），沒有標籤時回傳 None"""
+    match = re.search(r'<if_finish>(.*?)</if_finish>', response)
+    return match.group(1).strip().lower() if match else None
+
+
+def parse_action(response):
+    """取出第一個 <action> 標籤內的動作，沒有時回傳 None"""
+    actions = parse_actions(response)
+    return actions[0] if actions else None
+
+
+def parse_actions(response):
+    """依序取出所有非空的 <action> 標籤內容"""
+    actions = (match.strip() for match in re.findall(r'<action>(.*?)</action>', response, re.DOTALL))
+    return [action for action in actions if action]
+
+
+# SQL 被拒絕時附上的替代做法
+SQL_REJECTION_HINTS = {
+    'full_scan': "請加上 case_id 條件（有索引）；搜尋關鍵字改用 SEARCH，統計改用 STATS 或 LAW，查看判決內容改用 SNIPPET",
+    'budget': "請縮小查詢範圍（加上 WHERE 條件、避免多表交叉 JOIN），或改用 SEARCH / STATS",
+    'timeout': "請縮小查詢範圍（加上 WHERE 條件、避免多表交叉 JOIN），或改用 SEARCH / STATS",
+    'not_allowed': "資料庫為唯讀，只能執行 SELECT / WITH 查詢",
+}
+# 可以使用的動作命令
+ACTION_COMMANDS = ('READ_FILE', 'SQL', 'SQL_COUNT', 'SEARCH', 'STATS', 'LAW', 'SIMILAR', 'SNIPPET')
+
+
+def truncate_observation(text, budget):
+    """將單一動作的結果截到 budget 字元內"""
+    if len(text) <= budget:
+        return text
+    return f"{text[:budget]}\n... (結果已截斷，省略 {len(text) - budget} 字元，需要時請縮小查詢範圍)"
+
+
+def extract_content(response):
+    """取出 <content> 的內容，沒有標籤時回傳整段回應"""
+    match = re.search(r'<content>(.*?)</content>', response, re.DOTALL)
+    return match.group(1).strip() if match else response
+
+
+# 所有 Agent 共用的 SQL 結果快取，鍵包含資料庫世代編號
+sql_result_cache = LRUCache(max_entries=SQL_CACHE_MAX_ENTRIES, max_size=SQL_CACHE_MAX_SIZE, ttl=SQL_CACHE_TTL)
+metrics.register_cache('sql', sql_result_cache.stats)
+
+class AgentResources:
+    """所有 Agent（session）共用的資源：導入後的資料庫、唯讀連線、LLM backend 與歷史資料庫
+
+    建立時會執行一次 CSV 增量導入；之後建立的 Agent 只需要輕量的對話狀態。
+    """
+
+    def __init__(self, llm=None):
+        # LLM backend 預設由整個程序共用（openai / replay / stub，見 config.LLM_BACKEND）
+        self.llm = llm or get_default_backend()
+        # 經過排程器時看被包住的 backend；有磁碟快取的 backend 一併輸出命中率
+        cached = self.llm.backend if hasattr(self.llm, 'for_session') else self.llm
+        if hasattr(cached, 'stats'):
+            metrics.register_cache('llm', cached.stats)
+        self.history_store = get_history_store(HISTORY_DB)
+        self._action_executor = None
+        self._executor_lock = threading.Lock()
         self.setup_database()
-        self.available_tables = self.get_available_tables()
-        self.show_prompt = True  # 是否顯示 prompt
+
+    @property
+    def action_executor(self):
+        """同一回應中的多個動作在此執行緒池並行執行，第一次使用時才建立"""
+        with self._executor_lock:
+            if self._action_executor is None:
+                self._action_executor = ThreadPoolExecutor(max_workers=ACTION_WORKERS,
+                                                           thread_name_prefix='agent-multi-action')
+            return self._action_executor
 
     def setup_database(self):
-        """初始化 SQLite 數據庫並導入 CSV 文件"""
+        """初始化 SQLite 數據庫並增量導入 CSV 文件"""
         self.db_path = os.path.join(FILES_DIR, 'data.db')
-        # 不在初始化時創建連接，而是在需要時創建
         
-        # 自動導入所有 CSV 文件到 SQLite
-        conn = sqlite3.connect(self.db_path)
-        for file in os.listdir(FILES_DIR):
-            if file.endswith('.csv'):
-                table_name = os.path.splitext(file)[0]
-                df = pd.read_csv(os.path.join(FILES_DIR, file))
-                df.to_sql(table_name, conn, if_exists='replace', index=False)
-                print(f"已導入表格: {table_name}")
+        # 只重新導入內容有變動的 CSV 文件
+        started = time.perf_counter()
+        self.ingest_report = ingest_csv_files(self.db_path, FILES_DIR, chunk_size=INGEST_CHUNK_SIZE,
+                                              body_storage=BODY_STORAGE, compression_level=BODY_COMPRESSION_LEVEL)
+        log('info', 'ingest_report', format_ingest_report(self.ingest_report, time.perf_counter() - started))
+        for item in self.ingest_report:
+            if item["status"] == 'loaded':
                 # 顯示表格結構
-                cursor = conn.cursor()
-                cursor.execute(f"PRAGMA table_info({table_name})")
-                columns = cursor.fetchall()
-                print("列名:", [col[1] for col in columns])
-        conn.close()
+                log('debug', 'table_columns', f"{item['table']} 列名: {item['columns']}")
+
+        # 查詢使用每個執行緒一條的長期唯讀連線，整個程序共用
+        self.db = get_connection_manager(
+            self.db_path,
+            mmap_size=DB_MMAP_SIZE,
+            cache_size_kib=DB_CACHE_SIZE_KIB,
+            cached_statements=DB_CACHED_STATEMENTS,
+        )
+        self.db.refresh_generation()
+
+
+class Agent:
+    def __init__(self, llm=None, session_id=DEFAULT_SESSION_ID, resources=None):
+        # 未提供共用資源時自行建立（單機 CLI 的用法）
+        self.resources = resources or AgentResources(llm=llm)
+        self.llm = llm or self.resources.llm
+        if hasattr(self.llm, 'for_session'):
+            # 經過排程器的 backend 依 session 限制並行的請求數
+            self.llm = self.llm.for_session(session_id)
+        self.db_path = self.resources.db_path
+        self.db = self.resources.db
+        self.history_store = self.resources.history_store
+        self.session_id = session_id
+        self.context_window = ContextWindow(
+            token_budget=CONTEXT_TOKEN_BUDGET,
+            keep_recent=CONTEXT_KEEP_RECENT,
+            summary_chars=CONTEXT_SUMMARY_CHARS,
+        )
+        self.cycle_count = 0
+        self.conversation_history = []
+        # 目前循環與目前問題的追蹤紀錄
+        self.trace = CycleTrace(session_id, 0)
+        self.question_trace = None
+        # 不再自動載入歷史，而是在需要時載入
+        self.available_tables = self.get_available_tables()
+        self.show_prompt = bool(PROMPT_DUMP)  # 是否輸出完整 prompt（除錯用，見 config.PROMPT_DUMP）
 
     def get_available_tables(self):
-        """獲取數據庫中所有可用的表及其結構"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        tables = {}
-        
-        # 獲取所有表名
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        table_names = cursor.fetchall()
-        
-        # 獲取每個表的結構
-        for (table_name,) in table_names:
-            cursor.execute(f"PRAGMA table_info({table_name})")
-            columns = cursor.fetchall()
-            tables[table_name] = [col[1] for col in columns]
-        
-        conn.close()
-        return tables
+        """獲取數據庫中所有可用的表及其結構（同一資料庫世代內只查詢一次）"""
+        return self.db.schema()
+
+    def execute_sql(self, sql, count_remaining=False):
+        """執行 SQL 查詢並返回結果
+
+        查詢最多只取回 max_rows + 1 行；count_remaining=True（SQL_COUNT 動作）時才會另外計算總行數。
+        查詢在防護下執行：只允許唯讀語句、有指令預算與時間上限，且不允許全表掃描大型表格，
+        被拒絕時回傳原因與替代做法讓 AI 修正查詢。
+        成功的結果會以正規化後的 SQL 與資料庫世代編號為鍵放入共用快取，重新導入 CSV 後自動失效。
+        """
+        cache_key = (self.db.db_path, self.db.generation, normalize_sql(sql), count_remaining)
+        cached = sql_result_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-    def execute_sql(self, sql):
-        """執行 SQL 查詢並返回結果"""
         try:
             # 清理 SQL 語句，去除可能的大括號
             sql = sql.replace('{', '').replace('}', '')
             
-            # 執行查詢
-            conn = sqlite3.connect(self.db_path)
-            df = pd.read_sql_query(sql, conn)
-            conn.close()
-            
             # 限制回傳的資料量
             max_rows = 5  # 最多顯示 5 行
             max_column_length = 2000  # 每個欄位最多顯示 2000 字元
             max_total_length = 5000  # 總字數限制
             
-            if len(df) > max_rows:
-                df = df.head(max_rows)
-            
-            # 處理每個欄位的字數限制
-            for column in df.columns:
-                if df[column].dtype == 'object':  # 只處理文字欄位
-                    df[column] = df[column].apply(lambda x: str(x)[:max_column_length] + '...' if len(str(x)) > max_column_length else x)
-            
-            # 轉換為字串
-            result = df.to_string()
+            # 執行查詢
+            conn = self.db.connection()
+            large = large_tables(self.db.table_sizes(), SQL_SCAN_MAX_ROWS, SQL_SCAN_MAX_BYTES)
+            with guard_query(conn, SQL_MAX_INSTRUCTIONS, SQL_TIMEOUT_SECONDS) as body_reads:
+                reject_full_scans(conn, strip_statement(sql), large, body_reads)
+                columns, rows, total = fetch_preview(conn, sql, max_rows=max_rows,
+                                                     count_remaining=count_remaining)
+            if not columns:
+                return "SQL 查詢結果: 語句沒有回傳任何欄位"
             
-            # 處理總字數限制
-            if len(result) > max_total_length:
-                result = result[:max_total_length] + f"\n... (超過 {max_total_length} 字元限制)"
+            result = render_rows(columns, rows, max_column_length=max_column_length,
+                                 max_total_length=max_total_length)
             
             # 如果有更多行未顯示，添加提示
-            if len(df) > max_rows:
-                result += f"\n... (還有 {len(df) - max_rows} 行未顯示)"
-            
-            return f"SQL 查詢結果 ({len(df)} 行):\n{result}"
+            if total is None:
+                result += f"\n... (還有更多行未顯示，需要總行數時改用 SQL_COUNT 執行同一個查詢)"
+                result = f"SQL 查詢結果 (顯示前 {len(rows)} 行):\n{result}"
+            else:
+                if total > len(rows):
+                    result += f"\n... (還有 {total - len(rows)} 行未顯示)"
+                result = f"SQL 查詢結果 ({total} 行):\n{result}"
             
+        except QueryRejected as e:
+            return f"SQL 查詢被拒絕: {e}\n{SQL_REJECTION_HINTS[e.kind]}"
         except Exception as e:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            table_names = cursor.fetchall()
-            available_tables = "\n".join([f"- {table_name[0]}: " + ', '.join([col[1] for col in cursor.execute(f"PRAGMA table_info({table_name[0]})").fetchall()]) for table_name in table_names])
-            conn.close()
+            available_tables = self.db.describe_schema()
             return f"SQL 執行錯誤: {str(e)}\n\n可用的表格和列：\n{available_tables}"
 
+        sql_result_cache.put(cache_key, result)
+        return result
+
+    def search(self, table_name, query, limit=10):
+        """以 FTS5 全文索引搜尋判決內容或被告行為，回傳依 bm25 排序的結果"""
+        terms = split_terms(query)
+        if not terms:
+            return "SEARCH 錯誤: 請提供至少一個關鍵字，格式為 SEARCH 表格名稱 關鍵字"
+        try:
+            result = search_fts(self.db.connection(), table_name, terms, limit=limit)
+        except sqlite3.Error as e:
+            return f"SEARCH 執行錯誤: {str(e)}"
+        if result is None:
+            searchable = [name for name, columns in self.get_available_tables().items()
+                          if 'judgement_content' in columns or 'defendant_behavior' in columns]
+            return f"SEARCH 錯誤: 表格 {table_name} 沒有全文索引\n\n可搜尋的表格：\n" + "\n".join(f"- {name}" for name in searchable)
+        columns, rows = result
+        return format_search_results(table_name, terms, columns, rows)
+
+    def stats(self, dimension, value_filter=None, limit=20):
+        """查詢導入時預先計算的有罪/無罪統計（依爭點、法條、法院、年份或全部）"""
+        dimensions = list(STATS_DIMENSIONS) + [STATS_TOTAL]
+        if dimension not in dimensions:
+            return f"STATS 錯誤: 未知的統計維度 {dimension}，可用的維度：{', '.join(dimensions)}"
+        try:
+            conn = self.db.connection()
+            tables = stats_tables(conn)
+            if not tables:
+                return "STATS 錯誤: 資料庫中沒有可用的統計表"
+            results = []
+            for table_name in tables:
+                _, rows, group_count = query_stats(conn, table_name, dimension, value_filter, limit=limit)
+                results.append(format_stats_results(table_name, dimension, value_filter, rows, group_count))
+        except sqlite3.Error as e:
+            return f"STATS 執行錯誤: {str(e)}"
+        return "\n\n".join(results)
+
+    def law_cases(self, query, limit=20):
+        """以法條索引查詢引用某法條的案件，連同各案件的爭點與有罪/無罪"""
+        parsed = parse_law_query(query)
+        if parsed is None:
+            return "LAW 錯誤: 無法辨識法條，格式為 LAW 法規名稱 條號，例如 LAW 刑法 339之4 或 LAW 洗錢防制法第14條"
+        law, article = parsed
+        try:
+            cases, total = lookup_cases(self.db.connection(), law, article, limit=limit)
+        except sqlite3.Error as e:
+            return f"LAW 執行錯誤: {str(e)}"
+        return format_law_results(law, article, cases, total)
+
+    def similar(self, query, k=5):
+        """以 TF-IDF 向量找出與一段事實描述（或某個 case_id）最相似的案件
+
+        向量索引在第一次查詢時才載入（mmap），不影響啟動時間。
+        """
+        query = query.strip()
+        if not query:
+            return "SIMILAR 錯誤: 請提供案件事實描述或 case_id，格式為 SIMILAR 描述文字 或 SIMILAR case_id"
+        indexes = load_vector_indexes(self.db_path)
+        if not indexes:
+            return "SIMILAR 錯誤: 尚未建立相似案件向量索引"
+        # 參數剛好是已知的 case_id 時，以該案件的向量查詢
+        case_id = query if len(query.split()) == 1 and any(query in index.case_rows for index in indexes) else None
+        results = []
+        for index in indexes:
+            if case_id is not None:
+                vector = index.case_vector(case_id)
+                hits = index.top_k(vector, k=k, exclude_case=case_id) if vector is not None else []
+            else:
+                hits = index.top_k(index.query_vector(query), k=k)
+            results.append((index, hits))
+        label = f"與 case_id={case_id} 相似" if case_id is not None else f"查詢: {query[:50]}"
+        return format_similar_results(label, results)
+
+    def snippet(self, query, limit=3):
+        """擷取某個案件判決中與關鍵字最相關的段落，取代讀取整份判決的前 2000 字"""
+        case_id, terms = parse_snippet_query(query)
+        if not case_id or not terms:
+            return "SNIPPET 錯誤: 格式為 SNIPPET case_id 關鍵字1 關鍵字2"
+        try:
+            conn = self.db.connection()
+            for table_name in paragraph_tables(conn):
+                result = find_snippets(conn, table_name, case_id, terms, limit=limit)
+                if result is not None:
+                    total, snippets = result
+                    return format_snippets(table_name, case_id, terms, total, snippets)
+        except sqlite3.Error as e:
+            return f"SNIPPET 執行錯誤: {str(e)}"
+        return f"SNIPPET 錯誤: 找不到 case_id={case_id} 的判決全文"
+
+    def run_action(self, action):
+        """執行 <action> 標籤內的動作，回傳要回饋給 AI 的 [SYSTEM] 訊息；無法辨識的動作回傳 None"""
+        # 命令與參數之間可以是空白或換行（多行 SQL）
+        parts = action.strip().split(None, 1)
+        command = parts[0] if parts else ''
+        argument = parts[1] if len(parts) > 1 else ''
+        with self.trace.span(command.lower() if command in ACTION_COMMANDS else 'unknown_action'):
+            return self.dispatch_action(command, argument)
+
+    def dispatch_action(self, command, argument):
+        """依命令執行動作，回傳 [SYSTEM] 訊息；未知的命令回傳 None"""
+        if command == 'READ_FILE':
+            filename = argument.strip()
+            file_content = self.read_file(filename)
+            return f"[SYSTEM] 我已經讀取了文件 {filename}，內容如下:\n{file_content}"
+
+        if command in ('SQL', 'SQL_COUNT'):
+            result = self.execute_sql(argument, count_remaining=(command == 'SQL_COUNT'))
+            return f"[SYSTEM] SQL 查詢結果如下:\n{result}"
+
+        if command == 'SEARCH':
+            parts = argument.split(None, 1)
+            table_name = parts[0] if parts else ''
+            query = parts[1] if len(parts) > 1 else ''
+            result = self.search(table_name, query)
+            return f"[SYSTEM] 全文搜尋結果如下:\n{result}"
+
+        if command == 'STATS':
+            parts = argument.split(None, 1)
+            dimension = parts[0] if parts else STATS_TOTAL
+            value_filter = parts[1].strip() if len(parts) > 1 else None
+            result = self.stats(dimension, value_filter)
+            return f"[SYSTEM] 統計結果如下:\n{result}"
+
+        if command == 'LAW':
+            result = self.law_cases(argument)
+            return f"[SYSTEM] 法條查詢結果如下:\n{result}"
+
+        if command == 'SIMILAR':
+            result = self.similar(argument)
+            return f"[SYSTEM] 相似案件查詢結果如下:\n{result}"
+
+        if command == 'SNIPPET':
+            result = self.snippet(argument)
+            return f"[SYSTEM] 判決段落擷取結果如下:\n{result}"
+
+        return None
+
+    def run_actions(self, actions):
+        """執行一次回應中的所有動作，回傳合併後的 [SYSTEM] 訊息；全部無法辨識時回傳 None
+
+        只有一個動作時與 run_action 相同；多個動作在共用的執行緒池並行執行，
+        每個動作的結果以 ACTION_OBSERVATION_BUDGET 平分後的字數為上限，依原順序合併。
+        """
+        if len(actions) == 1:
+            return self.run_action(actions[0])
+
+        skipped = actions[MAX_ACTIONS_PER_TURN:]
+        actions = actions[:MAX_ACTIONS_PER_TURN]
+        with self.trace.span('actions'):
+            futures = [self.resources.action_executor.submit(self.run_action, action) for action in actions]
+            observations = [future.result() for future in futures]
+        if all(observation is None for observation in observations):
+            return None
+
+        budget = ACTION_OBSERVATION_BUDGET // len(actions)
+        sections = [f"[SYSTEM] 本次回應共執行 {len(actions)} 個動作，結果如下:"]
+        for index, (action, observation) in enumerate(zip(actions, observations), 1):
+            if observation is None:
+                body = "無法辨識的動作，請使用 READ_FILE、SQL、SQL_COUNT、SEARCH、STATS、LAW、SIMILAR 或 SNIPPET"
+            else:
+                body = truncate_observation(observation.removeprefix('[SYSTEM] '), budget)
+            sections.append(f"### 動作 {index}: {action[:200]}\n{body}")
+        if skipped:
+            sections.append(f"另有 {len(skipped)} 個動作超過每次 {MAX_ACTIONS_PER_TURN} 個的上限，未執行")
+        return "\n\n".join(sections)
+
     def save_history(self):
-        """保存對話歷史，包含完整的系統提示和對話內容"""
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        entry = {
-            "timestamp": current_time,
-            "cycle_count": self.cycle_count,
-            "system_prompt": self.last_system_prompt if hasattr(self, 'last_system_prompt') else None,
-            "conversation": self.conversation_history[-1] if self.conversation_history else None,
-            "full_context": self.last_full_context if hasattr(self, 'last_full_context') else None
-        }
-        
-        # 如果是第一次寫入，創建新文件
-        mode = 'w' if not os.path.exists(HISTORY_FILE) else 'a'
-        with open(HISTORY_FILE, 'a', encoding='utf-8') as f:
-            f.write("\n=== 新對話 ===\n")
-            json.dump(entry, f, ensure_ascii=False, indent=2)
-            f.write("\n")
-
-    def load_history(self):
-        """載入對話歷史"""
+        """保存本次循環的對話，系統提示與完整上下文以雜湊去重後存入歷史資料庫"""
+        full_context = getattr(self, 'last_full_context', None)
+        self.history_store.append(
+            self.session_id,
+            self.cycle_count,
+            self.conversation_history[-1] if self.conversation_history else None,
+            system_prompt=getattr(self, 'last_system_prompt', None),
+            messages=full_context["messages"] if full_context else None,
+        )
+
+    def load_history(self, limit=HISTORY_LOAD_LIMIT):
+        """載入此 session 最後 limit 筆對話歷史"""
+        try:
+            self.conversation_history = self.history_store.tail(self.session_id, limit)
+        except sqlite3.Error as e:
+            self.conversation_history = []
+            log('error', 'history_load_failed', f"載入對話歷史時發生錯誤: {e}", session=self.session_id)
+
+    def reset_history(self):
+        """清除此 session 的對話歷史與循環計數"""
+        self.history_store.reset(self.session_id)
         self.conversation_history = []
-        if os.path.exists(HISTORY_FILE):
-            try:
-                with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    # 分割每個對話記錄
-                    conversations = content.split("=== 新對話 ===")
-                    for conv in conversations:
-                        if conv.strip():
-                            try:
-                                entry = json.loads(conv.strip())
-                                if entry.get("conversation"):
-                                    self.conversation_history.append(entry["conversation"])
-                            except json.JSONDecodeError:
-                                print(f"無法解析對話記錄: {conv[:100]}...")
-            except Exception as e:
-                print(f"載入對話歷史時發生錯誤: {e}")
+        self.cycle_count = 0
 
     def format_history_for_ai(self):
         """格式化對話歷史，讓AI更容易理解"""
         formatted_history = []
         for entry in self.conversation_history:
-            parts = entry.split("\n", 1)
-            if len(parts) == 2 and parts[0].startswith("User: ") and "AI: " in parts[1]:
-                user_msg = parts[0].replace("User: ", "")
-                ai_msg = parts[1].replace("AI: ", "")
+            # 使用者訊息（例如 SQL 結果）可能有多行，以第一個 "\nAI: " 分隔
+            if entry.startswith("User: ") and "\nAI: " in entry:
+                user_msg, ai_msg = entry[len("User: "):].split("\nAI: ", 1)
                 formatted_history.append({
                     "user": user_msg,
                     "assistant": ai_msg
@@ -166,56 +422,64 @@ class Agent:
         with open(file_path, 'r', encoding='utf-8') as f:
             return f.read()
 
-    def think(self, user_input):
-        self.cycle_count += 1
-        
-        print(f"\n=== Agent.think() 被調用，循環 #{self.cycle_count} ===")
-        print(f"用戶輸入: {user_input[:100]}...")
-        
-        # 準備系統提示
-        system_prompt = f"""你是一個可以閱讀本地文件和執行 SQL 查詢的法律案例分析專家。請你根據用戶的問題主動查詢相關案例分析回答
+    def build_system_prompt(self):
+        """組出本次循環的系統提示"""
+        return f"""你是一個可以閱讀本地文件和執行 SQL 查詢的法律案例分析專家。請你根據用戶的問題主動查詢相關案例分析回答
 當前是第 {self.cycle_count} 次循環，你正在與自己對話進行法律分析
 
 可用的資料表說明：
 1. judgement_guilty_analysis_grouping_20250223_180510
    - 包含各爭點的有罪/無罪統計資料
-   - 重要欄位：defendant_behavior (被告行為，用來搜尋關鍵字), issue_type (爭點), guilty (有罪/無罪) 可用來統計爭點下有無罪的案件比率
+   - 重要欄位：defendant_behavior (被告行為，可用 SEARCH 搜尋關鍵字), issue_type (爭點), guilty (有罪/無罪) 可用來統計爭點下有無罪的案件比率
    - 可用於了解整體趨勢和常見爭點
 
 2. judgement_raw_20250223_181106
    - 包含原始判決書內容
    - 使用 case_id 查詢特定案件的完整內容
-   - 建議用法：SELECT * FROM judgement_raw_20250223_181106 WHERE case_id = '案件編號'
+   - 建議用法：SNIPPET 案件編號 關鍵字（只取相關段落），需要完整內容時才用 SELECT * FROM judgement_raw_20250223_181106 WHERE case_id = '案件編號'
+   - 判決全文 judgement_content 可用 SEARCH 搜尋關鍵字找出相關案件
 
 3. judgements_guilty_analysis_by_row_20250223_175846
    - 包含詳細的案件分析，每個爭點一行
-   - 重要欄位：issue_type(爭點)、law_articles(法條)、guilty(有無罪)
+   - 重要欄位：issue_type(爭點)、law_articles(法條)、guilty(有無罪)、defendant_behavior(被告行為，可用 SEARCH 搜尋)
    - 可用於深入分析特定爭點或法條的應用情況
 
 分析建議：
-1. 先用 grouping 表了解整體趨勢
+1. 有罪率、趨勢類問題先用 STATS 查預先計算好的統計，再用 grouping 表了解整體趨勢
 2. 用 by_row 表深入分析特定爭點
 3. 需要查看原始判決時，用 raw 表
 
 可用的動作：
 1. 讀取文件 (使用 READ_FILE 命令)
-2. 執行 SQL 查詢 (使用 SQL 命令)
-3. 決定是否繼續分析 (使用 if_finish 標籤)
+2. 執行 SQL 查詢 (使用 SQL 命令；需要知道未顯示的行數時改用 SQL_COUNT，格式相同，會另外計算總行數)
+3. 全文搜尋 (使用 SEARCH 命令，格式：SEARCH 表格名稱 關鍵字1 關鍵字2，回傳依相關度排序的 case_id 與摘要)
+4. 查詢統計 (使用 STATS 命令，格式：STATS 維度 [篩選字串]，維度可為 issue_type、law、court、year 或 all，
+   回傳各組的件數、有罪、無罪、有罪率與案件數，例如 STATS law 339 或 STATS year)
+5. 依法條查案件 (使用 LAW 命令，格式：LAW 法規名稱 條號，例如 LAW 刑法 339之4 或 LAW 洗錢防制法第14條，
+   只給法規名稱則查該法規所有條文；回傳引用該條的 case_id 與各爭點的有罪/無罪，比 LIKE 查 law_articles 快且完整)
+6. 找相似案件 (使用 SIMILAR 命令，格式：SIMILAR 案件事實描述 或 SIMILAR case_id，
+   依判決全文與被告行為的文字相似度回傳最相近的案件，適合「找跟這個情況類似的案例」)
+7. 擷取判決段落 (使用 SNIPPET 命令，格式：SNIPPET case_id 關鍵字1 關鍵字2，
+   回傳該判決中與關鍵字最相關的幾個段落；判決開頭多為案號與當事人資料，查看判決內容時請優先使用 SNIPPET)
+8. 決定是否繼續分析 (使用 if_finish 標籤)
 
 SQL 查詢注意事項：
 1. 不要在 SQL 語句外加大括號
 2. 確保表名完全正確
 3. 可嘗試檢視資料表內範例資料了解資料
-4. 使用 LIKE 查詢時用 '%關鍵字%'
+4. 搜尋判決全文或被告行為的關鍵字時優先使用 SEARCH（1～2 個字的關鍵字也有索引），不要用 LIKE '%關鍵字%' 掃描全表
 5. 每次查詢最多顯示 5 行資料
 6. 單一欄位最多顯示 2000 字元
 7. 查詢結果總字數限制為 5000 字元
+8. 資料庫為唯讀，每個查詢有時間上限；不允許全表掃描判決全文等大型表格，請以 case_id 條件查詢，被拒絕時依提示改用其他動作
 
 請嚴格依照以下格式回應：
 <think>思考方向 五十字內 </think>
-<action>READ_FILE {{filename}} 或 SQL {{query}}</action>
+<action>READ_FILE {{filename}} 或 SQL {{query}} 或 SQL_COUNT {{query}} 或 SEARCH {{table}} {{keywords}} 或 STATS {{dimension}} {{filter}} 或 LAW {{law}} {{article}} 或 SIMILAR {{description}} 或 SNIPPET {{case_id}} {{keywords}}</action>
 <if_finish>continue 或 finish</if_finish>
 <content>若完成則輸出針對用戶問題回答內容</content>
+可在同一次回應中放入多個 <action> 標籤（最多 {MAX_ACTIONS_PER_TURN} 個），它們會同時執行，結果合併在下一則訊息中依序回傳
+彼此不互相依賴的查詢（例如統計與多個案例的內容）請一次發出，減少來回次數；多個動作時每個結果的字數上限會依動作數平分
 若你認為分析完成了請使用 finish,沒有則輸入 continue
 若你決定 finish 請在 content 內總結到目前為止的發現與分析
 回應的時候請盡量引用你搜尋到的數據、具體案例與事實，增加可信度
@@ -223,22 +487,30 @@ SQL 查詢注意事項：
 若用戶的問題跟法律無關請 finish 對話
 """
 
+    def prepare_messages(self, user_input):
+        """開始新的循環：組出系統提示與對話歷史，回傳要送給 LLM 的訊息列表"""
+        self.cycle_count += 1
+        self.trace = CycleTrace(self.session_id, self.cycle_count)
+        # 不是以 [ 開頭的輸入（動作結果、[ORIGINAL_QUESTION]）就是新的問題
+        if self.question_trace is None or not user_input.startswith('['):
+            if self.question_trace is not None:
+                self.question_trace.finish('unfinished')
+            self.question_trace = QuestionTrace(self.session_id)
+
+        log('debug', 'cycle_start', f"Agent.think() 循環 #{self.cycle_count}",
+            session=self.session_id, cycle=self.cycle_count, input=user_input[:100])
+        
+        # 準備系統提示
+        system_prompt = self.build_system_prompt()
+
         # 保存最後的系統提示
         self.last_system_prompt = system_prompt
         
-        # 準備消息
-        messages = [
-            {"role": "system", "content": system_prompt}
-        ]
-        
-        # 添加所有歷史對話
+        # 準備消息：較早的動作結果壓縮成摘要，整體控制在 token 預算內
         history = self.format_history_for_ai()
-        for exchange in history:
-            messages.append({"role": "user", "content": exchange["user"]})
-            messages.append({"role": "assistant", "content": exchange["assistant"]})
-        
-        # 添加當前輸入
-        messages.append({"role": "user", "content": user_input})
+        messages, self.last_prompt_stats = self.context_window.build(system_prompt, history, user_input)
+        log('debug', 'prompt', f"Prompt 大小: 約 {self.last_prompt_stats['prompt_tokens']} tokens",
+            session=self.session_id, cycle=self.cycle_count, **self.last_prompt_stats)
         
         # 保存完整上下文
         self.last_full_context = {
@@ -246,45 +518,60 @@ SQL 查詢注意事項：
             "show_prompt": self.show_prompt
         }
         
-        # 顯示完整 prompt
+        # 完整 prompt 只在開啟除錯輸出時才輸出
         if self.show_prompt:
-            print("\n=== 完整 Prompt ===")
-            print("\n[SYSTEM]")
-            print(system_prompt)
-            print("\n[對話歷史]")
-            for exchange in history:
-                print("\n[USER]")
-                print(exchange["user"])
-                print("\n[ASSISTANT]")
-                print(exchange["assistant"])
-            print("\n[當前輸入]")
-            print(user_input)
-            print("\n=== Prompt 結束 ===\n")
+            dump_prompt(self.session_id, self.cycle_count, messages)
         
-        # 獲取 AI 回應
-        print("正在獲取 AI 回應...")
-        response = self.client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=messages,
-            temperature=0.7
-        )
-        
-        ai_response = response.choices[0].message.content
-        print(f"AI 回應長度: {len(ai_response)}")
+        return messages
+
+    def record_response(self, user_input, completion):
+        """記錄 LLM 回應並寫入對話歷史，回傳回應文字"""
+        ai_response = completion["content"]
+        self.last_usage = completion["usage"]
+        self.trace.record_usage(completion["usage"], completion["source"])
         
-        # 檢查是否包含 finish 標籤
-        if '<if_finish>finish</if_finish>' in ai_response:
-            print("\n=== 檢測到 finish 標籤 ===")
-            content_match = re.search(r'<content>(.*?)</content>', ai_response, re.DOTALL)
-            if content_match:
-                content = content_match.group(1).strip()
-                print("\n=== AI 完整回應（agent.think 中檢測） ===")
-                print(content)
-                print("=== 回應結束 ===\n")
-            else:
-                print("未找到 content 標籤")
+        with self.trace.span('parse'):
+            decision = parse_decision(ai_response)
+            actions = parse_actions(ai_response)
+        log('debug', 'response', f"AI 回應長度: {len(ai_response)}",
+            session=self.session_id, cycle=self.cycle_count, source=completion["source"],
+            decision=decision, actions=len(actions))
         
         self.conversation_history.append(f"User: {user_input}\nAI: {ai_response}")
-        self.save_history()
+        with self.trace.span('history'):
+            self.save_history()
+        self.trace.finish()
+
+        if self.question_trace is not None:
+            self.question_trace.add_cycle(completion["usage"])
+            if decision != 'continue':
+                self.question_trace.finish('finish' if decision == 'finish' else 'no_decision')
+                self.question_trace = None
         
         return ai_response
+
+    def think(self, user_input):
+        messages = self.prepare_messages(user_input)
+        
+        # 獲取 AI 回應
+        with self.trace.span('llm'):
+            completion = self.llm.complete(MODEL_NAME, messages, temperature=LLM_TEMPERATURE)
+        return self.record_response(user_input, completion)
+
+    def think_stream(self, user_input):
+        """think 的串流版本：逐段產生 LLM 回應文字，結束時寫入對話歷史並以 return 回傳完整回應"""
+        messages = self.prepare_messages(user_input)
+
+        # llm span 包含呼叫端處理每段文字的時間
+        with self.trace.span('llm'):
+            completion = yield from self.llm.stream(MODEL_NAME, messages, temperature=LLM_TEMPERATURE)
+        return self.record_response(user_input, completion)
+
+    async def athink(self, user_input, executor=None):
+        """think 的非同步版本：等待 LLM 時不佔用執行緒，寫入歷史在 executor 中進行"""
+        messages = self.prepare_messages(user_input)
+        
+        with self.trace.span('llm'):
+            completion = await self.llm.acomplete(MODEL_NAME, messages, temperature=LLM_TEMPERATURE)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.record_response, user_input, completion)
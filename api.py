@@ -1,17 +1,55 @@
-from flask import Flask, request, jsonify, Response, send_from_directory
+from flask import Flask, request, jsonify, Response, send_from_directory, g
 from flask_cors import CORS
 import json
 import time
-import re
-import os
-from agent import Agent
-from config import HISTORY_FILE  # Import HISTORY_FILE from config
+import uuid
+from agent import Agent, AgentResources, parse_decision, parse_actions, extract_content
+from async_engine import AnswerLoop
+from session_manager import SessionManager
+from tag_parser import TagStreamParser
+from telemetry import metrics, log
+from llm_scheduler import LLMOverloaded
+from config import SESSION_MAX_COUNT, SESSION_TTL, SESSION_MAX_HISTORY_CHARS
 
 app = Flask(__name__, static_folder='frontend')
-CORS(app)  # Enable CORS for all routes
+CORS(app, supports_credentials=True)  # Enable CORS for all routes
 
-# Initialize the agent
-agent = Agent()
+SESSION_HEADER = 'X-Session-Id'
+SESSION_COOKIE = 'session_id'
+
+# 所有 session 共用資料庫、LLM client 與歷史資料庫，只在啟動時導入一次 CSV
+resources = AgentResources()
+
+
+def create_session_agent(session_id):
+    agent = Agent(resources=resources, session_id=session_id)
+    # 被回收後再次出現的 session 從歷史資料庫接續最近的對話
+    agent.load_history()
+    return agent
+
+
+sessions = SessionManager(
+    create_session_agent,
+    max_sessions=SESSION_MAX_COUNT,
+    ttl=SESSION_TTL,
+    max_history_chars=SESSION_MAX_HISTORY_CHARS,
+)
+
+
+def current_session():
+    """依 X-Session-Id 標頭或 session_id cookie 取得 session，兩者都沒有時建立新的 session id"""
+    session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    if not session_id:
+        session_id = uuid.uuid4().hex
+        g.new_session_id = session_id
+    return sessions.get(session_id)
+
+
+@app.after_request
+def set_session_cookie(response):
+    if getattr(g, 'new_session_id', None):
+        response.set_cookie(SESSION_COOKIE, g.new_session_id, httponly=True, samesite='Lax')
+    return response
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
@@ -19,39 +57,48 @@ def chat():
     user_input = data.get('message', '')
     is_processing = data.get('isProcessing', False)
     
-    print("\n=== 收到用戶輸入 ===")
-    print(f"用戶輸入: {user_input[:100]}...")
-    print(f"是否處理中: {is_processing}")
+    session = current_session()
+    log('info', 'chat_request', "收到用戶輸入", session=session.session_id, processing=is_processing,
+        input=user_input[:100])
+    try:
+        with session.lock:
+            response = handle_chat(session.agent, user_input, is_processing, data.get('originalQuestion', ''))
+            cycle_count = session.agent.cycle_count
+    except LLMOverloaded as e:
+        return overloaded_response(e, session.session_id)
     
+    log('info', 'chat_response', f"回應長度: {len(response)}", session=session.session_id, cycle=cycle_count)
+    return jsonify({"response": response, "cycle_count": cycle_count, "session_id": session.session_id})
+
+def overloaded_response(error, session_id=None):
+    """LLM 排程器過載時立即回應 503，讓前端或負載平衡器稍後重試"""
+    log('warning', 'llm_overloaded', f"LLM 過載，回應 503: {error}", session=session_id, reason=error.reason)
+    response = jsonify({"error": str(error), "reason": error.reason})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, round(error.retry_after)))
+    return response
+
+def handle_chat(agent, user_input, is_processing, original_question):
+    """處理一次 /api/chat 請求，呼叫端需持有該 session 的鎖"""
     if is_processing:
         # 如果是處理中的消息，直接處理回應
-        response = process_ai_response(agent, user_input, data.get('originalQuestion', ''))
+        response = process_ai_response(agent, user_input, original_question)
     else:
         # 如果是新的用戶輸入，生成新的回應
         response = agent.think(user_input)
         
-        # 檢查是否是 finish
-        if_finish_match = re.search(r'<if_finish>(.*?)</if_finish>', response)
-        if if_finish_match and if_finish_match.group(1).strip().lower() == 'finish':
-            print("\n=== 檢測到 finish ===")
-            content_match = re.search(r'<content>(.*?)</content>', response, re.DOTALL)
-            if content_match:
-                content = content_match.group(1).strip()
-                print("\n=== AI 完整回應 ===")
-                print(content)
-                print("=== 回應結束 ===\n")
-            else:
-                print("未找到 content 標籤")
+        # 檢查是否是 finish，完整回應只在 debug 等級輸出
+        if parse_decision(response) == 'finish':
+            log('debug', 'chat_finish', extract_content(response), session=agent.session_id)
         else:
-            print("\n=== 未檢測到 finish ===")
+            log('debug', 'chat_continue', "未檢測到 finish", session=agent.session_id)
         
         # 處理回應
         processed_response = process_ai_response(agent, response, user_input)
         if processed_response != response:
             response = processed_response
     
-    print(f"回應長度: {len(response)}")
-    return jsonify({"response": response, "cycle_count": agent.cycle_count})
+    return response
 
 @app.route('/api/chat/stream', methods=['POST'])
 def chat_stream():
@@ -61,112 +108,131 @@ def chat_stream():
     if not user_input:
         return jsonify({"error": "No message provided"}), 400
     
+    session = current_session()
+    
     def generate():
-        # Get AI response
-        response = agent.think(user_input)
-        
-        # Extract thinking steps
-        thinking_steps = []
-        strategy_matches = re.findall(r'<strategy>(.*?)</strategy>', response)
-        think_matches = re.findall(r'<think>(.*?)</think>', response)
-        
-        # Combine strategy and think matches
-        for i in range(max(len(strategy_matches), len(think_matches))):
-            step = {}
-            if i < len(strategy_matches):
-                step['strategy'] = strategy_matches[i]
-            if i < len(think_matches):
-                step['think'] = think_matches[i]
-            if step:
-                thinking_steps.append(step)
-                
-                # Stream each thinking step
-                yield f"data: {json.dumps({'type': 'thinking', 'data': step})}\n\n"
-                time.sleep(0.5)  # Add delay for visual effect
-        
-        # Extract final content
-        content_match = re.search(r'<content>(.*?)</content>', response, re.DOTALL)
-        final_content = content_match.group(1) if content_match else response
-        
-        # Stream final response
-        yield f"data: {json.dumps({'type': 'final', 'data': final_content})}\n\n"
-        
-        # Process AI response if needed (SQL queries, etc.)
-        processed_response = process_ai_response(agent, response, user_input)
-        if processed_response != response:
-            # If there are additional steps, stream them
-            yield f"data: {json.dumps({'type': 'processing', 'data': processed_response})}\n\n"
+        with session.lock:
+            yield from stream_chat(session.agent, user_input)
     
-    return Response(generate(), mimetype='text/event-stream')
+    # 關閉快取與反向代理的緩衝，讓每個 token 事件立即送達
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(generate(), mimetype='text/event-stream', headers=headers)
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def stream_chat(agent, user_input):
+    """/api/chat/stream 的事件產生器，呼叫端需持有該 session 的鎖
+
+    每次循環依序送出：
+    - cycle：循環開始
+    - tag_open / token / tag_close：LLM 回應中各標籤的開始、新收到的文字與完整內容
+    - action / action_result：本次回應的動作列表與合併後的結果（例如 SQL 查詢結果）
+    最後送出 final（<content> 的內容、循環數與結束原因）；LLM 過載時改送 error 事件並結束。
+    """
+    try:
+        yield from _stream_cycles(agent, user_input)
+    except LLMOverloaded as e:
+        # 串流已經開始，無法再改成 503 狀態碼
+        yield sse_event({'type': 'error', 'status': 503, 'reason': e.reason, 'data': str(e),
+                         'retry_after': e.retry_after})
+
+
+def _stream_cycles(agent, user_input):
+    answer = AnswerLoop(user_input)
+    actions = answer.start()
+    while True:
+        if actions:
+            yield sse_event({'type': 'action', 'cycle': answer.cycles, 'data': actions})
+            action_started = time.monotonic()
+            observation = agent.run_actions(actions)
+            answer.record_actions(actions, observation, time.monotonic() - action_started)
+            if observation is not None:
+                yield sse_event({'type': 'action_result', 'cycle': answer.cycles, 'data': observation})
+        next_input = answer.next_input()
+        if next_input is None:
+            break
+        yield sse_event({'type': 'cycle', 'cycle': answer.cycles + 1})
+
+        parser = TagStreamParser()
+        stream = agent.think_stream(next_input)
+        while True:
+            try:
+                chunk = next(stream)
+            except StopIteration as stop:
+                response = stop.value
+                break
+            for event in parser.feed(chunk):
+                yield sse_event(tag_event(event))
+        for event in parser.close():
+            yield sse_event(tag_event(event))
+        actions = answer.record_response(response, agent.last_usage)
+
+    yield sse_event({
+        'type': 'final',
+        'data': extract_content(answer.response) if answer.response else '',
+        'cycles': answer.cycles,
+        'reason': answer.reason,
+    })
+
+
+def tag_event(event):
+    """將 TagStreamParser 的事件轉成 SSE 資料"""
+    if event["event"] == 'open':
+        return {'type': 'tag_open', 'tag': event["tag"]}
+    if event["event"] == 'text':
+        return {'type': 'token', 'tag': event["tag"], 'data': event["text"]}
+    return {'type': 'tag_close', 'tag': event["tag"], 'data': event["text"]}
 
 def process_ai_response(agent, response, initial_input=None):
     """Process AI response similar to the main.py implementation"""
-    print("\n=== 處理 AI 回應 ===")
+    session_id = agent.session_id
     
     # 先檢查是否要結束
-    if match := re.search(r'<if_finish>(.*?)</if_finish>', response):
-        decision = match.group(1).strip().lower()
-        print(f"檢測到 if_finish 標籤，決定: {decision}")
-        
-        if decision == 'finish':
-            # 直接返回 finish 的回應，不做處理
-            print("處理結果: 完成對話")
-            return response
-        elif decision == 'continue':
-            print("處理結果: 繼續對話")
-            # 只有在確定要繼續時才檢查動作
-            if action_match := re.search(r'<action>(.*?)</action>', response):
-                action = action_match.group(1)
-                print(f"檢測到動作: {action[:50]}...")
-                
-                if action.startswith('READ_FILE '):
-                    filename = action[10:]  # 去掉 'READ_FILE ' 前綴
-                    print(f"讀取文件: {filename}")
-                    file_content = agent.read_file(filename)
-                    return agent.think(f"[SYSTEM] 我已經讀取了文件 {filename}，內容如下:\n{file_content}")
-                
-                elif action.startswith('SQL '):
-                    sql = action[4:]  # 去掉 'SQL ' 前綴
-                    print(f"執行 SQL: {sql[:50]}...")
-                    result = agent.execute_sql(sql)
-                    return agent.think(f"[SYSTEM] SQL 查詢結果如下:\n{result}")
-                else:
-                    print(f"未知動作: {action[:50]}...")
-            else:
-                print("未檢測到動作")
+    decision = parse_decision(response)
+    log('debug', 'chat_decision', f"if_finish 決定: {decision}", session=session_id, decision=decision)
+    if decision == 'finish':
+        # 直接返回 finish 的回應，不做處理
+        return response
+    if decision == 'continue':
+        # 只有在確定要繼續時才檢查動作，同一回應中的多個動作並行執行
+        if actions := parse_actions(response):
+            log('debug', 'chat_actions', f"檢測到 {len(actions)} 個動作: {actions[0][:50]}",
+                session=session_id, actions=len(actions))
             
-            # 如果沒有動作但要繼續，使用原始問題或通用提示
-            next_input = f"[ORIGINAL_QUESTION] {initial_input}" if initial_input else "[SYSTEM] 請繼續分析上述情況。"
-            print(f"使用下一個輸入: {next_input[:50]}...")
-            return agent.think(next_input)
-    else:
-        print("未檢測到 if_finish 標籤")
+            observation = agent.run_actions(actions)
+            if observation is not None:
+                log('debug', 'chat_observation', f"動作結果: {observation[:100]}", session=session_id)
+                return agent.think(observation)
+            log('warning', 'chat_unknown_action', f"未知動作: {actions[0][:50]}", session=session_id)
+        
+        # 如果沒有動作但要繼續，使用原始問題或通用提示
+        next_input = f"[ORIGINAL_QUESTION] {initial_input}" if initial_input else "[SYSTEM] 請繼續分析上述情況。"
+        log('debug', 'chat_next_input', f"使用下一個輸入: {next_input[:50]}", session=session_id)
+        return agent.think(next_input)
     
     return response
 
 @app.route('/api/reset', methods=['POST'])
 def reset_conversation():
-    print("\n=== 重置對話 ===")
     try:
-        # 清空對話歷史文件
-        if os.path.exists(HISTORY_FILE):
-            os.remove(HISTORY_FILE)
-            print(f"已刪除歷史文件: {HISTORY_FILE}")
-        
-        # 重置 agent 的對話歷史和循環計數
-        agent.conversation_history = []
-        agent.cycle_count = 0
-        print("已重置 agent 的對話歷史和循環計數")
-        
-        # 保存空的歷史
-        agent.save_history()
-        print("已保存空的歷史")
+        # 只清除此 session 的歷史紀錄並重置循環計數
+        session = current_session()
+        with session.lock:
+            session.agent.reset_history()
+        log('info', 'chat_reset', "已重置 agent 的對話歷史和循環計數", session=session.session_id)
         
         return jsonify({"status": "success", "message": "對話已重置"})
     except Exception as e:
-        print(f"重置對話時發生錯誤: {str(e)}")
+        log('error', 'chat_reset_failed', f"重置對話時發生錯誤: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文字格式的指標：各階段延遲直方圖、每個問題的 token 數與循環數、快取命中率"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/')
 def index():
     return send_from_directory('frontend', 'index.html')
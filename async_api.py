@@ -0,0 +1,135 @@
+import os
+import json
+import uuid
+import asyncio
+import functools
+from aiohttp import web
+from agent import Agent, AgentResources
+from async_engine import AsyncAgentRunner
+from session_manager import SessionManager
+from llm_scheduler import LLMOverloaded
+from config import SESSION_MAX_COUNT, SESSION_TTL, SESSION_MAX_HISTORY_CHARS
+
+# 非同步版 API：/api/chat 在伺服器端以迴圈跑完整個分析流程，等待 LLM 時不佔用執行緒，
+# 單一程序可同時處理大量進行中的問題。與 api.py（Flask）提供相同的 session 行為，
+# 也接受前端以 isProcessing 送回未完成的回應（從該回應的動作接續）。
+
+SESSION_HEADER = 'X-Session-Id'
+SESSION_COOKIE = 'session_id'
+FRONTEND_DIR = 'frontend'
+
+resources = AgentResources()
+runner = AsyncAgentRunner()
+
+
+def create_session_agent(session_id):
+    agent = Agent(resources=resources, session_id=session_id)
+    agent.show_prompt = False
+    agent.load_history()
+    return agent
+
+
+sessions = SessionManager(
+    create_session_agent,
+    max_sessions=SESSION_MAX_COUNT,
+    ttl=SESSION_TTL,
+    max_history_chars=SESSION_MAX_HISTORY_CHARS,
+)
+
+
+async def current_session(request):
+    """依 X-Session-Id 標頭或 session_id cookie 取得 session，回傳 (session, 是否為新 id)"""
+    session_id = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    is_new = not session_id
+    if is_new:
+        session_id = uuid.uuid4().hex
+    # 建立 Agent 會讀取歷史資料庫，不在事件迴圈上執行
+    session = await asyncio.to_thread(sessions.get, session_id)
+    return session, is_new
+
+
+def json_response(data, session, is_new, status=200):
+    response = web.json_response(data, status=status, dumps=functools.partial(json.dumps, ensure_ascii=False))
+    if is_new:
+        response.set_cookie(SESSION_COOKIE, session.session_id, httponly=True, samesite='Lax')
+    return response
+
+
+async def chat(request):
+    data = await request.json()
+    user_input = data.get('message', '')
+    if not user_input:
+        return web.json_response({"error": "No message provided"}, status=400)
+
+    session, is_new = await current_session(request)
+    try:
+        async with session.async_lock:
+            if data.get('isProcessing', False):
+                # 前端送回上一個回應要求繼續：執行其中的動作後從該處接續，而不是把回應當成新問題
+                result = await runner.run(session.agent, data.get('originalQuestion', ''),
+                                          previous_response=user_input)
+            else:
+                result = await runner.run(session.agent, user_input)
+    except LLMOverloaded as e:
+        # LLM 排程器過載時立即回應 503，不讓請求繼續排隊
+        response = json_response({"error": str(e), "reason": e.reason}, session, is_new, status=503)
+        response.headers['Retry-After'] = str(max(1, round(e.retry_after)))
+        return response
+
+    return json_response({
+        "response": result["response"],
+        "content": result["content"],
+        "cycle_count": session.agent.cycle_count,
+        "cycles": result["cycles"],
+        "actions": [item["action"] for item in result["actions"]],
+        "reason": result["reason"],
+        "session_id": session.session_id,
+    }, session, is_new)
+
+
+async def reset_conversation(request):
+    session, is_new = await current_session(request)
+    try:
+        async with session.async_lock:
+            await asyncio.to_thread(session.agent.reset_history)
+        return json_response({"status": "success", "message": "對話已重置"}, session, is_new)
+    except Exception as e:
+        return json_response({"status": "error", "message": str(e)}, session, is_new, status=500)
+
+
+async def index(request):
+    return web.FileResponse(os.path.join(FRONTEND_DIR, 'index.html'))
+
+
+async def preflight(request):
+    return web.Response()
+
+
+async def shutdown_runner(app):
+    runner.shutdown()
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    response = await handler(request)
+    origin = request.headers.get('Origin')
+    if origin:
+        response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.headers['Access-Control-Allow-Headers'] = f'Content-Type, {SESSION_HEADER}'
+    return response
+
+
+def create_app():
+    app = web.Application(middlewares=[cors_middleware])
+    app.router.add_post('/api/chat', chat)
+    app.router.add_post('/api/reset', reset_conversation)
+    app.router.add_route('OPTIONS', '/api/{tail:.*}', preflight)
+    app.router.add_get('/', index)
+    app.router.add_static('/', FRONTEND_DIR)
+    app.on_cleanup.append(shutdown_runner)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=5000)
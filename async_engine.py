@@ -0,0 +1,180 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from agent import parse_decision, parse_actions, extract_content
+from config import MAX_CYCLES_PER_REQUEST, REQUEST_DEADLINE_SECONDS, ACTION_WORKERS
+
+
+class AnswerLoop:
+    """一個問題的 think → action → think 循環狀態，各種驅動方式（非同步 API、SSE 串流、批次評估）共用
+
+    呼叫端只負責取得 LLM 回應與執行動作：
+
+        actions = loop.start()
+        while True:
+            if actions:
+                loop.record_actions(actions, agent.run_actions(actions), seconds)
+            next_input = loop.next_input()
+            if next_input is None:
+                break
+            actions = loop.record_response(agent.think(next_input))
+        return loop.result()
+
+    start 可傳入上一次請求最後的回應（前端以 isProcessing 接續時），會先執行其中的動作再繼續。
+    reason 為結束原因：finish（AI 決定完成）、no_decision（回應沒有 if_finish 標籤）、
+    max_cycles（達到循環上限）或 deadline（超過時間上限）。
+    """
+
+    def __init__(self, question, max_cycles=MAX_CYCLES_PER_REQUEST, deadline=REQUEST_DEADLINE_SECONDS):
+        self.question = question
+        self.max_cycles = max_cycles
+        self.started = time.monotonic()
+        self.deadline_at = self.started + deadline
+        self.response = None
+        self.reason = None
+        self.actions = []
+        self.cycle_seconds = []
+        self.tokens = 0
+        self._pending = question
+        self._cycle_started = None
+
+    @property
+    def cycles(self):
+        return len(self.cycle_seconds)
+
+    def remaining(self):
+        return max(self.deadline_at - time.monotonic(), 0)
+
+    def continue_input(self):
+        """要繼續但沒有動作結果時的下一個輸入"""
+        return f"[ORIGINAL_QUESTION] {self.question}" if self.question else "[SYSTEM] 請繼續分析上述情況。"
+
+    def start(self, previous_response=None):
+        """回傳開始前要先執行的動作
+
+        previous_response 已經 finish 時直接結束；沒有 if_finish 標籤時視為下一個輸入
+        （前端在沒有動作時會送出 [ORIGINAL_QUESTION] 接續）。
+        """
+        if previous_response is None:
+            return []
+        decision = parse_decision(previous_response)
+        if decision is None:
+            self._pending = previous_response
+            return []
+        self.response = previous_response
+        if decision != 'continue':
+            self.reason = 'finish' if decision == 'finish' else 'no_decision'
+            return []
+        self._pending = self.continue_input()
+        return parse_actions(previous_response)
+
+    def next_input(self):
+        """回傳下一次 think 的輸入；已結束或超過時間上限時回傳 None"""
+        if self.reason is not None:
+            return None
+        if time.monotonic() >= self.deadline_at:
+            self.reason = 'deadline'
+            return None
+        self._cycle_started = time.monotonic()
+        return self._pending
+
+    def record_response(self, response, usage=None):
+        """記錄一次 LLM 回應，回傳要執行的動作；結束時回傳空列表並設定 reason"""
+        self.cycle_seconds.append(time.monotonic() - self._cycle_started)
+        self.tokens += (usage or {}).get("total_tokens", 0)
+        self.response = response
+        decision = parse_decision(response)
+        if decision != 'continue':
+            self.reason = 'finish' if decision == 'finish' else 'no_decision'
+            return []
+        if self.cycles >= self.max_cycles:
+            self.reason = 'max_cycles'
+            return []
+        # 沒有動作或無法辨識的動作但要繼續，使用原始問題
+        self._pending = self.continue_input()
+        return parse_actions(response)
+
+    def record_actions(self, actions, observation, seconds):
+        """記錄動作的結果與耗時，有結果時作為下一次 think 的輸入"""
+        self.actions.extend({"action": action, "seconds": seconds} for action in actions)
+        if observation is not None:
+            self._pending = observation
+
+    def result(self):
+        return {
+            "response": self.response,
+            "content": extract_content(self.response) if self.response else None,
+            "cycles": self.cycles,
+            "actions": self.actions,
+            "reason": self.reason,
+            "seconds": time.monotonic() - self.started,
+            "cycle_seconds": self.cycle_seconds,
+            "tokens": self.tokens,
+        }
+
+
+def run_answer(agent, question, max_cycles=MAX_CYCLES_PER_REQUEST, deadline=REQUEST_DEADLINE_SECONDS, think=None):
+    """AnswerLoop 的同步版本，在呼叫端的執行緒回答一個問題；think 預設為 agent.think
+
+    時間上限只在循環之間檢查。
+    """
+    think = think or agent.think
+    loop = AnswerLoop(question, max_cycles, deadline)
+    actions = loop.start()
+    while True:
+        if actions:
+            action_started = time.monotonic()
+            observation = agent.run_actions(actions)
+            loop.record_actions(actions, observation, time.monotonic() - action_started)
+        next_input = loop.next_input()
+        if next_input is None:
+            break
+        actions = loop.record_response(think(next_input), agent.last_usage)
+    return loop.result()
+
+
+class AsyncAgentRunner:
+    """以 AnswerLoop 驅動 think → action → think，直到 finish、達到循環上限或超過時間上限
+
+    LLM 呼叫使用非同步 client，等待時不佔用執行緒；SQL 與檔案動作在共用的執行緒池中執行。
+    同一個事件迴圈可以同時處理大量等待 LLM 的問題。
+    """
+
+    def __init__(self, max_cycles=MAX_CYCLES_PER_REQUEST, deadline=REQUEST_DEADLINE_SECONDS,
+                 executor=None, action_workers=ACTION_WORKERS):
+        self.max_cycles = max_cycles
+        self.deadline = deadline
+        self.executor = executor or ThreadPoolExecutor(max_workers=action_workers, thread_name_prefix='agent-action')
+
+    async def run(self, agent, question, previous_response=None):
+        """回答一個問題，回傳最後的回應與執行紀錄（AnswerLoop.result）
+
+        previous_response 為前端接續時送回的上一個回應，先執行其中的動作再繼續循環。
+        """
+        loop = asyncio.get_running_loop()
+        answer = AnswerLoop(question, self.max_cycles, self.deadline)
+        try:
+            actions = answer.start(previous_response)
+            while True:
+                if actions:
+                    action_started = time.monotonic()
+                    observation = await asyncio.wait_for(
+                        loop.run_in_executor(self.executor, agent.run_actions, actions), answer.remaining()
+                    )
+                    answer.record_actions(actions, observation, time.monotonic() - action_started)
+                next_input = answer.next_input()
+                if next_input is None:
+                    break
+                response = await asyncio.wait_for(agent.athink(next_input, executor=self.executor),
+                                                  answer.remaining())
+                actions = answer.record_response(response, agent.last_usage)
+        except asyncio.TimeoutError:
+            answer.reason = 'deadline'
+        return answer.result()
+
+    async def run_many(self, agents_and_questions):
+        """同時回答多個問題（每個問題使用各自的 Agent），回傳與輸入順序相同的結果列表"""
+        return await asyncio.gather(*(self.run(agent, question) for agent, question in agents_and_questions))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
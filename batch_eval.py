@@ -0,0 +1,198 @@
+"""批次評估：從 JSONL 讀取問題，以執行緒池中的多個獨立 Agent 並行回答，結果逐筆寫入 JSONL
+
+- 每個問題使用自己的 Agent（獨立的對話狀態），所有 Agent 共用 AgentResources：
+  資料庫的唯讀連線、SQL 結果快取、衍生索引與經過排程器的 LLM backend
+- 每完成一題就附加寫入一行結果（回應、循環數、動作與各自的耗時、token 數），中斷後以相同參數重新執行
+  會略過已有結果的問題；失敗的問題（error 欄位）會重新回答
+- Ctrl+C 時不再開始新的問題，等進行中的問題完成並寫入後才結束（再按一次直接結束）
+- 並行數由 --workers 控制，LLM 請求的並行與速率上限由 LLM 排程器統一管理
+
+問題檔每行為字串，或含 question 欄位（可另有 id 與其他欄位，例如 expected，會原樣保留在 meta）的物件。
+沒有 id 的問題以問題文字的雜湊作為 id，問題檔增刪或調換行之後仍能對應到既有的結果。
+
+用法：
+    python batch_eval.py questions.jsonl --output results.jsonl --workers 8
+"""
+import os
+import json
+import hashlib
+import time
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from agent import Agent, AgentResources
+from async_engine import run_answer
+from llm_scheduler import LLMOverloaded
+from config import MAX_CYCLES_PER_REQUEST, REQUEST_DEADLINE_SECONDS
+
+DEFAULT_WORKERS = 4
+
+
+def question_id(question):
+    return hashlib.sha256(question.encode('utf-8')).hexdigest()[:16]
+
+
+def load_questions(path):
+    """回傳 [{"id", "question", "meta"}, ...]；沒有 id 的問題以問題文字的雜湊作為 id"""
+    questions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            meta = {key: value for key, value in item.items() if key not in ('id', 'question')}
+            questions.append({"id": str(item.get("id") or question_id(item["question"])), "question": item["question"], "meta": meta})
+    return questions
+
+
+def load_completed(path):
+    """讀取既有的結果檔，回傳已成功完成的問題 id
+
+    最後一行可能在中斷時只寫了一半，先截斷到最後一個完整的行，之後的結果才能接著附加。
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            f.truncate(end)
+    completed = set()
+    for line in data[:end].decode('utf-8').splitlines():
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if not record.get("error"):
+            completed.add(record["id"])
+    return completed
+
+
+def think(agent, user_input, deadline_at):
+    """呼叫 agent.think；LLM 排程器過載時依建議的秒數等待後重試，直到問題的時間上限"""
+    while True:
+        try:
+            return agent.think(user_input)
+        except LLMOverloaded as e:
+            if time.monotonic() + e.retry_after > deadline_at:
+                raise
+            time.sleep(e.retry_after)
+
+
+class BatchEvaluator:
+    """以 workers 個執行緒回答問題，結果依完成順序附加寫入 output_path"""
+
+    def __init__(self, resources, output_path, workers=DEFAULT_WORKERS, max_cycles=MAX_CYCLES_PER_REQUEST,
+                 deadline=REQUEST_DEADLINE_SECONDS, session_prefix='batch'):
+        self.resources = resources
+        self.output_path = output_path
+        self.workers = workers
+        self.max_cycles = max_cycles
+        self.deadline = deadline
+        self.session_prefix = session_prefix
+        self._write_lock = threading.Lock()
+
+    def answer(self, item):
+        agent = Agent(resources=self.resources, session_id=f"{self.session_prefix}-{item['id']}")
+        agent.show_prompt = False
+        record = {"id": item["id"], "question": item["question"], "meta": item["meta"],
+                  "generation": self.resources.db.generation}
+        deadline_at = time.monotonic() + self.deadline
+        try:
+            record.update(run_answer(agent, item["question"], self.max_cycles, self.deadline,
+                                     think=lambda user_input: think(agent, user_input, deadline_at)))
+            record["error"] = None
+        except Exception as e:
+            record["error"] = f"{type(e).__name__}: {e}"
+        return record
+
+    def write(self, output, record):
+        with self._write_lock:
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            # 每筆結果立即寫入，強制結束時最多只損失進行中的問題
+            output.flush()
+
+    def report(self, record, done, total):
+        status = record["error"] or f"{record['reason']}, {record['cycles']} 個循環"
+        print(f"[{done}/{total}] {record['id']}: {status}, {record.get('seconds', 0):.1f} 秒")
+
+    def run(self, questions):
+        """回答所有尚未完成的問題，回傳本次寫入的結果列表"""
+        completed = load_completed(self.output_path)
+        pending = [item for item in questions if item["id"] not in completed]
+        print(f"共 {len(questions)} 題，已完成 {len(questions) - len(pending)} 題，本次回答 {len(pending)} 題"
+              f"（{self.workers} 個 worker）")
+        results = []
+        started = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='batch-worker')
+        try:
+            with open(self.output_path, 'a', encoding='utf-8') as output:
+                futures = [executor.submit(self.answer, item) for item in pending]
+                written = set()
+
+                def collect(futures):
+                    for future in as_completed(futures):
+                        record = future.result()
+                        self.write(output, record)
+                        written.add(future)
+                        results.append(record)
+                        self.report(record, len(results), len(pending))
+
+                try:
+                    collect(futures)
+                except KeyboardInterrupt:
+                    # 取消尚未開始的問題；進行中的問題在結果檔仍開啟時等待完成並寫入，不浪費已花費的 LLM 呼叫
+                    running = [future for future in futures if future not in written and not future.cancel()]
+                    print(f"\n已中斷，等待進行中的 {len(running)} 題完成（再按一次 Ctrl+C 直接結束）")
+                    collect(running)
+                    print(f"完成的 {len(results)} 題已寫入 {self.output_path}，以相同參數重新執行即可接續")
+                    raise
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        print(format_summary(results, time.monotonic() - started))
+        return results
+
+
+def format_summary(results, elapsed):
+    answered = [record for record in results if not record["error"]]
+    reasons = Counter(record["reason"] for record in answered)
+    lines = [
+        "=== 批次評估摘要 ===",
+        f"完成 {len(answered)} 題，失敗 {len(results) - len(answered)} 題，總耗時 {elapsed:.1f} 秒"
+        + (f"，吞吐量 {len(results) / elapsed * 60:.1f} 題/分鐘" if elapsed > 0 and results else ''),
+    ]
+    if answered:
+        seconds = sorted(record["seconds"] for record in answered)
+        lines.append(f"結束原因: {', '.join(f'{reason}={count}' for reason, count in reasons.most_common())}")
+        lines.append(f"每題耗時 p50={seconds[len(seconds) // 2]:.1f} 秒, max={seconds[-1]:.1f} 秒; "
+                     f"平均 {sum(r['cycles'] for r in answered) / len(answered):.1f} 個循環、"
+                     f"{sum(r['tokens'] for r in answered) / len(answered):.0f} tokens")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以並行的 worker 批次回答 JSONL 問題集")
+    parser.add_argument('questions', help="問題檔（JSONL）")
+    parser.add_argument('--output', default=None, help="結果檔（JSONL），預設為問題檔名加上 .results.jsonl")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="同時回答的問題數")
+    parser.add_argument('--max-cycles', type=int, default=MAX_CYCLES_PER_REQUEST, help="每題最多的循環數")
+    parser.add_argument('--deadline', type=float, default=REQUEST_DEADLINE_SECONDS, help="每題的時間上限（秒）")
+    parser.add_argument('--session-prefix', default='batch', help="對話歷史中使用的 session id 前綴")
+    args = parser.parse_args()
+
+    output = args.output or os.path.splitext(args.questions)[0] + '.results.jsonl'
+    questions = load_questions(args.questions)
+    resources = AgentResources()
+    evaluator = BatchEvaluator(resources, output, workers=args.workers, max_cycles=args.max_cycles,
+                               deadline=args.deadline, session_prefix=args.session_prefix)
+    try:
+        evaluator.run(questions)
+    except KeyboardInterrupt:
+        raise SystemExit(130)
+
+
+if __name__ == '__main__':
+    main()
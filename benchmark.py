@@ -0,0 +1,359 @@
+"""離線效能測試：以確定性的本地 LLM（replay / stub）重播問題集，量測整個 agent 循環
+
+量測項目：
+- 冷啟動（全新資料庫，含 CSV 導入與所有衍生索引）與熱啟動（manifest 未變更）時間
+- 每個循環與每個問題的延遲百分位數、SQL 動作時間、每個循環的 prompt token 數
+- 程序的峰值 RSS
+- 對 Flask app 以 N 個並行 session 提問時的吞吐量
+結果存成 JSON，方便比較不同版本。
+
+用法：
+    python benchmark.py --latency 0.2 --sessions 1,4,8
+    python benchmark.py --questions questions.jsonl --output bench_results/v2.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import contextlib
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_MARKER = 'BENCH_RESULT '
+DEFAULT_TRANSCRIPT = os.path.join(REPO_DIR, 'conversation_history.txt')
+DEFAULT_OUTPUT_DIR = os.path.join(REPO_DIR, 'bench_results')
+
+# 在子程序中量測啟動時間：匯入模組 + 建立共用資源（CSV 導入與索引）
+STARTUP_SCRIPT = f"""
+import json, time
+started = time.perf_counter()
+from agent import AgentResources
+resources = AgentResources()
+print({RESULT_MARKER!r} + json.dumps({{"seconds": time.perf_counter() - started}}))
+"""
+
+
+def percentiles(values):
+    """回傳 count / mean / p50 / p90 / p99 / max（最近排名法）"""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": rank(50),
+        "p90": rank(90),
+        "p99": rank(99),
+        "max": ordered[-1],
+    }
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # Linux 的 ru_maxrss 單位為 KiB
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def load_questions(path, limit=None):
+    """讀取問題集：.jsonl（每行字串或含 question 欄位的物件）、錄製的對話（.txt / .db）或每行一題的文字檔"""
+    from llm_backend import load_transcripts
+
+    questions = []
+    if path.endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    questions.append(item if isinstance(item, str) else item["question"])
+    elif path.endswith('.db') or os.path.basename(path) == os.path.basename(DEFAULT_TRANSCRIPT):
+        # 錄製的對話中，不是以 [ 開頭的使用者輸入就是原始問題
+        questions = [user_input for user_input, _ in load_transcripts(path) if not user_input.startswith('[')]
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+    return questions[:limit] if limit else questions
+
+
+def prepare_workspace(files_dir):
+    """建立暫存工作目錄並複製 CSV，避免動到正式的資料庫與對話歷史"""
+    workspace = tempfile.mkdtemp(prefix='agent-bench-')
+    os.makedirs(os.path.join(workspace, 'files'))
+    for name in os.listdir(files_dir):
+        if name.endswith('.csv'):
+            shutil.copy2(os.path.join(files_dir, name), os.path.join(workspace, 'files', name))
+    return workspace
+
+
+def measure_startup(workspace):
+    """在子程序中分別量測冷啟動（第一次）與熱啟動（第二次）"""
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    results = {}
+    for label in ('cold', 'warm'):
+        wall_started = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=workspace, env=env,
+                                   capture_output=True, text=True, check=True)
+        line = next(line for line in completed.stdout.splitlines() if line.startswith(RESULT_MARKER))
+        results[label] = {
+            "seconds": json.loads(line[len(RESULT_MARKER):])["seconds"],
+            "process_seconds": time.perf_counter() - wall_started,
+        }
+    results["peak_rss_mb"] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return results
+
+
+class Recorder:
+    """收集各執行緒的量測值"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cycles = []
+        self.sql = []
+        self.actions = []
+        self.questions = []
+
+    def add(self, name, value):
+        with self.lock:
+            getattr(self, name).append(value)
+
+
+def timed_agent_class(recorder):
+    """回傳一個在 think / execute_sql / run_actions 周圍計時的 Agent 子類別"""
+    from agent import Agent
+
+    class TimedAgent(Agent):
+        def think(self, user_input):
+            started = time.perf_counter()
+            response = super().think(user_input)
+            recorder.add('cycles', {
+                "cycle": self.cycle_count,
+                "seconds": time.perf_counter() - started,
+                "prompt_tokens": self.last_prompt_stats["prompt_tokens"],
+            })
+            return response
+
+        def execute_sql(self, sql, count_remaining=False):
+            started = time.perf_counter()
+            try:
+                return super().execute_sql(sql, count_remaining)
+            finally:
+                recorder.add('sql', time.perf_counter() - started)
+
+        def run_actions(self, actions):
+            started = time.perf_counter()
+            try:
+                return super().run_actions(actions)
+            finally:
+                recorder.add('actions', time.perf_counter() - started)
+
+    return TimedAgent
+
+
+def run_question(agent, question, max_cycles):
+    """與 local_only_main 相同的流程：think 後反覆以 process_ai_response 處理，直到回應不再改變"""
+    from local_only_main import process_ai_response
+
+    response = agent.think(question)
+    for _ in range(max_cycles - 1):
+        processed = process_ai_response(agent, response, question)
+        if processed == response:
+            break
+        response = processed
+    return response
+
+
+def run_agent_benchmark(resources, questions, recorder, max_cycles):
+    agent_class = timed_agent_class(recorder)
+    for number, question in enumerate(questions):
+        agent = agent_class(resources=resources, session_id=f"bench-{number}")
+        agent.show_prompt = False
+        started = time.perf_counter()
+        run_question(agent, question, max_cycles)
+        recorder.add('questions', {"seconds": time.perf_counter() - started, "cycles": agent.cycle_count})
+
+
+def run_flask_session(app, session_id, questions, max_cycles):
+    """模擬前端：送出問題後，只要回應還是 continue 就以 isProcessing 繼續呼叫 /api/chat"""
+    from agent import parse_decision
+
+    client = app.test_client()
+    headers = {'X-Session-Id': session_id}
+    latencies = []
+    for question in questions:
+        started = time.perf_counter()
+        response = client.post('/api/chat', json={"message": question}, headers=headers).get_json()["response"]
+        for _ in range(max_cycles):
+            if parse_decision(response) != 'continue':
+                break
+            response = client.post('/api/chat', json={
+                "message": response, "isProcessing": True, "originalQuestion": question,
+            }, headers=headers).get_json()["response"]
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run_flask_throughput(questions, session_counts, questions_per_session, max_cycles):
+    import api
+
+    results = []
+    for sessions in session_counts:
+        # 每個 session 依序提問，session 之間並行
+        assignments = [
+            [questions[(number + offset) % len(questions)] for offset in range(questions_per_session)]
+            for number in range(sessions)
+        ]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as pool:
+            futures = [
+                pool.submit(run_flask_session, api.app, f"bench-flask-{sessions}-{number}", assigned, max_cycles)
+                for number, assigned in enumerate(assignments)
+            ]
+            latencies = [latency for future in futures for latency in future.result()]
+        seconds = time.perf_counter() - started
+        results.append({
+            "sessions": sessions,
+            "questions": len(latencies),
+            "seconds": seconds,
+            "questions_per_second": len(latencies) / seconds if seconds else None,
+            "latency": percentiles(latencies),
+        })
+    return results
+
+
+def token_growth(cycles):
+    """依循環序號彙整 prompt token 數，觀察對話越長 prompt 成長的幅度"""
+    by_cycle = {}
+    for item in cycles:
+        by_cycle.setdefault(item["cycle"], []).append(item["prompt_tokens"])
+    return [
+        {"cycle": cycle, "count": len(values), "mean": sum(values) / len(values), "max": max(values)}
+        for cycle, values in sorted(by_cycle.items())
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="離線重播問題集並量測 agent 效能")
+    parser.add_argument('--questions', default=DEFAULT_TRANSCRIPT,
+                        help="問題集（.jsonl、錄製的對話 .txt / .db 或每行一題的文字檔）")
+    parser.add_argument('--transcript', default=DEFAULT_TRANSCRIPT, help="replay backend 使用的錄製對話")
+    parser.add_argument('--backend', choices=('replay', 'stub'), default='replay', help="本地確定性 LLM")
+    parser.add_argument('--latency', type=float, default=0.0, help="模擬每次 LLM 呼叫的延遲（秒）")
+    parser.add_argument('--limit', type=int, default=None, help="最多使用幾個問題")
+    parser.add_argument('--sessions', default='1,4,8', help="Flask 吞吐量測試的並行 session 數（逗號分隔）")
+    parser.add_argument('--questions-per-session', type=int, default=3)
+    parser.add_argument('--files-dir', default=os.path.join(REPO_DIR, 'files'))
+    parser.add_argument('--output', default=None, help="結果 JSON 路徑（預設 bench_results/bench-<時間>.json）")
+    parser.add_argument('--skip-startup', action='store_true', help="不量測冷/熱啟動")
+    parser.add_argument('--skip-flask', action='store_true', help="不量測 Flask 吞吐量")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # config 在匯入時讀取環境變數，必須在匯入任何專案模組之前設定
+    os.environ['LLM_BACKEND'] = args.backend
+    os.environ['LLM_CACHE_MODE'] = 'off'
+    os.environ['LLM_STUB_LATENCY'] = str(args.latency)
+    os.environ['LLM_REPLAY_FILE'] = os.path.abspath(args.transcript)
+    sys.path.insert(0, REPO_DIR)
+
+    questions = load_questions(os.path.abspath(args.questions), args.limit)
+    if not questions:
+        print("沒有可用的問題")
+        return 1
+    output = args.output or os.path.join(DEFAULT_OUTPUT_DIR, f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    output = os.path.abspath(output)
+    workspace = prepare_workspace(os.path.abspath(args.files_dir))
+    original_dir = os.getcwd()
+    result = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "backend": args.backend,
+            "latency": args.latency,
+            "questions": len(questions),
+        },
+    }
+    try:
+        print(f"工作目錄: {workspace}，問題數: {len(questions)}")
+        if not args.skip_startup:
+            print("量測冷/熱啟動...")
+            result["startup"] = measure_startup(workspace)
+
+        os.chdir(workspace)
+        from config import MAX_CYCLES_PER_REQUEST
+        recorder = Recorder()
+        # 程式本身以 print 記錄過程，量測期間丟棄輸出
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            from agent import AgentResources
+            resources = AgentResources()
+            print("agent 循環...", file=sys.stderr)
+            run_agent_benchmark(resources, questions, recorder, MAX_CYCLES_PER_REQUEST)
+            if not args.skip_flask:
+                session_counts = [int(value) for value in args.sessions.split(',') if value.strip()]
+                result["flask_throughput"] = run_flask_throughput(
+                    questions, session_counts, args.questions_per_session, MAX_CYCLES_PER_REQUEST)
+
+        result["cycles"] = percentiles([item["seconds"] for item in recorder.cycles])
+        result["questions"] = percentiles([item["seconds"] for item in recorder.questions])
+        result["cycles_per_question"] = percentiles([item["cycles"] for item in recorder.questions])
+        result["sql"] = percentiles(recorder.sql)
+        result["actions"] = percentiles(recorder.actions)
+        result["prompt_tokens_by_cycle"] = token_growth(recorder.cycles)
+        result["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+
+    print(format_summary(result))
+    print(f"結果已寫入 {output}")
+    return 0
+
+
+def format_summary(result):
+    def ms(stats, key):
+        return f"{stats[key] * 1000:.1f}" if stats.get("count") else '-'
+
+    lines = ["=== 效能測試結果 ==="]
+    if "startup" in result:
+        lines.append(f"冷啟動: {result['startup']['cold']['seconds']:.3f} s, "
+                     f"熱啟動: {result['startup']['warm']['seconds']:.3f} s")
+    for label, key in (("每個循環", "cycles"), ("每個問題", "questions"), ("SQL", "sql"), ("動作", "actions")):
+        stats = result[key]
+        lines.append(f"{label}: n={stats['count']} p50={ms(stats, 'p50')} ms "
+                     f"p90={ms(stats, 'p90')} ms p99={ms(stats, 'p99')} ms")
+    growth = ', '.join(f"#{item['cycle']}={item['mean']:.0f}" for item in result["prompt_tokens_by_cycle"])
+    lines.append(f"各循環平均 prompt tokens: {growth}")
+    lines.append(f"峰值 RSS: {result['peak_rss_mb']:.1f} MB")
+    for item in result.get("flask_throughput", []):
+        lines.append(f"Flask {item['sessions']} 個 session: {item['questions_per_second']:.2f} 題/秒, "
+                     f"p50={ms(item['latency'], 'p50')} ms p90={ms(item['latency'], 'p90')} ms")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
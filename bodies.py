@@ -0,0 +1,184 @@
+import zlib
+import sqlite3
+from telemetry import log
+
+# 以壓縮方式另外存放的長文字欄位（判決全文）
+BODY_COLUMN = 'judgement_content'
+# 在 SQL 中讀取判決全文的函式：judgement_body('表格名稱', rowid)
+BODY_FUNCTION = 'judgement_body'
+BODY_STORAGE_MODES = ('plain', 'compressed')
+# 壓縮與還原時每批處理的行數
+BODY_BATCH_ROWS = 256
+
+
+def body_table_name(table_name):
+    """壓縮全文表名稱，以底線開頭避免出現在給 AI 的表格清單中"""
+    return f"_bodies_{table_name}"
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def has_body_store(conn, table_name):
+    return conn.execute(
+        "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?", (body_table_name(table_name),)
+    ).fetchone() is not None
+
+
+def drop_body_store(conn, table_name):
+    conn.execute(f"DROP TABLE IF EXISTS main.{_quote(body_table_name(table_name))}")
+
+
+def _stored_columns(conn, table_name):
+    """實際存在於 main 表格中的欄位"""
+    return [row[1] for row in conn.execute(f"PRAGMA main.table_info({_quote(table_name)})")]
+
+
+def is_compressed(conn, table_name):
+    """表格的判決全文是否以壓縮方式存放（原表沒有全文欄位且有壓縮表）"""
+    return BODY_COLUMN not in _stored_columns(conn, table_name) and has_body_store(conn, table_name)
+
+
+def body_tables(conn):
+    """回傳全文以壓縮方式存放的原始表格名稱"""
+    prefix = body_table_name('')
+    rows = conn.execute(
+        "SELECT name FROM main.sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\' ORDER BY name",
+        (prefix.replace('_', '\\_') + '%',),
+    )
+    return [name[len(prefix):] for (name,) in rows]
+
+
+def compress_text(text, level=6):
+    """回傳 (壓縮後的 blob, 原文 UTF-8 位元組數, CRC32)"""
+    data = text.encode('utf-8')
+    return zlib.compress(data, level), len(data), zlib.crc32(data)
+
+
+def decompress_body(blob, length, checksum):
+    """解壓縮並檢查長度與 CRC32，回傳 UTF-8 位元組；資料損毀時丟出 ValueError"""
+    data = zlib.decompress(blob)
+    if len(data) != length or zlib.crc32(data) != checksum:
+        raise ValueError("判決全文的長度或檢查碼不符，資料可能已損毀")
+    return data
+
+
+def read_body_bytes(conn, table_name, rowid):
+    """只讀取並解壓縮一份判決全文，回傳 UTF-8 位元組；該行沒有全文時回傳 None"""
+    row = conn.execute(
+        f"SELECT length, checksum, body FROM main.{_quote(body_table_name(table_name))} WHERE source_rowid = ?",
+        (rowid,),
+    ).fetchone()
+    if row is None or row[2] is None:
+        return None
+    return decompress_body(row[2], row[0], row[1])
+
+
+def read_body(conn, table_name, rowid):
+    data = read_body_bytes(conn, table_name, rowid)
+    return data.decode('utf-8') if data is not None else None
+
+
+def register_body_function(conn):
+    """在連線上註冊 judgement_body(表格, rowid)，讓 SQL 只在真正輸出的行才解壓縮全文"""
+    conn.create_function(BODY_FUNCTION, 2, lambda table_name, rowid: read_body(conn, table_name, rowid),
+                         deterministic=True)
+
+
+def text_expression(conn, table_name, column, alias=None):
+    """讀取某個文字欄位的 SQL 運算式：全文已壓縮時改為呼叫 judgement_body"""
+    prefix = f"{alias}." if alias else ''
+    if column == BODY_COLUMN and is_compressed(conn, table_name):
+        literal = table_name.replace("'", "''")
+        return f"{BODY_FUNCTION}('{literal}', {prefix}rowid)"
+    return prefix + _quote(column)
+
+
+def store_bodies(conn, table_name, level=6):
+    """將表格的判決全文壓縮後搬到另一個表格，並從原表刪除該欄位
+
+    壓縮表以 source_rowid 為主鍵，另存原文長度與 CRC32；原表只剩下中繼資料欄位，
+    掃描中繼資料時不會讀到全文所在的頁面。
+    """
+    bodies = _quote(body_table_name(table_name))
+    conn.execute(f"DROP TABLE IF EXISTS {bodies}")
+    conn.execute(f"""
+        CREATE TABLE {bodies} (
+            source_rowid INTEGER PRIMARY KEY,
+            length INTEGER NOT NULL,
+            checksum INTEGER NOT NULL,
+            body BLOB
+        )
+    """)
+    cursor = conn.execute(f"SELECT rowid, {_quote(BODY_COLUMN)} FROM main.{_quote(table_name)} ORDER BY rowid")
+    while batch := cursor.fetchmany(BODY_BATCH_ROWS):
+        rows = []
+        for rowid, text in batch:
+            if text is None:
+                rows.append((rowid, 0, 0, None))
+            else:
+                blob, length, checksum = compress_text(str(text), level)
+                rows.append((rowid, length, checksum, blob))
+        conn.executemany(f"INSERT INTO {bodies} VALUES (?, ?, ?, ?)", rows)
+    conn.execute(f"ALTER TABLE main.{_quote(table_name)} DROP COLUMN {_quote(BODY_COLUMN)}")
+
+
+def restore_bodies(conn, table_name):
+    """將壓縮的全文還原成原表的一般欄位（plain 模式），並刪除壓縮表"""
+    table = _quote(table_name)
+    conn.execute(f"ALTER TABLE main.{table} ADD COLUMN {_quote(BODY_COLUMN)} TEXT")
+    rowids = [rowid for (rowid,) in conn.execute(f"SELECT rowid FROM main.{table} ORDER BY rowid")]
+    # 一次只解壓縮一批，記憶體用量只和批次大小有關
+    for start in range(0, len(rowids), BODY_BATCH_ROWS):
+        conn.executemany(
+            f"UPDATE main.{table} SET {_quote(BODY_COLUMN)} = ? WHERE rowid = ?",
+            [(read_body(conn, table_name, rowid), rowid) for rowid in rowids[start:start + BODY_BATCH_ROWS]],
+        )
+    conn.execute(f"DROP TABLE main.{_quote(body_table_name(table_name))}")
+
+
+def apply_body_storage(conn, table_name, columns, mode, level=6):
+    """依儲存模式壓縮或還原表格的判決全文，回傳是否有變更（有變更時衍生索引必須重建）"""
+    if mode not in BODY_STORAGE_MODES:
+        raise ValueError(f"未知的全文儲存模式: {mode}")
+    if BODY_COLUMN not in columns:
+        return False
+    in_table = BODY_COLUMN in _stored_columns(conn, table_name)
+    if mode == 'compressed' and in_table:
+        # 剛重新導入的表格也會走到這裡，舊的壓縮表在 store_bodies 中重建
+        store_bodies(conn, table_name, level)
+        return True
+    if mode == 'plain' and not in_table and has_body_store(conn, table_name):
+        restore_bodies(conn, table_name)
+        return True
+    if mode == 'plain':
+        # 重新導入前留下的壓縮表已經過期
+        drop_body_store(conn, table_name)
+    return False
+
+
+def create_body_views(conn):
+    """在查詢用連線上以 TEMP VIEW 遮蔽全文已壓縮的表格，讓 AI 的 SQL 仍能讀到 judgement_content
+
+    TEMP 物件優先於 main 中的同名表格；view 的全文欄位以 judgement_body 計算，
+    只有 WHERE 篩選後真正輸出的行才會解壓縮。內部程式一律以 main.表格 讀取實際的表格。
+    """
+    query_only = conn.execute("PRAGMA query_only").fetchone()[0]
+    conn.execute("PRAGMA query_only = 0")
+    try:
+        for (name,) in conn.execute("SELECT name FROM temp.sqlite_master WHERE type = 'view'").fetchall():
+            conn.execute(f"DROP VIEW temp.{_quote(name)}")
+        for table_name in body_tables(conn):
+            columns = _stored_columns(conn, table_name)
+            if BODY_COLUMN in columns:
+                continue
+            select = ', '.join([_quote(col) for col in columns] +
+                               [f"{text_expression(conn, table_name, BODY_COLUMN)} AS {_quote(BODY_COLUMN)}"])
+            conn.execute(f"CREATE TEMP VIEW {_quote(table_name)} AS SELECT {select} FROM main.{_quote(table_name)}")
+    except sqlite3.Error as e:
+        # 少了 view 的連線查詢 judgement_content 會得到難以理解的錯誤，不能交給呼叫端繼續使用
+        log('error', 'body_views_failed', f"建立判決全文 view 時發生錯誤: {e}")
+        raise
+    finally:
+        conn.execute(f"PRAGMA query_only = {int(query_only)}")
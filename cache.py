@@ -0,0 +1,102 @@
+import re
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+# SQL 中的字串常值、引號識別字、空白與其他片段
+_SQL_TOKEN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\]|\s+|[^'\"`\[\s]+|.", re.DOTALL)
+
+
+def normalize_sql(sql):
+    """正規化 SQL 作為快取鍵：去除大括號與結尾分號、合併空白、字串常值以外轉小寫
+
+    字串常值（例如 case_id）保持原樣，避免大小寫不同的查詢共用結果。
+    """
+    sql = sql.replace('{', '').replace('}', '').strip().rstrip(';').strip()
+    parts = []
+    for token in _SQL_TOKEN.findall(sql):
+        if token.isspace():
+            parts.append(' ')
+        elif token[0] in ("'", '"', '`', '['):
+            parts.append(token)
+        else:
+            parts.append(token.lower())
+    return ''.join(parts)
+
+
+class LRUCache:
+    """執行緒安全的 LRU 快取，支援筆數上限、總大小上限與 TTL 到期
+
+    大小以 sys.getsizeof 或 len() 估算（字串結果以字元數計）。
+    """
+
+    def __init__(self, max_entries=512, max_size=8 * 1024 * 1024, ttl=600):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _sizeof(value):
+        return len(value) if isinstance(value, str) else sys.getsizeof(value)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, size, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self.size -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        if size > self.max_size:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._data[key] = (value, size, expires_at)
+            self.size += size
+            while len(self._data) > self.max_entries or self.size > self.max_size:
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -4,6 +4,84 @@ from dotenv import load_dotenv
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # 未設定時使用官方 API；可指向本地的 fake_openai_server.py
 MODEL_NAME = "gpt-4o-mini"
-HISTORY_FILE = "conversation_history.txt"
+HISTORY_FILE = "conversation_history.txt"  # 舊版對話紀錄，僅供 replay backend 回放
+HISTORY_DB = "conversation_history.db"  # 對話歷史資料庫
+HISTORY_LOAD_LIMIT = 50  # load_history 最多載入的對話筆數
+DEFAULT_SESSION_ID = "default"
 FILES_DIR = "files"
+
+# CSV 導入時每次讀取的行數，控制導入大型判決檔時的記憶體用量
+INGEST_CHUNK_SIZE = 5000
+
+# 判決全文的儲存方式：plain（一般欄位）或 compressed（zlib 壓縮另存，只在讀取特定案件時解壓縮）
+# compressed 需另外選用：切換時會移除原表的 judgement_content 欄位並 VACUUM，
+# 之後只有經過 ConnectionManager 的連線（TEMP VIEW）看得到完整欄位，直接開啟 data.db 的工具讀不到全文
+BODY_STORAGE = os.getenv("BODY_STORAGE", "plain")
+BODY_COMPRESSION_LEVEL = 6
+
+# 查詢用唯讀連線的 SQLite 調校參數
+DB_MMAP_SIZE = 256 * 1024 * 1024  # 記憶體映射讀取的上限（位元組）
+DB_CACHE_SIZE_KIB = 64 * 1024  # 每條連線的頁面快取大小（KiB）
+DB_CACHED_STATEMENTS = 256  # 每條連線保留的預編譯語句數量
+
+# SQL 動作結果快取
+SQL_CACHE_MAX_ENTRIES = 512  # 最多保留的查詢數
+SQL_CACHE_MAX_SIZE = 8 * 1024 * 1024  # 快取結果總字元數上限
+SQL_CACHE_TTL = 600  # 每筆結果保留秒數
+
+# AI 產生的 SQL 的執行限制
+SQL_MAX_INSTRUCTIONS = 50_000_000  # 每個查詢的 SQLite VM 指令預算
+SQL_TIMEOUT_SECONDS = 5  # 每個查詢的時間上限（秒）
+# 行數或原始 CSV 大小超過任一上限的表格視為大型表格，不允許全表掃描
+SQL_SCAN_MAX_ROWS = 100_000
+SQL_SCAN_MAX_BYTES = 1024 * 1024
+
+# LLM backend：openai（預設）、replay（以錄製的對話回答）、stub（本地模擬，不連網）
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+# LLM 回應磁碟快取：off、record（只記錄）、serve（有快取就直接回傳）
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "off")
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+LLM_REPLAY_FILE = os.getenv("LLM_REPLAY_FILE", HISTORY_FILE)
+LLM_STUB_LATENCY = float(os.getenv("LLM_STUB_LATENCY", "0"))  # 模擬 API 延遲（秒）
+LLM_TEMPERATURE = 0.7
+
+# 整個程序共用的 LLM 請求排程（並行上限、速率限制、重試與等待佇列）
+LLM_SCHEDULER = os.getenv("LLM_SCHEDULER", "on") == "on"
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # 全域同時進行的請求數
+LLM_MAX_PER_SESSION = 2  # 每個 session 同時進行的請求數
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "64"))  # 等待名額的請求數上限，超過時直接回應 503
+LLM_QUEUE_TIMEOUT = 30  # 等待名額與速率限制的時間上限（秒），超過時回應 503
+# 每分鐘請求數與 token 數上限，0 為不限制
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_COMPLETION_TOKEN_RESERVE = 1000  # 速率限制預留給每個回應的 token 數，回應後依實際用量修正
+LLM_MAX_RETRIES = 4  # 429、5xx 與連線錯誤的重試次數
+LLM_RETRY_BASE_DELAY = 0.5  # 指數退避的基準秒數
+LLM_RETRY_MAX_DELAY = 20  # 單次退避的上限秒數
+
+# 每次送給 LLM 的上下文控制
+CONTEXT_TOKEN_BUDGET = 12000  # 每次請求的 prompt token 上限（估計值）
+CONTEXT_KEEP_RECENT = 4  # 保留原文的最近對話組數
+CONTEXT_SUMMARY_CHARS = 200  # 較早的動作結果與回應壓縮後保留的字數
+
+# API 伺服器的 session 管理
+SESSION_MAX_COUNT = 1000  # 同時保留在記憶體中的 session 上限
+SESSION_TTL = 1800  # 閒置多少秒後回收 session
+SESSION_MAX_HISTORY_CHARS = 50_000_000  # 所有 session 對話歷史總字數上限
+
+# 每個問題的執行上限
+MAX_CYCLES_PER_REQUEST = 10  # 單一問題最多的 think 循環數
+REQUEST_DEADLINE_SECONDS = 180  # 單一問題的總時間上限（秒）
+ACTION_WORKERS = 8  # 執行 SQL / 檔案動作的執行緒數
+
+# 單次回應中的多個動作
+MAX_ACTIONS_PER_TURN = 4  # 每次回應最多執行的動作數，超過的部分略過
+ACTION_OBSERVATION_BUDGET = 12000  # 合併後動作結果的總字數上限，依動作數平分給每個動作
+
+# 紀錄與除錯輸出
+LOG_LEVEL = os.getenv("AGENT_LOG_LEVEL", "info").lower()  # debug / info / warning / error
+LOG_FORMAT = os.getenv("AGENT_LOG_FORMAT", "text")  # text 或 json（每行一個 JSON 物件）
+# 完整 prompt 的除錯輸出：空字串為關閉，stdout 或檔案路徑（附加寫入）
+PROMPT_DUMP = os.getenv("AGENT_PROMPT_DUMP", "")
@@ -0,0 +1,107 @@
+import re
+from llm_backend import estimate_tokens
+
+# 動作結果訊息的開頭，例如 "[SYSTEM] SQL 查詢結果如下:"
+_TOOL_RESULT = re.compile(r'^\[SYSTEM\][^\n]*')
+_TAG = re.compile(r'<(think|action|if_finish|content)>(.*?)</\1>', re.DOTALL)
+
+
+def summarize_tool_result(text, max_chars=200):
+    """將較舊的動作結果壓縮成簡短摘要：保留標題與前幾行，其餘以省略說明取代"""
+    if len(text) <= max_chars:
+        return text
+    header = _TOOL_RESULT.match(text).group(0)
+    body = ' '.join(text[len(header):].split())
+    return f"{header} (舊結果摘要) {body[:max_chars]}… (已省略 {len(text) - max_chars} 字元，需要時請重新查詢)"
+
+
+def summarize_assistant(text, max_chars=200):
+    """較舊的 AI 回應只保留 think / 所有 action / if_finish，content 截短"""
+    if len(text) <= max_chars:
+        return text
+    matches = _TAG.findall(text)
+    if not matches:
+        return text[:max_chars] + '…'
+    tags = dict((name, value.strip()) for name, value in matches)
+    parts = []
+    if 'think' in tags:
+        parts.append(f"<think>{tags['think']}</think>")
+    # 一次回應可能有多個動作，全部保留
+    parts.extend(f"<action>{value.strip()}</action>" for name, value in matches if name == 'action')
+    if 'if_finish' in tags:
+        parts.append(f"<if_finish>{tags['if_finish']}</if_finish>")
+    if tags.get('content'):
+        content = tags['content']
+        if len(content) > max_chars:
+            content = content[:max_chars] + '…'
+        parts.append(f"<content>{content}</content>")
+    return "\n".join(parts)
+
+
+class ContextWindow:
+    """在 token 預算內組出送給 LLM 的訊息列表
+
+    - 最近 keep_recent 組對話原文保留
+    - 更早的動作結果（[SYSTEM] 訊息）與 AI 回應壓縮成摘要，使用者問題保留原文
+    - 仍超過 token_budget 時，先從最舊的摘要開始捨棄，再壓縮最近的對話，最後才捨棄最近的對話
+    """
+
+    def __init__(self, token_budget=12000, keep_recent=4, summary_chars=200):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.summary_chars = summary_chars
+
+    def _compress(self, exchange):
+        user = exchange["user"]
+        if user.startswith('[SYSTEM]'):
+            user = summarize_tool_result(user, self.summary_chars)
+        return {
+            "user": user,
+            "assistant": summarize_assistant(exchange["assistant"], self.summary_chars),
+        }
+
+    @staticmethod
+    def _tokens(exchange):
+        return estimate_tokens(exchange["user"]) + estimate_tokens(exchange["assistant"])
+
+    def build(self, system_prompt, history, user_input):
+        """回傳 (messages, stats)，stats 記錄估計的 prompt token 數與保留/摘要/捨棄的對話數"""
+        split = max(len(history) - self.keep_recent, 0)
+        kept = [self._compress(exchange) for exchange in history[:split]] + list(history[split:])
+        summarized = [True] * split + [False] * (len(history) - split)
+        costs = [self._tokens(exchange) for exchange in kept]
+        fixed = estimate_tokens(system_prompt) + estimate_tokens(user_input)
+
+        def over_budget():
+            return fixed + sum(costs) > self.token_budget
+
+        # 1. 先從最舊的開始捨棄已摘要的較早對話
+        dropped = 0
+        while over_budget() and dropped < split:
+            del kept[0], costs[0], summarized[0]
+            dropped += 1
+        # 2. 仍超過預算時，由舊到新壓縮最近的對話
+        for index in range(len(kept)):
+            if not over_budget():
+                break
+            kept[index] = self._compress(kept[index])
+            costs[index] = self._tokens(kept[index])
+            summarized[index] = True
+        # 3. 全部壓縮後仍超過預算，繼續捨棄最舊的對話
+        while over_budget() and kept:
+            del kept[0], costs[0], summarized[0]
+            dropped += 1
+
+        messages = [{"role": "system", "content": system_prompt}]
+        for exchange in kept:
+            messages.append({"role": "user", "content": exchange["user"]})
+            messages.append({"role": "assistant", "content": exchange["assistant"]})
+        messages.append({"role": "user", "content": user_input})
+
+        stats = {
+            "prompt_tokens": fixed + sum(costs),
+            "verbatim": summarized.count(False),
+            "summarized": summarized.count(True),
+            "dropped": dropped,
+        }
+        return messages, stats
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import weakref
+import threading
+from urllib.request import pathname2url
+from bodies import register_body_function, create_body_views
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+class _ThreadConnection:
+    """一個執行緒的連線；只由該執行緒的 thread-local 持有，執行緒結束後被回收時關閉連線"""
+
+    __slots__ = ('conn', 'views_generation', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.views_generation = None
+
+
+class ConnectionManager:
+    """管理 data.db 的唯讀連線：每個執行緒保留一條長期連線，並快取表格結構
+
+    執行緒結束時其連線會自動關閉並從清單移除（Flask 每個請求可能在不同的執行緒上處理），
+    連線數不會隨處理過的執行緒數增加。
+
+    全文以壓縮方式存放的表格，在每條連線上以同名的 TEMP VIEW 呈現完整欄位（見 bodies.create_body_views）。
+
+    連線以 URI mode=ro 開啟，查詢永遠無法修改資料；WAL 模式由導入流程（唯一的寫入者）設定，
+    讓讀取與導入可以同時進行。
+    """
+
+    def __init__(self, db_path, mmap_size=256 * 1024 * 1024, cache_size_kib=64 * 1024, cached_statements=256):
+        self.db_path = os.path.abspath(db_path)
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._schema = None
+        self._schema_generation = None
+        self._table_sizes = None
+        self._table_sizes_generation = None
+        self.generation = None
+
+    def _open(self):
+        uri = f"file:{pathname2url(self.db_path)}?mode=ro"
+        # check_same_thread=False 只是為了讓 close() 能從其他執行緒關閉連線，實際使用時每條連線只屬於一個執行緒
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=self.cached_statements)
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kib)}")
+        conn.execute("PRAGMA query_only = 1")
+        register_body_function(conn)
+        holder = _ThreadConnection(conn)
+        with self._lock:
+            self._connections.add(conn)
+        weakref.finalize(holder, self._discard, conn)
+        return holder
+
+    def _discard(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+        conn.close()
+
+    def connection_count(self):
+        with self._lock:
+            return len(self._connections)
+
+    def connection(self):
+        """取得目前執行緒的唯讀連線，第一次使用時才建立"""
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = self._open()
+            self._local.holder = holder
+        # 全文壓縮存放的表格以 TEMP VIEW 呈現，資料庫世代變更後重新建立
+        if holder.views_generation != self.generation:
+            # 建立失敗時丟出例外，下次取得連線時重試
+            create_body_views(holder.conn)
+            holder.views_generation = self.generation
+        return holder.conn
+
+    def refresh_generation(self):
+        """重新讀取資料庫世代編號（導入流程每次變更表格都會遞增 PRAGMA user_version）"""
+        self.generation = self.connection().execute("PRAGMA user_version").fetchone()[0]
+        return self.generation
+
+    def schema(self):
+        """回傳 {表格名稱: [欄位, ...]}，同一世代內只查詢一次"""
+        if self.generation is None:
+            self.refresh_generation()
+        with self._lock:
+            if self._schema is not None and self._schema_generation == self.generation:
+                return self._schema
+        conn = self.connection()
+        tables = {}
+        names = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY name"
+        ).fetchall()
+        for (table_name,) in names:
+            # 底線開頭的是內部表格，如導入 manifest 與全文索引
+            if table_name.startswith('_'):
+                continue
+            columns = conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()
+            tables[table_name] = [col[1] for col in columns]
+        with self._lock:
+            self._schema = tables
+            self._schema_generation = self.generation
+        return tables
+
+    def table_sizes(self):
+        """回傳 {表格名稱: (行數, CSV 位元組數)}，取自導入 manifest，同一世代內只查詢一次"""
+        if self.generation is None:
+            self.refresh_generation()
+        with self._lock:
+            if self._table_sizes is not None and self._table_sizes_generation == self.generation:
+                return self._table_sizes
+        try:
+            rows = self.connection().execute("SELECT table_name, row_count, size FROM _ingest_manifest").fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        sizes = {table_name: (row_count, size) for table_name, row_count, size in rows}
+        with self._lock:
+            self._table_sizes = sizes
+            self._table_sizes_generation = self.generation
+        return sizes
+
+    def describe_schema(self):
+        """表格與欄位的文字說明，用於 SQL 錯誤時提示 AI"""
+        return "\n".join(f"- {table_name}: " + ', '.join(columns) for table_name, columns in self.schema().items())
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+def get_connection_manager(db_path, **kwargs):
+    """同一個資料庫檔案在整個程序內共用一個 ConnectionManager"""
+    key = os.path.abspath(db_path)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = ConnectionManager(db_path, **kwargs)
+            _managers[key] = manager
+    return manager
@@ -0,0 +1,177 @@
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from llm_backend import StubBackend, STREAM_CHUNK_CHARS
+
+# 本地的模擬 OpenAI Chat Completions 伺服器，用來測試 LLM 排程器的並行上限、重試與過載行為：
+#   python fake_openai_server.py --latency 0.5 --rpm 120 --error-rate 0.1
+#   OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=fake LLM_BACKEND=openai python api.py
+# 回應內容與 stub backend 相同；GET /stats 回傳請求數、錯誤數與觀察到的最大並行數。
+
+
+class FakeOpenAIState:
+    def __init__(self, latency=0.0, rpm=None, max_concurrency=None, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1.0, seed=None):
+        self.latency = latency
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.stub = StubBackend()
+        self.recent = deque()
+        self.in_flight = 0
+        self.stats = {"requests": 0, "completed": 0, "rate_limited": 0, "errors": 0, "peak_concurrency": 0}
+        self.lock = threading.Lock()
+
+    def admit(self):
+        """回傳 None 表示接受請求，否則回傳 (狀態碼, 錯誤類型, 訊息)"""
+        now = time.monotonic()
+        with self.lock:
+            self.stats["requests"] += 1
+            while self.recent and now - self.recent[0] > 60:
+                self.recent.popleft()
+            if self.rpm and len(self.recent) >= self.rpm:
+                self.stats["rate_limited"] += 1
+                return 429, 'requests', f"Rate limit reached: {self.rpm} requests per minute"
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                self.stats["rate_limited"] += 1
+                return 429, 'requests', f"Too many concurrent requests (limit {self.max_concurrency})"
+            if self.random.random() < self.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+                return 429, 'requests', "Simulated rate limit"
+            if self.random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return 500, 'server_error', "Simulated server error"
+            self.recent.append(now)
+            self.in_flight += 1
+            self.stats["peak_concurrency"] = max(self.stats["peak_concurrency"], self.in_flight)
+            return None
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.stats["completed"] += 1
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/').endswith('/stats'):
+                with state.lock:
+                    self._send_json(200, dict(state.stats, in_flight=state.in_flight))
+            else:
+                self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send_json(404, {"error": {"message": "Not found", "type": "invalid_request_error"}})
+                return
+            rejected = state.admit()
+            if rejected:
+                status, kind, message = rejected
+                self._send_json(status, {"error": {"message": message, "type": kind, "code": None}},
+                                {'retry-after': str(state.retry_after)} if status == 429 else None)
+                return
+            try:
+                if state.latency:
+                    time.sleep(state.latency)
+                result = state.stub._respond(request.get("messages", []))
+                if request.get("stream"):
+                    self._stream(request, result)
+                else:
+                    self._send_json(200, self._completion(request, result))
+            finally:
+                state.done()
+
+        def _completion(self, request, result):
+            return {
+                "id": f"chatcmpl-fake-{int(time.time() * 1000)}",
+                "object": 'chat.completion',
+                "created": int(time.time()),
+                "model": request.get("model", 'fake'),
+                "choices": [{"index": 0, "message": {"role": 'assistant', "content": result["content"]},
+                             "finish_reason": 'stop'}],
+                "usage": result["usage"],
+            }
+
+        def _stream(self, request, result):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            content = result["content"]
+            for start in range(0, len(content), STREAM_CHUNK_CHARS):
+                chunk = {
+                    "id": 'chatcmpl-fake', "object": 'chat.completion.chunk', "created": int(time.time()),
+                    "model": request.get("model", 'fake'),
+                    "choices": [{"index": 0, "delta": {"content": content[start:start + STREAM_CHUNK_CHARS]},
+                                 "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+    return Handler
+
+
+def start_server(host='127.0.0.1', port=8900, **options):
+    """在背景執行緒啟動模擬伺服器，回傳 (server, state)；port 為 0 時自動選擇可用的埠"""
+    state = FakeOpenAIState(**options)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地的模擬 OpenAI Chat Completions 伺服器")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.0, help="每個回應的延遲（秒）")
+    parser.add_argument('--rpm', type=int, default=None, help="每分鐘請求數上限，超過時回應 429")
+    parser.add_argument('--max-concurrency', type=int, default=None, help="同時處理的請求數上限，超過時回應 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="隨機回應 500 的比例")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="隨機回應 429 的比例")
+    parser.add_argument('--retry-after', type=float, default=1.0, help="429 回應的 retry-after 秒數")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    state = FakeOpenAIState(latency=args.latency, rpm=args.rpm, max_concurrency=args.max_concurrency,
+                            error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                            retry_after=args.retry_after, seed=args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    print(f"模擬 OpenAI 伺服器: http://{args.host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,30 @@ const renderMarkdown = (text) => {
     return <div>{text}</div>;
 };
 
+// 每個瀏覽器的 session id 存在 localStorage，重新整理頁面後仍接續同一段對話
+const SESSION_STORAGE_KEY = 'sessionId';
+
+const getSessionId = () => {
+    let sessionId = localStorage.getItem(SESSION_STORAGE_KEY);
+    if (!sessionId) {
+        sessionId = Array.from(crypto.getRandomValues(new Uint8Array(16)),
+            (byte) => byte.toString(16).padStart(2, '0')).join('');
+        localStorage.setItem(SESSION_STORAGE_KEY, sessionId);
+    }
+    return sessionId;
+};
+
+// 所有 API 請求都帶上 X-Session-Id 標頭與 cookie，讓後端把同一個使用者的請求對應到同一個 session
+const postApi = (path, body) => fetch(`http://localhost:5000${path}`, {
+    method: 'POST',
+    credentials: 'include',
+    headers: {
+        'Content-Type': 'application/json',
+        'X-Session-Id': getSessionId(),
+    },
+    body: body === undefined ? undefined : JSON.stringify(body),
+});
+
 function SimpleApp() {
     const [messages, setMessages] = useState([]);
     const [input, setInput] = useState('');
@@ -71,30 +95,20 @@ function SimpleApp() {
                     
                     if (actionMatch) {
                         // 繼續處理
-                        const response = await fetch('http://localhost:5000/api/chat', {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json',
-                            },
-                            body: JSON.stringify({ 
-                                message: processedResponse,
-                                isProcessing: true
-                            }),
+                        const response = await postApi('/api/chat', {
+                            message: processedResponse,
+                            isProcessing: true,
+                            originalQuestion: userMessage
                         });
                         
                         const data = await response.json();
                         processedResponse = data.response;
                     } else {
                         // 沒有動作但需要繼續
-                        const response = await fetch('http://localhost:5000/api/chat', {
-                            method: 'POST',
-                            headers: {
-                                'Content-Type': 'application/json',
-                            },
-                            body: JSON.stringify({ 
-                                message: `[ORIGINAL_QUESTION] ${userMessage}`,
-                                isProcessing: true
-                            }),
+                        const response = await postApi('/api/chat', {
+                            message: `[ORIGINAL_QUESTION] ${userMessage}`,
+                            isProcessing: true,
+                            originalQuestion: userMessage
                         });
                         
                         const data = await response.json();
@@ -148,13 +162,7 @@ function SimpleApp() {
     
     // 獲取聊天回應
     const fetchChatResponse = async (message) => {
-        const response = await fetch('http://localhost:5000/api/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({ message }),
-        });
+        const response = await postApi('/api/chat', { message });
         
         const data = await response.json();
         return data.response;
@@ -163,12 +171,7 @@ function SimpleApp() {
     // Reset conversation
     const handleReset = async () => {
         try {
-            const response = await fetch('http://localhost:5000/api/reset', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-            });
+            const response = await postApi('/api/reset');
             
             const data = await response.json();
             if (data.status === 'success') {
@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from datetime import datetime
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class HistoryStore:
+    """以 SQLite 保存對話歷史，取代不斷變大的 conversation_history.txt
+
+    - 每個循環只新增一筆 entries 紀錄，不重寫舊資料
+    - 系統提示與完整上下文中的每則訊息以 SHA-256 去重後存在 blobs，entries 只記錄雜湊
+    - entries 依 (session_id, id) 與 timestamp 建立索引，載入時只讀最後幾筆
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                content TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                cycle_count INTEGER NOT NULL,
+                system_prompt_hash TEXT,
+                conversation TEXT,
+                context TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_session ON entries (session_id, id);
+            CREATE INDEX IF NOT EXISTS idx_entries_timestamp ON entries (timestamp);
+        """)
+        self._conn.commit()
+
+    def _put_blob(self, text):
+        key = content_hash(text)
+        self._conn.execute("INSERT OR IGNORE INTO blobs (hash, content) VALUES (?, ?)", (key, text))
+        return key
+
+    def append(self, session_id, cycle_count, conversation, system_prompt=None, messages=None):
+        """新增一個循環的紀錄；messages 為送給 LLM 的完整訊息列表（只保存雜湊參照）"""
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            prompt_hash = self._put_blob(system_prompt) if system_prompt is not None else None
+            context = None
+            if messages is not None:
+                context = json.dumps([[message["role"], self._put_blob(message["content"])] for message in messages])
+            self._conn.execute(
+                "INSERT INTO entries (session_id, timestamp, cycle_count, system_prompt_hash, conversation, context) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, timestamp, cycle_count, prompt_hash, conversation, context)
+            )
+            self._conn.commit()
+
+    def tail(self, session_id, limit):
+        """回傳該 session 最後 limit 筆對話（由舊到新），只讀取需要的紀錄"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT conversation FROM entries WHERE session_id = ? AND conversation IS NOT NULL "
+                "ORDER BY id DESC LIMIT ?",
+                (session_id, int(limit))
+            ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def conversations(self, session_id=None, since=None):
+        """依時間順序列出對話紀錄，可依 session 與起始時間篩選"""
+        sql = "SELECT session_id, timestamp, cycle_count, conversation FROM entries WHERE conversation IS NOT NULL"
+        params = []
+        if session_id is not None:
+            sql += " AND session_id = ?"
+            params.append(session_id)
+        if since is not None:
+            sql += " AND timestamp >= ?"
+            params.append(since)
+        sql += " ORDER BY id"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [
+            {"session_id": sid, "timestamp": ts, "cycle_count": cycle, "conversation": conversation}
+            for sid, ts, cycle, conversation in rows
+        ]
+
+    def full_context(self, entry_id):
+        """還原某筆紀錄送給 LLM 的完整訊息列表"""
+        with self._lock:
+            row = self._conn.execute("SELECT context FROM entries WHERE id = ?", (entry_id,)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            messages = []
+            for role, key in json.loads(row[0]):
+                content = self._conn.execute("SELECT content FROM blobs WHERE hash = ?", (key,)).fetchone()
+                messages.append({"role": role, "content": content[0] if content else ''})
+        return messages
+
+    def count(self, session_id):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries WHERE session_id = ?", (session_id,)).fetchone()[0]
+
+    def reset(self, session_id):
+        """清除單一 session 的紀錄（索引刪除，不需重寫其他 session 的資料），並刪除不再被引用的 blobs"""
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+        self.prune_blobs()
+
+    def prune_blobs(self):
+        """刪除已沒有任何紀錄引用的 blobs，回傳刪除的筆數；reset 清除 session 後會呼叫"""
+        with self._lock:
+            referenced = set()
+            for prompt_hash, context in self._conn.execute("SELECT system_prompt_hash, context FROM entries"):
+                if prompt_hash:
+                    referenced.add(prompt_hash)
+                if context:
+                    referenced.update(key for _, key in json.loads(context))
+            orphaned = [key for (key,) in self._conn.execute("SELECT hash FROM blobs") if key not in referenced]
+            self._conn.executemany("DELETE FROM blobs WHERE hash = ?", [(key,) for key in orphaned])
+            self._conn.commit()
+        return len(orphaned)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_history_store(path):
+    """同一個歷史資料庫在整個程序內共用一個 HistoryStore"""
+    key = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = HistoryStore(path)
+            _stores[key] = store
+    return store
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from datetime import datetime
+import pandas as pd
+from search import build_fts_index, drop_fts_index
+from stats import build_stats_table, drop_stats_table
+from law_index import build_law_index, drop_law_index
+from similar import build_vector_index, drop_vector_index
+from snippets import build_paragraph_index, drop_paragraph_index
+from bodies import apply_body_storage, drop_body_store, register_body_function
+
+# 記錄每個 CSV 檔案導入狀態的表格，以底線開頭避免出現在給 AI 的表格清單中
+MANIFEST_TABLE = '_ingest_manifest'
+
+
+def file_digest(path, block_size=1 << 20):
+    """以串流方式計算檔案內容的 SHA-256，避免整個檔案載入記憶體"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ensure_manifest(conn):
+    """建立導入 manifest 表格（若不存在）"""
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+            file_name TEXT PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            columns TEXT NOT NULL,
+            ingested_at TEXT NOT NULL
+        )
+    """)
+
+
+def load_manifest(conn):
+    """讀取 manifest，回傳 {file_name: row_dict}"""
+    cursor = conn.execute(
+        f"SELECT file_name, table_name, size, mtime_ns, sha256, row_count, columns FROM {MANIFEST_TABLE}"
+    )
+    manifest = {}
+    for file_name, table_name, size, mtime_ns, sha256, row_count, columns in cursor:
+        manifest[file_name] = {
+            "table_name": table_name,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "sha256": sha256,
+            "row_count": row_count,
+            "columns": json.loads(columns),
+        }
+    return manifest
+
+
+def table_exists(conn, table_name):
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?", (table_name,)
+    ).fetchone()
+    return row is not None
+
+
+def load_csv_in_chunks(conn, csv_path, table_name, chunk_size):
+    """分塊讀取 CSV 並寫入暫存表，完成後再替換正式表格，讀取期間記憶體用量只和 chunk_size 有關"""
+    staging = f"_loading_{table_name}"
+    conn.execute(f'DROP TABLE IF EXISTS "{staging}"')
+    row_count = 0
+    columns = []
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        if not columns:
+            columns = [str(col) for col in chunk.columns]
+        chunk.to_sql(staging, conn, if_exists='append', index=False)
+        row_count += len(chunk)
+
+    if not columns:
+        # 空檔案：仍建立一個沒有資料的表格，保持與舊行為一致
+        columns = [str(col) for col in pd.read_csv(csv_path, nrows=0).columns]
+        pd.DataFrame(columns=columns).to_sql(staging, conn, if_exists='replace', index=False)
+
+    conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+    conn.execute(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"')
+    return row_count, columns
+
+
+def build_case_index(conn, table_name, columns, rebuild=True):
+    """為有 case_id 欄位的表格建立 case_id 索引，依案件查詢（含 JOIN）時不需要全表掃描
+
+    表格重新導入時舊索引會隨舊表格一起刪除，因此 rebuild 只影響是否先檢查索引存在。
+    回傳是否有建立索引。
+    """
+    index_name = f"_case_idx_{table_name}"
+    if 'case_id' not in columns:
+        return False
+    if not rebuild and conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (index_name,)
+    ).fetchone():
+        return False
+    conn.execute(f'DROP INDEX IF EXISTS "{index_name}"')
+    conn.execute(f'CREATE INDEX "{index_name}" ON "{table_name}" (case_id)')
+    return True
+
+
+def build_derived_indexes(conn, table_name, columns, rebuild):
+    """建立依附在資料表上的衍生索引（全文索引、統計表、法條索引、段落位置、相似案件向量等）
+
+    rebuild=True 表示資料表剛重新導入，所有衍生索引都必須重建；
+    否則只補建尚不存在的索引。回傳有重建的索引名稱列表。
+    """
+    built = []
+    if build_case_index(conn, table_name, columns, rebuild=rebuild):
+        built.append('case_id')
+    if build_fts_index(conn, table_name, columns, rebuild=rebuild):
+        built.append('fts')
+    if build_stats_table(conn, table_name, columns, rebuild=rebuild):
+        built.append('stats')
+    if build_law_index(conn, table_name, columns, rebuild=rebuild):
+        built.append('laws')
+    if build_paragraph_index(conn, table_name, columns, rebuild=rebuild):
+        built.append('paragraphs')
+    built += [f"vectors:{column}" for column in build_vector_index(conn, table_name, columns, rebuild=rebuild)]
+    return built
+
+
+def drop_derived_indexes(conn, table_name):
+    drop_fts_index(conn, table_name)
+    drop_stats_table(conn, table_name)
+    drop_law_index(conn, table_name)
+    drop_vector_index(conn, table_name)
+    drop_paragraph_index(conn, table_name)
+
+
+def ingest_csv_files(db_path, files_dir, chunk_size=5000, body_storage='plain', compression_level=6):
+    """增量導入 files_dir 內的 CSV 檔案
+
+    檔案大小與修改時間都沒變時直接跳過（不讀取檔案內容）；
+    大小或修改時間有變但內容雜湊相同時只更新 manifest；
+    內容確實改變時才分塊重新導入。
+    body_storage='compressed' 時判決全文以 zlib 壓縮另存（見 bodies.py），切換模式時會就地轉換並重建衍生索引。
+    任何表格被重新導入、切換儲存模式或移除時，資料庫的 PRAGMA user_version（世代編號）會加一；
+    只有既有表格切換儲存模式時才會 VACUUM。
+    回傳每個表格的導入報告列表。
+    """
+    report = []
+    storage_changed = False
+    conn = sqlite3.connect(db_path)
+    # 衍生索引從壓縮的全文建立時需要 judgement_body
+    register_body_function(conn)
+    try:
+        # WAL 模式會保存在資料庫檔案中，讓查詢用的唯讀連線在導入時仍可讀取
+        conn.execute("PRAGMA journal_mode = WAL")
+        ensure_manifest(conn)
+        conn.commit()
+        manifest = load_manifest(conn)
+
+        csv_files = sorted(f for f in os.listdir(files_dir) if f.endswith('.csv'))
+        for file in csv_files:
+            started = time.perf_counter()
+            path = os.path.join(files_dir, file)
+            table_name = os.path.splitext(file)[0]
+            stat = os.stat(path)
+            previous = manifest.get(file)
+            status = 'loaded'
+
+            if (previous and previous["size"] == stat.st_size
+                    and previous["mtime_ns"] == stat.st_mtime_ns
+                    and table_exists(conn, table_name)):
+                status = 'unchanged'
+                row_count, columns = previous["row_count"], previous["columns"]
+            else:
+                sha256 = file_digest(path)
+                if previous and previous["sha256"] == sha256 and table_exists(conn, table_name):
+                    # 內容相同（例如只是被 touch 或重新複製），只需更新檔案狀態
+                    status = 'touched'
+                    row_count, columns = previous["row_count"], previous["columns"]
+                else:
+                    row_count, columns = load_csv_in_chunks(conn, path, table_name, chunk_size)
+                conn.execute(
+                    f"""INSERT OR REPLACE INTO {MANIFEST_TABLE}
+                        (file_name, table_name, size, mtime_ns, sha256, row_count, columns, ingested_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (file, table_name, stat.st_size, stat.st_mtime_ns, sha256, row_count,
+                     json.dumps(columns, ensure_ascii=False),
+                     datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                conn.commit()
+
+            converted = apply_body_storage(conn, table_name, columns, body_storage, compression_level)
+            # 剛導入的表格轉成壓縮存放屬於導入的一部分；只有既有表格切換模式才需要重整資料庫
+            storage_changed |= converted and status != 'loaded'
+            indexes = ['bodies'] if converted else []
+            indexes += build_derived_indexes(conn, table_name, columns, rebuild=(status == 'loaded' or converted))
+            if indexes:
+                conn.commit()
+
+            report.append({
+                "table": table_name,
+                "status": status,
+                "rows": row_count,
+                "columns": columns,
+                "indexes": indexes,
+                "seconds": time.perf_counter() - started,
+            })
+
+        # CSV 已被移除的表格一併清除，避免 AI 查到過期資料
+        current = set(csv_files)
+        for file, entry in manifest.items():
+            if file not in current:
+                started = time.perf_counter()
+                drop_derived_indexes(conn, entry["table_name"])
+                drop_body_store(conn, entry["table_name"])
+                conn.execute(f'DROP TABLE IF EXISTS "{entry["table_name"]}"')
+                conn.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE file_name = ?", (file,))
+                conn.commit()
+                report.append({
+                    "table": entry["table_name"],
+                    "status": 'removed',
+                    "rows": 0,
+                    "columns": [],
+                    "indexes": [],
+                    "seconds": time.perf_counter() - started,
+                })
+
+        # 有表格變動時遞增世代編號，讓各連線的表格結構快取失效
+        if storage_changed or any(item["status"] in ('loaded', 'removed') for item in report):
+            conn.execute("PRAGMA user_version = %d" % (conn.execute("PRAGMA user_version").fetchone()[0] + 1))
+            conn.commit()
+        if storage_changed:
+            # 轉換後原表與舊索引留下大量空頁，重整一次讓資料庫檔案與頁面快取實際變小
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return report
+
+
+def format_ingest_report(report, total_seconds):
+    """將導入報告轉成啟動時顯示的文字"""
+    labels = {
+        'loaded': '已導入',
+        'touched': '內容未變',
+        'unchanged': '未變更',
+        'removed': '已移除',
+    }
+    lines = ["=== CSV 導入報告 ==="]
+    for item in report:
+        line = f"{labels[item['status']]:<4} {item['table']}: {item['rows']} 行, {item['seconds'] * 1000:.1f} ms"
+        if item['indexes']:
+            line += f" (重建索引: {', '.join(item['indexes'])})"
+        lines.append(line)
+    lines.append(f"總耗時: {total_seconds * 1000:.1f} ms")
+    return "\n".join(lines)
@@ -0,0 +1,221 @@
+import re
+from collections import Counter
+from search import quote_identifier
+from bodies import text_expression
+
+# 判決全文中常見的法規名稱；分析表中以《》標示的法規名稱不在此列表也能辨識
+KNOWN_LAWS = (
+    '刑法', '刑事訴訟法', '洗錢防制法', '組織犯罪防制條例', '詐欺犯罪危害防制條例',
+    '毒品危害防制條例', '槍砲彈藥刀械管制條例', '個人資料保護法', '銀行法', '證券交易法',
+    '民法', '民事訴訟法', '少年事件處理法', '道路交通管理處罰條例', '兒童及少年性剝削防制條例',
+)
+# 建立法條索引的文字欄位，依序取第一個存在的欄位
+LAW_SOURCE_COLUMNS = ('law_articles', 'judgement_content')
+_LAW_NAMES = '|'.join(sorted(KNOWN_LAWS, key=len, reverse=True))
+_ARTICLE = re.compile(
+    r'(?:《([^》]{1,30})》|(' + _LAW_NAMES + r'|同法))\s*第\s*(\d+)\s*條(?:\s*之\s*(\d+))?'
+)
+_QUERY_ARTICLE = re.compile(r'^第?\s*(\d+)\s*條?(?:\s*之\s*(\d+))?')
+
+
+def law_index_table_name(table_name):
+    """法條索引表名稱，以底線開頭避免出現在給 AI 的表格清單中"""
+    return f"_laws_{table_name}"
+
+
+def normalize_law(name):
+    name = name.strip()
+    return name[len('中華民國'):] if name.startswith('中華民國') else name
+
+
+def format_article(law, article):
+    """('刑法', '339之4') -> 刑法第339條之4"""
+    number, _, sub = article.partition('之')
+    return f"{law}第{number}條" + (f"之{sub}" if sub else '')
+
+
+def extract_articles(text):
+    """依出現順序取出文字中引用的 (法規, 條號)，條號如 '339' 或 '339之4'
+
+    只取到「條」為止（項、款不另外區分）；「同法」視為前一個提到的法規。
+    """
+    articles = []
+    previous = None
+    for match in _ARTICLE.finditer(str(text or '')):
+        bracketed, named, number, sub = match.groups()
+        law = normalize_law(bracketed) if bracketed else named
+        if law == '同法':
+            if previous is None:
+                continue
+            law = previous
+        previous = law
+        articles.append((law, f"{int(number)}之{int(sub)}" if sub else str(int(number))))
+    return articles
+
+
+def parse_law_query(text):
+    """解析 LAW 動作的參數，回傳 (法規, 條號)；只給法規名稱時條號為 None，無法解析時回傳 None
+
+    支援「刑法第339條之4」「《洗錢防制法》第14條」「刑法 339之4」「刑法 339」「刑法」等寫法。
+    """
+    text = text.strip()
+    articles = extract_articles(text)
+    if articles:
+        return articles[0]
+    parts = text.split(None, 1)
+    if not parts:
+        return None
+    law = normalize_law(parts[0].strip('《》'))
+    if len(parts) == 1:
+        return law, None
+    match = _QUERY_ARTICLE.match(parts[1].strip())
+    if not match:
+        return None
+    number, sub = match.groups()
+    return law, f"{int(number)}之{int(sub)}" if sub else str(int(number))
+
+
+def build_law_index(conn, table_name, columns, rebuild=True):
+    """解析表格中引用的法條，建立 (law, article, case_id) 索引表
+
+    有 issue_type / guilty 欄位的表格（逐爭點分析）一併存入爭點與判決結果；
+    判決全文則記錄每個案件引用該法條的次數。
+    主鍵 (law, article, case_id, issue_type) 以 WITHOUT ROWID 叢集存放，查詢某法條時只需一次範圍掃描；
+    另建 (case_id, law, article) 索引供依案件反查。
+    rebuild=False 時若索引表已存在則直接跳過。回傳是否有（重新）建立索引表。
+    """
+    index_table = law_index_table_name(table_name)
+    if not rebuild and conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (index_table,)
+    ).fetchone():
+        return False
+
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(index_table)}")
+    source = next((col for col in LAW_SOURCE_COLUMNS if col in columns), None)
+    if 'case_id' not in columns or source is None:
+        return False
+
+    extra = [col for col in ('issue_type', 'guilty') if col in columns]
+    select = ', '.join([quote_identifier('case_id'), text_expression(conn, table_name, source)] +
+                       [quote_identifier(col) for col in extra])
+    rows = {}
+    for row in conn.execute(f"SELECT {select} FROM {quote_identifier(table_name)}"):
+        case_id, text = row[0], row[1]
+        if case_id is None:
+            continue
+        record = dict(zip(extra, row[2:]))
+        issue_type = str(record.get('issue_type') or '')
+        guilty = record.get('guilty')
+        for (law, article), mentions in Counter(extract_articles(text)).items():
+            key = (law, article, str(case_id), issue_type)
+            if key in rows:
+                rows[key][1] += mentions
+            else:
+                rows[key] = [guilty, mentions]
+
+    conn.execute(f"""
+        CREATE TABLE {quote_identifier(index_table)} (
+            law TEXT NOT NULL,
+            article TEXT NOT NULL,
+            case_id TEXT NOT NULL,
+            issue_type TEXT NOT NULL,
+            guilty INTEGER,
+            mentions INTEGER NOT NULL,
+            PRIMARY KEY (law, article, case_id, issue_type)
+        ) WITHOUT ROWID
+    """)
+    conn.executemany(
+        f"INSERT INTO {quote_identifier(index_table)} VALUES (?, ?, ?, ?, ?, ?)",
+        [key + tuple(value) for key, value in rows.items()],
+    )
+    conn.execute(
+        f"CREATE INDEX {quote_identifier(index_table + '_case')} "
+        f"ON {quote_identifier(index_table)} (case_id, law, article)"
+    )
+    return True
+
+
+def drop_law_index(conn, table_name):
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(law_index_table_name(table_name))}")
+
+
+def law_index_tables(conn):
+    """回傳資料庫中所有法條索引表的名稱"""
+    prefix = law_index_table_name('')
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\' ORDER BY name",
+        (prefix.replace('_', '\\_') + '%',),
+    )
+    return [name for (name,) in rows]
+
+
+def lookup_cases(conn, law, article=None, limit=20):
+    """查詢引用某法條（或某法規任一條）的案件
+
+    回傳 (cases, total)：cases 為依爭點分析數、引用次數排序的前 limit 個案件，
+    每個案件為 {"case_id", "articles", "issues": [(issue_type, guilty)], "mentions"}；total 為符合的案件總數。
+    只在判決全文中被引用的案件，會再以 case_id 索引補上該案件在分析表中的爭點與判決結果。
+    """
+    if article is None:
+        where, params = "law = ?", [law]
+    else:
+        where, params = "law = ? AND article = ?", [law, article]
+
+    tables = law_index_tables(conn)
+    cases = {}
+    for index_table in tables:
+        cursor = conn.execute(
+            f"SELECT article, case_id, issue_type, guilty, mentions FROM {quote_identifier(index_table)} "
+            f"WHERE {where}",
+            params,
+        )
+        for article_found, case_id, issue_type, guilty, mentions in cursor:
+            case = cases.setdefault(case_id, {"case_id": case_id, "articles": set(), "issues": {}, "mentions": 0})
+            case["articles"].add(format_article(law, article_found))
+            if issue_type:
+                case["issues"][issue_type] = guilty
+            else:
+                case["mentions"] += mentions
+
+    ranked = sorted(cases.values(), key=lambda case: (-len(case["issues"]), -case["mentions"], case["case_id"]))
+    selected = ranked[:limit]
+
+    # 只在判決全文出現的案件，以 case_id 索引補上其他爭點
+    missing = [case["case_id"] for case in selected if not case["issues"]]
+    if missing:
+        placeholders = ', '.join('?' * len(missing))
+        by_id = {case["case_id"]: case for case in selected}
+        for index_table in tables:
+            cursor = conn.execute(
+                f"SELECT DISTINCT case_id, issue_type, guilty FROM {quote_identifier(index_table)} "
+                f"WHERE case_id IN ({placeholders}) AND issue_type != ''",
+                missing,
+            )
+            for case_id, issue_type, guilty in cursor:
+                by_id[case_id]["issues"][issue_type] = guilty
+
+    for case in selected:
+        case["articles"] = sorted(case["articles"])
+        case["issues"] = list(case["issues"].items())
+    return selected, len(cases)
+
+
+def format_law_results(law, article, cases, total):
+    """將法條查詢結果轉成回饋給 AI 的文字"""
+    target = format_article(law, article) if article else f"{law}（所有條文）"
+    if not cases:
+        return f"LAW 結果 ({target}): 沒有找到引用此法條的案件"
+    lines = [f"LAW 結果 ({target}, 共 {total} 件, 顯示 {len(cases)} 件):"]
+    for rank, case in enumerate(cases, 1):
+        line = f"{rank}. case_id={case['case_id']}"
+        if article is None:
+            line += f" 法條={'、'.join(case['articles'])}"
+        if case["mentions"]:
+            line += f" 判決引用 {case['mentions']} 次"
+        lines.append(line)
+        for issue_type, guilty in case["issues"]:
+            outcome = {1: '有罪', 0: '無罪'}.get(guilty, '未知')
+            lines.append(f"   - {issue_type}: {outcome}")
+        if not case["issues"]:
+            lines.append("   - (分析表中沒有此案件的爭點紀錄)")
+    return "\n".join(lines)
@@ -0,0 +1,386 @@
+import os
+import re
+import json
+import time
+import hashlib
+import asyncio
+import threading
+from history_store import get_history_store
+from config import (OPENAI_API_KEY, OPENAI_BASE_URL, LLM_BACKEND, LLM_CACHE_MODE, LLM_CACHE_DIR,
+                    LLM_REPLAY_FILE, LLM_STUB_LATENCY, LLM_SCHEDULER, LLM_MAX_CONCURRENCY, LLM_MAX_PER_SESSION,
+                    LLM_QUEUE_SIZE, LLM_QUEUE_TIMEOUT, LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE,
+                    LLM_COMPLETION_TOKEN_RESERVE, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY)
+
+CACHE_MODES = ('off', 'record', 'serve')
+# 模擬串流時每個片段的字元數
+STREAM_CHUNK_CHARS = 8
+
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓文字約一字一 token，其他字元約四個一 token"""
+    cjk = sum(1 for ch in text if '　' <= ch <= '鿿' or '豈' <= ch <= '￯')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _usage_for(messages, content):
+    prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+    completion_tokens = estimate_tokens(content)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _chunks(content, size=STREAM_CHUNK_CHARS):
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+
+class OpenAIBackend:
+    """直接呼叫 OpenAI Chat Completions API
+
+    max_retries 為 openai 套件本身的重試次數；經過 LLMScheduler 時設為 0，由排程器統一重試。
+    """
+
+    name = 'openai'
+
+    def __init__(self, client=None, api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=2):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_retries = max_retries
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries)
+        self.client = client
+        self._async_client = None
+
+    @property
+    def async_client(self):
+        """非同步 client 在第一次使用時才建立，之後重複使用同一個連線池"""
+        if self._async_client is None:
+            from openai import AsyncOpenAI
+            self._async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                             max_retries=self.max_retries)
+        return self._async_client
+
+    def complete(self, model, messages, **params):
+        response = self.client.chat.completions.create(model=model, messages=messages, **params)
+        return self._result(messages, response)
+
+    async def acomplete(self, model, messages, **params):
+        response = await self.async_client.chat.completions.create(model=model, messages=messages, **params)
+        return self._result(messages, response)
+
+    def stream(self, model, messages, **params):
+        """逐段產生回應文字，結束時以 return 回傳與 complete() 相同格式的結果
+
+        串流回應沒有 usage 欄位，token 數以估計值記錄。
+        """
+        response = self.client.chat.completions.create(model=model, messages=messages, stream=True, **params)
+        parts = []
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        content = ''.join(parts)
+        return {"content": content, "usage": _usage_for(messages, content), "source": self.name}
+
+    def _result(self, messages, response):
+        usage = response.usage
+        return {
+            "content": response.choices[0].message.content,
+            "usage": {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.total_tokens,
+            } if usage else _usage_for(messages, response.choices[0].message.content),
+            "source": self.name,
+        }
+
+
+class StubBackend:
+    """不連網的確定性模擬 LLM，用於壓力測試與離線跑完整的 agent 循環
+
+    第一次循環對系統提示中列出的第一個資料表發出 SQL 動作，之後的循環直接 finish 並引用最後一次的動作結果。
+    latency 可模擬 API 延遲（秒）。
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    @staticmethod
+    def _first_table(system_prompt):
+        match = re.search(r'^\d+\. ([A-Za-z_]\w*)\s*$', system_prompt, re.MULTILINE)
+        return match.group(1) if match else None
+
+    def complete(self, model, messages, **params):
+        if self.latency:
+            time.sleep(self.latency)
+        return self._respond(messages)
+
+    async def acomplete(self, model, messages, **params):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._respond(messages)
+
+    def stream(self, model, messages, **params):
+        """latency 視為第一個片段前的等待時間，之後分段送出完整回應"""
+        if self.latency:
+            time.sleep(self.latency)
+        result = self._respond(messages)
+        yield from _chunks(result["content"])
+        return result
+
+    def _respond(self, messages):
+        last_input = messages[-1]["content"]
+        table = self._first_table(messages[0]["content"]) if messages[0]["role"] == 'system' else None
+        if not last_input.startswith('[SYSTEM]') and table:
+            content = (
+                "<think>先查看相關資料表的整體統計</think>\n"
+                f"<action>SQL SELECT * FROM {table} LIMIT 5</action>\n"
+                "<if_finish>continue</if_finish>\n"
+                "<content></content>"
+            )
+        else:
+            observation = ' '.join(last_input.split())[:200]
+            content = (
+                "<think>已取得資料，整理結論</think>\n"
+                "<action></action>\n"
+                "<if_finish>finish</if_finish>\n"
+                f"<content>（本地模擬回應）根據查詢結果：{observation}</content>"
+            )
+        return {"content": content, "usage": _usage_for(messages, content), "source": self.name}
+
+
+def load_transcripts(path):
+    """讀取錄製的對話，回傳 [(user_input, ai_response), ...]
+
+    支援舊版 conversation_history.txt 與新版歷史資料庫（.db）。
+    """
+    exchanges = []
+    if not os.path.exists(path):
+        return exchanges
+    if path.endswith('.db'):
+        conversations = [entry["conversation"] for entry in get_history_store(path).conversations()]
+    else:
+        conversations = []
+        with open(path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        for block in content.split("=== 新對話 ==="):
+            if not block.strip():
+                continue
+            try:
+                entry = json.loads(block.strip())
+            except json.JSONDecodeError:
+                continue
+            conversations.append(entry.get("conversation"))
+    for conversation in conversations:
+        if not conversation or not conversation.startswith("User: ") or "\nAI: " not in conversation:
+            continue
+        user_input, ai_response = conversation[len("User: "):].split("\nAI: ", 1)
+        exchanges.append((user_input.strip(), ai_response))
+    return exchanges
+
+
+class ReplayBackend:
+    """以錄製的對話回答，找不到對應紀錄時交給後備 backend（預設為 StubBackend）
+
+    先以最後一則使用者訊息完全比對；比對不到時，找出本輪的原始問題，
+    依目前是第幾次循環回放同一段錄製對話中的對應回應。
+    """
+
+    name = 'replay'
+
+    def __init__(self, transcript_path=LLM_REPLAY_FILE, fallback=None, latency=0.0):
+        self.exchanges = load_transcripts(transcript_path)
+        self.fallback = fallback or StubBackend()
+        self.latency = latency
+        self.by_input = {}
+        self.sessions = {}
+        current = None
+        for user_input, ai_response in self.exchanges:
+            self.by_input.setdefault(user_input, ai_response)
+            if not user_input.startswith('['):
+                current = self.sessions.setdefault(user_input, [])
+                # 同一問題錄製過多次時只保留第一次的完整過程
+                if current:
+                    current = None
+                    continue
+            if current is not None:
+                current.append(ai_response)
+
+    def complete(self, model, messages, **params):
+        content = self._lookup(messages)
+        if content is None:
+            return self.fallback.complete(model, messages, **params)
+        if self.latency:
+            time.sleep(self.latency)
+        return {"content": content, "usage": _usage_for(messages, content), "source": self.name}
+
+    async def acomplete(self, model, messages, **params):
+        content = self._lookup(messages)
+        if content is None:
+            return await self.fallback.acomplete(model, messages, **params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return {"content": content, "usage": _usage_for(messages, content), "source": self.name}
+
+    def stream(self, model, messages, **params):
+        content = self._lookup(messages)
+        if content is None:
+            return (yield from self.fallback.stream(model, messages, **params))
+        if self.latency:
+            time.sleep(self.latency)
+        yield from _chunks(content)
+        return {"content": content, "usage": _usage_for(messages, content), "source": self.name}
+
+    def _lookup(self, messages):
+        """回傳錄製的回應，找不到時回傳 None"""
+        last_input = messages[-1]["content"].strip()
+        content = self.by_input.get(last_input)
+        if content is None:
+            question, step = None, 0
+            if not last_input.startswith('['):
+                question = last_input
+            else:
+                for message in reversed(messages[1:-1]):
+                    if message["role"] == 'assistant':
+                        step += 1
+                    elif not message["content"].startswith('['):
+                        question = message["content"].strip()
+                        break
+            recorded = self.sessions.get(question, [])
+            if step < len(recorded):
+                content = recorded[step]
+        return content
+
+
+class CachingBackend:
+    """以 (model, messages, 參數) 的 SHA-256 為鍵，將回應存到磁碟
+
+    mode='record'：每次都呼叫底層 backend，並記錄回應；
+    mode='serve'：有快取就直接回傳（需明確啟用，因為 temperature > 0 時回應本來就不固定）。
+    """
+
+    def __init__(self, backend, cache_dir=LLM_CACHE_DIR, mode='record'):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"未知的快取模式: {mode}")
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.name = f"{backend.name}+cache"
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(model, messages, params):
+        payload = json.dumps({"model": model, "messages": messages, "params": params},
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _read(self, path):
+        if self.mode != 'serve' or not os.path.exists(path):
+            with self._lock:
+                self.misses += 1
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            result = json.load(f)
+        with self._lock:
+            self.hits += 1
+        result["source"] = 'cache'
+        return result
+
+    def _write(self, path, model, result):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先寫入暫存檔再改名，避免並行請求讀到寫一半的檔案
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"content": result["content"], "usage": result["usage"], "model": model},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def complete(self, model, messages, **params):
+        path = self._path(self.cache_key(model, messages, params))
+        result = self._read(path)
+        if result is None:
+            result = self.backend.complete(model, messages, **params)
+            self._write(path, model, result)
+        return result
+
+    async def acomplete(self, model, messages, **params):
+        path = self._path(self.cache_key(model, messages, params))
+        result = await asyncio.to_thread(self._read, path)
+        if result is None:
+            result = await self.backend.acomplete(model, messages, **params)
+            await asyncio.to_thread(self._write, path, model, result)
+        return result
+
+    def stream(self, model, messages, **params):
+        """快取命中時一次送出整段回應；否則轉送底層 backend 的串流，結束後寫入快取"""
+        path = self._path(self.cache_key(model, messages, params))
+        result = self._read(path)
+        if result is not None:
+            yield result["content"]
+            return result
+        result = yield from self.backend.stream(model, messages, **params)
+        self._write(path, model, result)
+        return result
+
+
+def create_scheduler():
+    from llm_scheduler import LLMScheduler
+    return LLMScheduler(
+        max_concurrency=LLM_MAX_CONCURRENCY,
+        max_per_session=LLM_MAX_PER_SESSION,
+        queue_size=LLM_QUEUE_SIZE,
+        queue_timeout=LLM_QUEUE_TIMEOUT,
+        requests_per_minute=LLM_REQUESTS_PER_MINUTE or None,
+        tokens_per_minute=LLM_TOKENS_PER_MINUTE or None,
+        completion_tokens=LLM_COMPLETION_TOKEN_RESERVE,
+        max_retries=LLM_MAX_RETRIES,
+        retry_base_delay=LLM_RETRY_BASE_DELAY,
+        retry_max_delay=LLM_RETRY_MAX_DELAY,
+    )
+
+
+def create_backend(kind=LLM_BACKEND, cache_mode=LLM_CACHE_MODE, cache_dir=LLM_CACHE_DIR, scheduled=LLM_SCHEDULER):
+    """依設定建立 LLM backend：openai / replay / stub，可再包一層磁碟快取，最外層經過 LLMScheduler"""
+    if kind == 'openai':
+        backend = OpenAIBackend(max_retries=0 if scheduled else 2)
+    elif kind == 'replay':
+        backend = ReplayBackend(fallback=StubBackend(latency=LLM_STUB_LATENCY), latency=LLM_STUB_LATENCY)
+    elif kind == 'stub':
+        backend = StubBackend(latency=LLM_STUB_LATENCY)
+    else:
+        raise ValueError(f"未知的 LLM backend: {kind}")
+    if cache_mode != 'off':
+        backend = CachingBackend(backend, cache_dir=cache_dir, mode=cache_mode)
+    if scheduled:
+        from llm_scheduler import ScheduledBackend
+        backend = ScheduledBackend(backend, create_scheduler())
+    return backend
+
+
+_default_backend = None
+_default_lock = threading.Lock()
+
+
+def get_default_backend():
+    """整個程序共用的 LLM backend（共用 HTTP 連線池與快取統計）"""
+    global _default_backend
+    with _default_lock:
+        if _default_backend is None:
+            _default_backend = create_backend()
+    return _default_backend
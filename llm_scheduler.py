@@ -0,0 +1,371 @@
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from telemetry import metrics, log
+from llm_backend import estimate_tokens
+
+LLM_QUEUE_DEPTH = metrics.gauge('agent_llm_queue_depth', "等待 LLM 並行名額的請求數")
+LLM_IN_FLIGHT = metrics.gauge('agent_llm_in_flight', "進行中的 LLM 請求數")
+LLM_QUEUE_WAIT = metrics.histogram('agent_llm_queue_wait_seconds', "LLM 請求從排隊到送出（含速率限制等待）的時間")
+LLM_RETRIES = metrics.counter('agent_llm_retries_total', "LLM 請求因暫時性錯誤重試的次數，依原因分類")
+LLM_REJECTED = metrics.counter('agent_llm_rejected_total', "因過載被直接拒絕的 LLM 請求數，依原因分類")
+
+
+class LLMOverloaded(Exception):
+    """LLM 排程器過載，請求沒有送出；API 以 503 回應，retry_after 為建議的重試秒數"""
+
+    def __init__(self, reason, message, retry_after=1.0):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """權杖桶：每秒補充 rate 個權杖，最多累積 capacity 個；rate 為 None 時不限制
+
+    reserve 一律先扣除權杖（允許變成負數），回傳需要等待的秒數，讓並行的請求依到達順序排隊；
+    實際用量與預估不同時以 adjust 補回或追加扣除。
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            # 單次請求超過桶的容量時，最多等到桶滿
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, amount):
+        """amount 為正時補回權杖（預估過多），為負時追加扣除"""
+        if not self.rate:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+def transient_reason(error):
+    """可以重試的錯誤回傳原因（rate_limit / server_error / connection），其餘回傳 None
+
+    以狀態碼與類別名稱判斷，不需要匯入 openai 套件。
+    """
+    status = getattr(error, 'status_code', None)
+    if status == 429:
+        return 'rate_limit'
+    if status in (408, 409) or (status is not None and status >= 500):
+        return 'server_error'
+    if type(error).__name__ in ('APIConnectionError', 'APITimeoutError') or \
+            isinstance(error, (ConnectionError, TimeoutError)):
+        return 'connection'
+    return None
+
+
+def retry_after_seconds(error):
+    """讀取錯誤回應的 retry-after-ms / retry-after 標頭，沒有時回傳 None"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        try:
+            return float(headers.get(header)) * scale
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class _Waiter:
+    """排隊中的請求；同步請求以 threading.Event 喚醒，非同步請求以事件迴圈上的 asyncio.Event 喚醒"""
+
+    def __init__(self, session_id, loop=None):
+        self.session_id = session_id
+        self.granted = False
+        self.loop = loop
+        self.event = asyncio.Event() if loop else threading.Event()
+
+    def wake(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.event.set)
+        else:
+            self.event.set()
+
+
+class LLMScheduler:
+    """整個程序共用的 LLM 請求排程：並行上限、速率限制、重試與有上限的等待佇列
+
+    - 全域最多 max_concurrency 個、每個 session 最多 max_per_session 個進行中的請求
+    - 每分鐘請求數與 token 數以權杖桶限制；token 數以 prompt 估計值加上 completion_tokens 預留，
+      回應後依 usage 修正
+    - 等待名額的請求超過 queue_size 個，或預計等待超過 queue_timeout 秒時直接丟出 LLMOverloaded
+    - 429、5xx 與連線錯誤以帶隨機抖動的指數退避重試，最多 max_retries 次，並遵守 retry-after 標頭
+    同一個排程器可同時給執行緒（Flask、批次）與事件迴圈（aiohttp）使用。
+    """
+
+    def __init__(self, max_concurrency=8, max_per_session=2, queue_size=64, queue_timeout=30.0,
+                 requests_per_minute=None, tokens_per_minute=None, completion_tokens=1000,
+                 max_retries=4, retry_base_delay=0.5, retry_max_delay=20.0):
+        self.max_concurrency = max_concurrency
+        self.max_per_session = max_per_session
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.completion_tokens = completion_tokens
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        # 權杖桶最多累積 10 秒的用量，允許短暫的突發請求
+        self.requests = TokenBucket(requests_per_minute / 60 if requests_per_minute else None,
+                                    requests_per_minute and max(1, requests_per_minute // 6))
+        self.tokens = TokenBucket(tokens_per_minute / 60 if tokens_per_minute else None,
+                                  tokens_per_minute and max(1, tokens_per_minute // 6))
+        self.in_flight = 0
+        self._per_session = {}
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    # --- 並行名額 ---
+
+    def _can_run(self, session_id):
+        if self.in_flight >= self.max_concurrency:
+            return False
+        return session_id is None or self._per_session.get(session_id, 0) < self.max_per_session
+
+    def _take(self, session_id):
+        self.in_flight += 1
+        if session_id is not None:
+            self._per_session[session_id] = self._per_session.get(session_id, 0) + 1
+
+    def _update_gauges(self):
+        LLM_QUEUE_DEPTH.set(len(self._waiters))
+        LLM_IN_FLIGHT.set(self.in_flight)
+
+    def _enter(self, session_id, loop=None):
+        """有名額時直接取得並回傳 None，否則排入佇列並回傳 _Waiter；佇列已滿時丟出 LLMOverloaded
+
+        每次名額釋放後都會把所有符合條件的等待者放行，仍在佇列中的都是暫時無法執行的請求，
+        新請求有名額時可以直接執行而不會插隊。
+        """
+        with self._lock:
+            if self._can_run(session_id):
+                self._take(session_id)
+                self._update_gauges()
+                return None
+            if len(self._waiters) >= self.queue_size:
+                LLM_REJECTED.inc(reason='queue_full')
+                raise LLMOverloaded('queue_full', f"LLM 請求佇列已滿（{self.queue_size} 個），請稍後再試",
+                                    retry_after=self.retry_base_delay * 2)
+            waiter = _Waiter(session_id, loop)
+            self._waiters.append(waiter)
+            self._update_gauges()
+            return waiter
+
+    def _abandon(self, waiter):
+        """等待逾時：仍在佇列中時移除並丟出 LLMOverloaded；剛好已被放行時視為取得名額"""
+        with self._lock:
+            if waiter.granted:
+                return
+            self._waiters.remove(waiter)
+            self._update_gauges()
+        LLM_REJECTED.inc(reason='queue_timeout')
+        raise LLMOverloaded('queue_timeout', f"等待 LLM 名額超過 {self.queue_timeout} 秒，請稍後再試",
+                            retry_after=self.queue_timeout)
+
+    def _release(self, session_id):
+        with self._lock:
+            self.in_flight -= 1
+            if session_id is not None:
+                self._per_session[session_id] -= 1
+                if not self._per_session[session_id]:
+                    del self._per_session[session_id]
+            for waiter in list(self._waiters):
+                if self._can_run(waiter.session_id):
+                    self._take(waiter.session_id)
+                    waiter.granted = True
+                    self._waiters.remove(waiter)
+                    waiter.wake()
+            self._update_gauges()
+
+    def _reserve_rate(self, messages, queued_at, session_id):
+        """扣除請求與 token 權杖，回傳 (需要等待的秒數, 預留的 token 數)
+
+        預計等待超過剩餘的排隊時間時釋放名額並丟出 LLMOverloaded。
+        """
+        reserved = sum(estimate_tokens(message["content"]) for message in messages) + self.completion_tokens
+        delay = max(self.requests.reserve(1), self.tokens.reserve(reserved))
+        if time.monotonic() + delay - queued_at > self.queue_timeout:
+            self._refund(reserved)
+            self._release(session_id)
+            LLM_REJECTED.inc(reason='rate_limited')
+            raise LLMOverloaded('rate_limited', f"LLM 速率限制需等待 {delay:.1f} 秒，請稍後再試", retry_after=delay)
+        return delay, reserved
+
+    def _refund(self, reserved):
+        """請求沒有送出：退回預留的請求與 token 權杖"""
+        self.requests.adjust(1)
+        self.tokens.adjust(reserved)
+
+    def _settle(self, reserved, result):
+        """依 usage 修正預留的 token 數；請求失敗或串流中斷（result 為 None）時沒有 usage 可依據，全數退回"""
+        self.tokens.adjust(reserved - (result["usage"]["total_tokens"] if result else 0))
+
+    def acquire(self, session_id, messages):
+        """阻塞直到取得名額並通過速率限制，回傳預留的 token 數；之後必須呼叫 release"""
+        queued_at = time.monotonic()
+        waiter = self._enter(session_id)
+        if waiter is not None and not waiter.event.wait(self.queue_timeout):
+            self._abandon(waiter)
+        delay, reserved = self._reserve_rate(messages, queued_at, session_id)
+        if delay:
+            time.sleep(delay)
+        LLM_QUEUE_WAIT.observe(time.monotonic() - queued_at)
+        return reserved
+
+    async def aacquire(self, session_id, messages):
+        queued_at = time.monotonic()
+        waiter = self._enter(session_id, asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter.event.wait(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._abandon(waiter)
+            except asyncio.CancelledError:
+                # 請求被取消（例如超過問題的時間上限）時不能留下佔用的名額
+                with self._lock:
+                    granted = waiter.granted
+                    if not granted:
+                        self._waiters.remove(waiter)
+                        self._update_gauges()
+                if granted:
+                    self._release(session_id)
+                raise
+        delay, reserved = self._reserve_rate(messages, queued_at, session_id)
+        if delay:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self._refund(reserved)
+                self._release(session_id)
+                raise
+        LLM_QUEUE_WAIT.observe(time.monotonic() - queued_at)
+        return reserved
+
+    def release(self, session_id):
+        self._release(session_id)
+
+    # --- 重試 ---
+
+    def backoff(self, attempt, error):
+        """第 attempt 次重試前的等待秒數：指數退避上限內的隨機值（full jitter），不少於 retry-after"""
+        ceiling = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt)
+        return max(random.uniform(0, ceiling), retry_after_seconds(error) or 0)
+
+    def _should_retry(self, attempt, error, session_id):
+        reason = transient_reason(error)
+        if reason is None or attempt >= self.max_retries:
+            return None
+        LLM_RETRIES.inc(reason=reason)
+        # 重試也要計入每分鐘的請求數
+        delay = max(self.backoff(attempt, error), self.requests.reserve(1))
+        log('warning', 'llm_retry', f"LLM 請求失敗（{reason}），{delay:.2f} 秒後第 {attempt + 1} 次重試",
+            session=session_id, reason=reason, error=str(error)[:200])
+        return delay
+
+    def complete(self, backend, model, messages, session_id=None, **params):
+        reserved = self.acquire(session_id, messages)
+        result = None
+        try:
+            attempt = 0
+            while True:
+                try:
+                    result = backend.complete(model, messages, **params)
+                    break
+                except Exception as e:
+                    delay = self._should_retry(attempt, e, session_id)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+        finally:
+            self.release(session_id)
+            self._settle(reserved, result)
+        return result
+
+    async def acomplete(self, backend, model, messages, session_id=None, **params):
+        reserved = await self.aacquire(session_id, messages)
+        result = None
+        try:
+            attempt = 0
+            while True:
+                try:
+                    result = await backend.acomplete(model, messages, **params)
+                    break
+                except Exception as e:
+                    delay = self._should_retry(attempt, e, session_id)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        finally:
+            self.release(session_id)
+            self._settle(reserved, result)
+        return result
+
+    def stream(self, backend, model, messages, session_id=None, **params):
+        """串流期間一直佔用名額；只有在收到第一個片段之前的錯誤會重試，之後的錯誤直接丟出"""
+        reserved = self.acquire(session_id, messages)
+        result = None
+        try:
+            attempt = 0
+            while True:
+                stream = backend.stream(model, messages, **params)
+                try:
+                    first = next(stream)
+                    break
+                except StopIteration as stop:
+                    result = stop.value
+                    return result
+                except Exception as e:
+                    delay = self._should_retry(attempt, e, session_id)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+            yield first
+            result = yield from stream
+        finally:
+            self.release(session_id)
+            self._settle(reserved, result)
+        return result
+
+
+class ScheduledBackend:
+    """讓 LLM backend 的所有請求經過 LLMScheduler；for_session 回傳帶 session id 的版本，用於每個 session 的並行上限"""
+
+    def __init__(self, backend, scheduler, session_id=None):
+        self.backend = backend
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.name = backend.name
+
+    def for_session(self, session_id):
+        return ScheduledBackend(self.backend, self.scheduler, session_id)
+
+    def complete(self, model, messages, **params):
+        return self.scheduler.complete(self.backend, model, messages, session_id=self.session_id, **params)
+
+    async def acomplete(self, model, messages, **params):
+        return await self.scheduler.acomplete(self.backend, model, messages, session_id=self.session_id, **params)
+
+    def stream(self, model, messages, **params):
+        return (yield from self.scheduler.stream(self.backend, model, messages, session_id=self.session_id,
+                                                 **params))
@@ -1,6 +1,9 @@
 import re
-import os
-from agent import Agent
+from agent import Agent, parse_actions
+from config import HISTORY_DB, MAX_CYCLES_PER_REQUEST
+from history_store import get_history_store
+
+LOCAL_SESSION_ID = "local"
 
 def process_ai_response(agent, response, initial_input=None):
     """處理 AI 的回應，包括執行動作和處理結果"""
@@ -10,28 +13,17 @@ def process_ai_response(agent, response, initial_input=None):
         if decision == 'finish':
             return response
         elif decision == 'continue':
-            # 只有在確定要繼續時才檢查動作
-            if action_match := re.search(r'<action>(.*?)</action>', response):
-                action = action_match.group(1)
-                if action.startswith('READ_FILE '):
-                    filename = action[10:]  # 去掉 'READ_FILE ' 前綴
-                    print(f"\n讀取文件 {filename}:")
-                    file_content = agent.read_file(filename)
-                    print(file_content)
-                    
-                    print(f"\n循環次數: {agent.cycle_count + 1}")
-                    print("AI處理文件內容...")
-                    return agent.think(f"[SYSTEM] 我已經讀取了文件 {filename}，內容如下:\n{file_content}")
-                
-                elif action.startswith('SQL '):
-                    sql = action[4:]  # 去掉 'SQL ' 前綴
-                    print(f"\n執行 SQL: {sql}")
-                    result = agent.execute_sql(sql)
-                    print(result)
+            # 只有在確定要繼續時才檢查動作，同一回應中的多個動作並行執行
+            if actions := parse_actions(response):
+                for action in actions:
+                    print(f"\n執行動作: {action}")
+                observation = agent.run_actions(actions)
+                if observation is not None:
+                    print(observation)
                     
                     print(f"\n循環次數: {agent.cycle_count + 1}")
-                    print("AI處理 SQL 結果...")
-                    return agent.think(f"[SYSTEM] SQL 查詢結果如下:\n{result}")
+                    print("AI處理動作結果...")
+                    return agent.think(observation)
             
             # 如果沒有動作但要繼續，使用原始問題或通用提示
             print(f"\n循環次數: {agent.cycle_count + 1}")
@@ -42,14 +34,15 @@ def process_ai_response(agent, response, initial_input=None):
     return response
 
 def main():
-    # 檢查是否需要重置記憶
-    if os.path.exists("conversation_history.txt"):
+    # 檢查是否需要重置記憶（只清除本機 CLI 這個 session 的紀錄）
+    history_store = get_history_store(HISTORY_DB)
+    if history_store.count(LOCAL_SESSION_ID):
         reset = input("是否要重置對話記憶？(y/n): ").lower() == 'y'
         if reset:
-            os.remove("conversation_history.txt")
+            history_store.reset(LOCAL_SESSION_ID)
             print("對話記憶已重置")
     
-    agent = Agent()
+    agent = Agent(session_id=LOCAL_SESSION_ID)
     print("系統啟動 (輸入 'exit' 結束)")
     print("CSV 文件已自動導入到 SQLite 數據庫中")
     
@@ -61,14 +54,17 @@ def main():
         print(f"\n循環次數: {agent.cycle_count + 1}")
         print("AI思考中...")
         
-        # 獲取並處理 AI 的回應
+        # 獲取並處理 AI 的回應，單一問題最多 MAX_CYCLES_PER_REQUEST 次循環
         response = agent.think(user_input)
-        while True:
+        for _ in range(MAX_CYCLES_PER_REQUEST - 1):
             print("\n" + response)
             processed_response = process_ai_response(agent, response, user_input)
             if processed_response == response:  # 如果回應沒有改變，說明不需要繼續處理
                 break
             response = processed_response
+        else:
+            print("\n" + response)
+            print(f"\n已達單一問題的循環上限 ({MAX_CYCLES_PER_REQUEST})，停止分析")
 
 if __name__ == "__main__":
     main()
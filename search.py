@@ -0,0 +1,225 @@
+import re
+from bodies import BODY_COLUMN, is_compressed, text_expression
+
+# 需要建立全文索引的文字欄位（只要表格有這些欄位就會建立索引）
+FTS_TEXT_COLUMNS = ('judgement_content', 'defendant_behavior')
+# 搜尋結果中一併顯示的識別欄位（表格有的才顯示）
+FTS_ID_COLUMNS = ('case_id', 'issue_type', 'guilty')
+# trigram 分詞器只能索引長度 >= 3 的字串，較短的關鍵字改查 bigram 索引
+TRIGRAM_MIN_LENGTH = 3
+# bigram 索引的分詞單位：連續的文字與數字（不含底線，與 unicode61 分詞器一致）
+_WORD_RUN = re.compile(r'[^\W_]+')
+# 建立 contentless 索引時每批讀取的列數
+INDEX_BATCH_ROWS = 256
+
+
+def fts_table_name(table_name):
+    """全文索引虛擬表的名稱，以底線開頭避免出現在給 AI 的表格清單中"""
+    return f"_fts_{table_name}"
+
+
+def bigram_table_name(table_name):
+    """短關鍵字（1～2 個字）使用的 bigram 全文索引"""
+    return f"_bigram_{table_name}"
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _index_columns(conn, index_name):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({quote_identifier(index_name)})")]
+
+
+def fts_columns(conn, table_name):
+    """回傳全文索引涵蓋的欄位；沒有索引時回傳空列表"""
+    return _index_columns(conn, fts_table_name(table_name))
+
+
+def bigram_text(text):
+    """將文字轉成以空白分隔的重疊雙字詞（「詐欺罪」→「詐欺 欺罪 罪」）
+
+    每段連續文字的最後一個字另外保留為單字，單字關鍵字以前綴查詢即可比對到所有出現的位置。
+    """
+    tokens = []
+    for run in _WORD_RUN.findall(str(text or '')):
+        tokens += [run[i:i + 2] for i in range(len(run) - 1)]
+        tokens.append(run[-1])
+    return ' '.join(tokens)
+
+
+def bigram_query(term):
+    """短關鍵字的 bigram 索引查詢：兩個字比對完全相同的詞，單字以前綴比對；只有標點符號時回傳 None"""
+    tokens = ['"' + part + '"' + ('*' if len(part) == 1 else '') for part in _WORD_RUN.findall(term)]
+    return ' AND '.join(tokens) or None
+
+
+def build_fts_index(conn, table_name, columns, rebuild=True):
+    """為表格的文字欄位建立 FTS5 trigram 全文索引，以及給短關鍵字使用的 bigram 索引
+
+    使用 external content 表，索引只存 trigram 而不重複保存判決全文；
+    判決全文已壓縮時改用 contentless 索引，建立時解壓縮一次寫入 trigram，查詢時不會讀到全文。
+    rebuild=False 時若兩個索引都已存在則直接跳過。
+    回傳是否有（重新）建立索引。
+    """
+    text_columns = [col for col in FTS_TEXT_COLUMNS if col in columns]
+    fts = fts_table_name(table_name)
+    if (not rebuild and fts_columns(conn, table_name) == text_columns
+            and _index_columns(conn, bigram_table_name(table_name)) == text_columns):
+        return False
+
+    drop_fts_index(conn, table_name)
+    if not text_columns:
+        return False
+    build_bigram_index(conn, table_name, text_columns)
+    column_list = ', '.join(quote_identifier(col) for col in text_columns)
+    if BODY_COLUMN in text_columns and is_compressed(conn, table_name):
+        conn.execute(
+            f"CREATE VIRTUAL TABLE {quote_identifier(fts)} USING fts5({column_list}, content='', tokenize='trigram')"
+        )
+        _fill_index(conn, table_name, fts, text_columns)
+        return True
+    content = table_name.replace("'", "''")
+    conn.execute(
+        f"CREATE VIRTUAL TABLE {quote_identifier(fts)} USING fts5("
+        f"{column_list}, content='{content}', content_rowid='rowid', tokenize='trigram')"
+    )
+    conn.execute(f"INSERT INTO {quote_identifier(fts)}({quote_identifier(fts)}) VALUES ('rebuild')")
+    return True
+
+
+def build_bigram_index(conn, table_name, text_columns):
+    """以 contentless 的 unicode61 索引保存 bigram_text 轉換後的文字
+
+    trigram 分詞器無法比對 1～2 個字的關鍵字（例如「詐欺」「竊盜」），改由這個索引以單一詞查詢，
+    不必對原表（或壓縮的全文）做 LIKE 掃描；保留完整的位置資訊，搜尋結果仍可依 bm25 排序。
+    """
+    bigram = bigram_table_name(table_name)
+    column_list = ', '.join(quote_identifier(col) for col in text_columns)
+    conn.execute(
+        f"CREATE VIRTUAL TABLE {quote_identifier(bigram)} USING fts5({column_list}, content='', tokenize='unicode61')"
+    )
+    _fill_index(conn, table_name, bigram, text_columns, bigram_text)
+
+
+def _fill_index(conn, table_name, index_name, text_columns, transform=None):
+    """分批讀取（必要時解壓縮）表格的文字欄位寫入 contentless 索引，transform 為寫入前的文字轉換"""
+    column_list = ', '.join(quote_identifier(col) for col in text_columns)
+    select = ', '.join(['rowid'] + [text_expression(conn, table_name, col) for col in text_columns])
+    placeholders = ', '.join('?' * (len(text_columns) + 1))
+    cursor = conn.execute(f"SELECT {select} FROM {quote_identifier(table_name)} ORDER BY rowid")
+    while batch := cursor.fetchmany(INDEX_BATCH_ROWS):
+        if transform:
+            batch = [(row[0], *map(transform, row[1:])) for row in batch]
+        conn.executemany(
+            f"INSERT INTO {quote_identifier(index_name)}(rowid, {column_list}) VALUES ({placeholders})", batch
+        )
+
+
+def drop_fts_index(conn, table_name):
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(fts_table_name(table_name))}")
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(bigram_table_name(table_name))}")
+
+
+def split_terms(text):
+    """將 SEARCH 動作的關鍵字拆成列表，支援以雙引號包住含空白的片語"""
+    terms = []
+    for quoted, plain in re.findall(r'"([^"]+)"|(\S+)', text):
+        term = (quoted or plain).strip()
+        if term:
+            terms.append(term)
+    return terms
+
+
+def _python_snippet(text, terms, width=24):
+    """沒有可用的 FTS 匹配時，在 Python 端擷取關鍵字附近的文字"""
+    text = str(text or '')
+    for term in terms:
+        pos = text.find(term)
+        if pos >= 0:
+            start = max(pos - width, 0)
+            end = min(pos + len(term) + width, len(text))
+            snippet = text[start:pos] + f"【{term}】" + text[pos + len(term):end]
+            return ('…' if start > 0 else '') + snippet + ('…' if end < len(text) else '')
+    return ''
+
+
+def search_fts(conn, table_name, terms, limit=10, snippet_tokens=24):
+    """以全文索引搜尋表格，依 bm25 排序回傳命中列
+
+    長度 >= 3 的關鍵字走 trigram 索引（MATCH），1～2 個字的關鍵字走 bigram 索引；
+    兩種都有時以 trigram 的 bm25 排序，只有短關鍵字時以 bigram 的 bm25 排序。所有關鍵字都必須出現（AND），
+    任何情況都不會掃描原表。只有標點符號的關鍵字無法被索引，會被略過。
+    摘要在 trigram 索引有原文時以 snippet() 產生；判決全文已壓縮或只有短關鍵字時，
+    只讀取（解壓縮）最後輸出的幾行、在 Python 端擷取。
+    回傳 (column_names, rows)，表格沒有全文索引時回傳 None。
+    """
+    text_columns = fts_columns(conn, table_name)
+    if not text_columns:
+        return None
+    fts = quote_identifier(fts_table_name(table_name))
+    bigram = quote_identifier(bigram_table_name(table_name))
+    # 查詢用連線上同名的 TEMP VIEW 沒有 rowid，一律讀取 main 中實際的表格
+    base = f"main.{quote_identifier(table_name)}"
+    base_columns = [row[1] for row in conn.execute(f"PRAGMA main.table_info({quote_identifier(table_name)})")]
+    id_columns = [col for col in FTS_ID_COLUMNS if col in base_columns]
+    columns = ['rowid'] + id_columns + ['bm25', 'snippet']
+    compressed = BODY_COLUMN in text_columns and is_compressed(conn, table_name)
+
+    long_terms = [term for term in terms if len(term) >= TRIGRAM_MIN_LENGTH]
+    short_queries = [query for query in map(bigram_query, (t for t in terms if len(t) < TRIGRAM_MIN_LENGTH)) if query]
+    if not long_terms and not short_queries:
+        return columns, []
+    short_query = ' AND '.join(short_queries)
+    fts_snippet = bool(long_terms) and not compressed
+
+    select = ["t.rowid"] + [f"t.{quote_identifier(col)}" for col in id_columns]
+    where = []
+    params = []
+    if long_terms:
+        select.append(f"bm25({fts}) AS score")
+        if fts_snippet:
+            select.append(f"snippet({fts}, -1, '【', '】', '…', {int(snippet_tokens)})")
+        source = f"{fts} JOIN {base} AS t ON t.rowid = {fts}.rowid"
+        where.append(f"{fts} MATCH ?")
+        params.append(' AND '.join('"' + term.replace('"', '""') + '"' for term in long_terms))
+        if short_query:
+            where.append(f"t.rowid IN (SELECT rowid FROM {bigram} WHERE {bigram} MATCH ?)")
+            params.append(short_query)
+    else:
+        select.append(f"bm25({bigram}) AS score")
+        source = f"{bigram} JOIN {base} AS t ON t.rowid = {bigram}.rowid"
+        where.append(f"{bigram} MATCH ?")
+        params.append(short_query)
+
+    sql = f"SELECT {', '.join(select)} FROM {source} WHERE {' AND '.join(where)} ORDER BY score LIMIT ?"
+    params.append(int(limit))
+
+    text_expressions = [text_expression(conn, table_name, col, 't') for col in text_columns]
+    rows = []
+    for row in conn.execute(sql, params).fetchall():
+        row = list(row)
+        if fts_snippet:
+            snippet = row.pop()
+        else:
+            values = conn.execute(f"SELECT {', '.join(text_expressions)} FROM {base} AS t WHERE t.rowid = ?",
+                                  (row[0],)).fetchone()
+            snippet = next((s for s in (_python_snippet(value, terms) for value in values) if s), '')
+        rows.append(row + [snippet])
+    return columns, rows
+
+
+def format_search_results(table_name, terms, columns, rows):
+    """將搜尋結果轉成回饋給 AI 的文字"""
+    if not rows:
+        return f"SEARCH 結果 ({table_name}, 關鍵字: {' '.join(terms)}): 沒有找到符合的資料"
+    lines = [f"SEARCH 結果 ({table_name}, 關鍵字: {' '.join(terms)}, 共 {len(rows)} 筆, 依 bm25 排序，分數越低越相關):"]
+    for rank, row in enumerate(rows, 1):
+        record = dict(zip(columns, row))
+        fields = [f"{col}={record[col]}" for col in columns if col not in ('rowid', 'bm25', 'snippet')]
+        if not any(col == 'case_id' for col in columns):
+            fields.insert(0, f"rowid={record['rowid']}")
+        lines.append(f"{rank}. " + ' '.join(fields) + f" bm25={record['bm25']:.4g}")
+        if record['snippet']:
+            lines.append(f"   {' '.join(str(record['snippet']).split())}")
+    return "\n".join(lines)
@@ -0,0 +1,103 @@
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+
+
+class Session:
+    """單一使用者的對話狀態，lock（同步伺服器）與 async_lock（非同步伺服器）確保同一 session 的請求依序處理"""
+
+    def __init__(self, session_id, agent):
+        self.session_id = session_id
+        self.agent = agent
+        self.lock = threading.Lock()
+        self.async_lock = asyncio.Lock()
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    def busy(self):
+        return self.lock.locked() or self.async_lock.locked()
+
+    def history_size(self):
+        return sum(len(entry) for entry in self.agent.conversation_history)
+
+
+class SessionManager:
+    """以 session id 管理各自的 Agent，所有 Agent 共用資料庫與 LLM 資源
+
+    - 超過 ttl 秒沒有使用的 session 會被回收
+    - session 數量超過 max_sessions 或對話歷史總字數超過 max_history_chars 時，依 LRU 回收閒置的 session
+    - 正在處理請求的 session 不會被回收
+    被回收的 session 之後再出現時會重新建立，並從歷史資料庫載入最近的對話。
+    """
+
+    def __init__(self, factory, max_sessions=1000, ttl=1800, max_history_chars=50_000_000):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_history_chars = max_history_chars
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    def get(self, session_id):
+        """取得 session，不存在時建立"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_used = time.monotonic()
+                return session
+        # 建立 Agent 可能需要讀取歷史資料庫，不在全域鎖內進行
+        agent = self.factory(session_id)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = Session(session_id, agent)
+                self._sessions[session_id] = session
+                self.created += 1
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+            self._evict_locked()
+        return session
+
+    def remove(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _evict_locked(self):
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if self.ttl and now - session.last_used > self.ttl and not session.busy():
+                del self._sessions[session_id]
+                self.evicted += 1
+
+        total_chars = sum(session.history_size() for session in self._sessions.values())
+        for session_id, session in list(self._sessions.items()):
+            if len(self._sessions) <= self.max_sessions and total_chars <= self.max_history_chars:
+                break
+            # 最近剛存取的 session（OrderedDict 最後一個）與處理中的 session 不回收
+            if session_id == next(reversed(self._sessions)) or session.busy():
+                continue
+            total_chars -= session.history_size()
+            del self._sessions[session_id]
+            self.evicted += 1
+
+    def evict_idle(self):
+        """主動回收過期的 session，可由背景工作定期呼叫"""
+        with self._lock:
+            self._evict_locked()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": len(self._sessions),
+                "busy": sum(1 for session in self._sessions.values() if session.busy()),
+                "created": self.created,
+                "evicted": self.evicted,
+            }
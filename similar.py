@@ -0,0 +1,236 @@
+import os
+import json
+import threading
+import numpy as np
+from search import FTS_TEXT_COLUMNS, quote_identifier
+from bodies import text_expression
+
+# 雜湊後的向量維度；維度越高碰撞越少，但每份文件的向量佔用 4 * SIMILAR_DIMENSIONS bytes
+SIMILAR_DIMENSIONS = 1 << 13
+# 使用的字元 n-gram 長度（中文以二、三字詞為主）
+SIMILAR_NGRAMS = (2, 3)
+# 計算相似度時每批處理的文件數，控制記憶體用量
+SIMILAR_BATCH_ROWS = 4096
+# 結果中一併顯示的識別欄位（表格有的才顯示）
+SIMILAR_ID_COLUMNS = ('case_id', 'issue_type', 'guilty')
+VECTOR_DIR_NAME = 'vectors'
+
+# n-gram 雜湊使用的乘數（64 位元整數運算，溢位即取模）
+_HASH_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9], dtype=np.uint64)
+
+
+def vector_dir(db_path):
+    """向量檔放在資料庫旁的 vectors 目錄"""
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), VECTOR_DIR_NAME)
+
+
+def _vector_paths(directory, table_name, column):
+    base = os.path.join(directory, f"{table_name}.{column}")
+    return {"matrix": f"{base}.npy", "idf": f"{base}.idf.npy", "meta": f"{base}.meta.json"}
+
+
+def _db_file(conn):
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def term_frequencies(text, dimensions=SIMILAR_DIMENSIONS, ngrams=SIMILAR_NGRAMS):
+    """以向量化運算計算字元 n-gram 的雜湊詞頻（空白會先去除）"""
+    text = ''.join(str(text or '').split())
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    counts = np.zeros(dimensions, dtype=np.float32)
+    for n in ngrams:
+        if len(codes) < n:
+            continue
+        hashed = np.zeros(len(codes) - n + 1, dtype=np.uint64)
+        for offset in range(n):
+            hashed += codes[offset:len(codes) - n + 1 + offset] * _HASH_MULTIPLIERS[offset]
+        buckets = ((hashed >> np.uint64(17)) % np.uint64(dimensions)).astype(np.int64)
+        counts += np.bincount(buckets, minlength=dimensions)
+    return counts
+
+
+def _weight(counts, idf):
+    """對數詞頻乘上 idf 後做 L2 正規化（counts 可為單一向量或一批向量）"""
+    weighted = np.log1p(counts) * idf
+    norms = np.linalg.norm(weighted, axis=-1, keepdims=True)
+    return np.divide(weighted, norms, out=np.zeros_like(weighted), where=norms > 0)
+
+
+def build_vector_index(conn, table_name, columns, rebuild=True):
+    """為表格的文字欄位建立 TF-IDF 向量矩陣，存成可 memory-map 的 .npy 檔
+
+    矩陣先寫到暫存檔再改名，查詢端看到的永遠是完整的檔案；建立失敗時刪除暫存檔。
+    rebuild=False 時若向量檔都已存在則直接跳過。回傳有（重新）建立向量的欄位列表。
+    """
+    directory = vector_dir(_db_file(conn))
+    text_columns = [col for col in FTS_TEXT_COLUMNS if col in columns]
+    built = []
+    for column in text_columns:
+        paths = _vector_paths(directory, table_name, column)
+        if not rebuild and all(os.path.exists(path) for path in paths.values()):
+            continue
+        os.makedirs(directory, exist_ok=True)
+        id_columns = [col for col in SIMILAR_ID_COLUMNS if col in columns]
+        select = ', '.join(['rowid'] + [quote_identifier(col) for col in id_columns] +
+                           [text_expression(conn, table_name, column)])
+        count = conn.execute(f"SELECT COUNT(*) FROM {quote_identifier(table_name)}").fetchone()[0]
+
+        tmp = {name: f"{path}.{os.getpid()}.tmp" for name, path in paths.items()}
+        try:
+            matrix = np.lib.format.open_memmap(tmp["matrix"], mode='w+', dtype=np.float32,
+                                               shape=(count, SIMILAR_DIMENSIONS))
+            document_frequency = np.zeros(SIMILAR_DIMENSIONS, dtype=np.float64)
+            rows = []
+            # 逐列讀取，全文不會一次全部載入記憶體
+            cursor = conn.execute(f"SELECT {select} FROM {quote_identifier(table_name)} ORDER BY rowid LIMIT ?",
+                                  (count,))
+            for index, row in enumerate(cursor):
+                matrix[index] = term_frequencies(row[-1])
+                document_frequency += matrix[index] > 0
+                rows.append(list(row[:-1]))
+            idf = (np.log((1 + count) / (1 + document_frequency)) + 1).astype(np.float32)
+            for start in range(0, count, SIMILAR_BATCH_ROWS):
+                matrix[start:start + SIMILAR_BATCH_ROWS] = _weight(matrix[start:start + SIMILAR_BATCH_ROWS], idf)
+            matrix.flush()
+            del matrix
+            # np.save 會自動補上 .npy 副檔名，改用檔案物件寫入暫存檔
+            with open(tmp["idf"], 'wb') as f:
+                np.save(f, idf)
+            with open(tmp["meta"], 'w', encoding='utf-8') as f:
+                json.dump({
+                    "table": table_name,
+                    "column": column,
+                    "columns": ['rowid'] + id_columns,
+                    "rows": rows,
+                }, f, ensure_ascii=False)
+            for name, path in paths.items():
+                os.replace(tmp[name], path)
+        finally:
+            # 建立失敗時不留下暫存檔；成功時暫存檔都已改名，這裡不會刪到任何東西
+            for path in tmp.values():
+                if os.path.exists(path):
+                    os.remove(path)
+        built.append(column)
+    return built
+
+
+def drop_vector_index(conn, table_name):
+    directory = vector_dir(_db_file(conn))
+    for column in FTS_TEXT_COLUMNS:
+        for path in _vector_paths(directory, table_name, column).values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class VectorIndex:
+    """單一表格欄位的向量索引，矩陣以 mmap 方式開啟，只有實際讀到的頁面會載入記憶體"""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.mtime_ns = os.stat(paths["matrix"]).st_mtime_ns
+        self.matrix = np.load(paths["matrix"], mmap_mode='r')
+        self.idf = np.load(paths["idf"])
+        with open(paths["meta"], 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.table = meta["table"]
+        self.column = meta["column"]
+        self.columns = meta["columns"]
+        self.rows = meta["rows"]
+        case_index = self.columns.index('case_id') if 'case_id' in self.columns else None
+        self.case_rows = {}
+        if case_index is not None:
+            for position, row in enumerate(self.rows):
+                # 沒有 case_id 的列無法以 case_id 查詢，不能全部歸到 "None" 之下
+                if row[case_index] is not None:
+                    self.case_rows.setdefault(str(row[case_index]), []).append(position)
+
+    def query_vector(self, text):
+        return _weight(term_frequencies(text, dimensions=len(self.idf)), self.idf)
+
+    def case_vector(self, case_id):
+        """某個案件的向量（多行時取平均後重新正規化），找不到時回傳 None"""
+        positions = self.case_rows.get(str(case_id))
+        if not positions:
+            return None
+        vector = np.asarray(self.matrix[positions]).mean(axis=0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    def top_k(self, vector, k=5, exclude_case=None):
+        """分批計算餘弦相似度（向量皆已正規化，內積即為餘弦），回傳 [(分數, 列資料 dict)]
+
+        同一個 case_id 只保留分數最高的一列。
+        """
+        scores = np.empty(len(self.rows), dtype=np.float32)
+        for start in range(0, len(self.rows), SIMILAR_BATCH_ROWS):
+            scores[start:start + SIMILAR_BATCH_ROWS] = self.matrix[start:start + SIMILAR_BATCH_ROWS] @ vector
+        results = []
+        seen = set()
+        # 先取候選再排序，避免對全部分數做完整排序
+        candidates = min(len(scores), max(k * 4, k + 8))
+        while True:
+            if candidates < len(scores):
+                order = np.argpartition(-scores, candidates - 1)[:candidates]
+                order = order[np.argsort(-scores[order])]
+            else:
+                order = np.argsort(-scores)
+            for position in order:
+                if scores[position] <= 0:
+                    # 之後的分數都不會更高，不需要再擴大候選
+                    return results
+                if len(results) >= k:
+                    break
+                record = dict(zip(self.columns, self.rows[position]))
+                case_id = record.get('case_id')
+                # 沒有 case_id 的列各自獨立，不合併成同一個案件
+                key = case_id if case_id is not None else ('rowid', record['rowid'])
+                if key in seen or (exclude_case is not None and case_id is not None
+                                   and str(case_id) == str(exclude_case)):
+                    continue
+                seen.add(key)
+                results.append((float(scores[position]), record))
+            if len(results) >= k or candidates >= len(scores):
+                return results
+            # 重複的案件太多，擴大候選重新挑選
+            results, seen = [], set()
+            candidates = min(len(scores), candidates * 4)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def load_vector_indexes(db_path):
+    """載入（或沿用已載入的）所有向量索引；向量檔重建後會自動重新開啟"""
+    directory = vector_dir(db_path)
+    if not os.path.isdir(directory):
+        return []
+    loaded = []
+    with _indexes_lock:
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.meta.json'):
+                continue
+            base = os.path.join(directory, name[:-len('.meta.json')])
+            paths = {"matrix": f"{base}.npy", "idf": f"{base}.idf.npy", "meta": f"{base}.meta.json"}
+            if not all(os.path.exists(path) for path in paths.values()):
+                continue
+            index = _indexes.get(base)
+            if index is None or index.mtime_ns != os.stat(paths["matrix"]).st_mtime_ns:
+                index = _indexes[base] = VectorIndex(paths)
+            loaded.append(index)
+    return loaded
+
+
+def format_similar_results(query_label, results):
+    """results 為 [(VectorIndex, [(分數, 列資料)])]，轉成回饋給 AI 的文字"""
+    lines = [f"SIMILAR 結果 ({query_label}, 依餘弦相似度排序):"]
+    for index, hits in results:
+        lines.append(f"[{index.table}.{index.column}]")
+        if not hits:
+            lines.append("  沒有相似的資料")
+        for rank, (score, record) in enumerate(hits, 1):
+            fields = [f"{col}={value}" for col, value in record.items() if col != 'rowid']
+            if 'case_id' not in record:
+                fields.insert(0, f"rowid={record['rowid']}")
+            lines.append(f"  {rank}. " + ' '.join(fields) + f" 相似度={score:.3f}")
+    return "\n".join(lines)
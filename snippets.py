@@ -0,0 +1,212 @@
+import re
+from search import quote_identifier, split_terms, TRIGRAM_MIN_LENGTH
+from bodies import is_compressed, read_body_bytes, text_expression
+
+# 建立段落索引的全文欄位
+SNIPPET_TEXT_COLUMN = 'judgement_content'
+# 段落長度上限（字元），過長的行在句號處切開
+PARAGRAPH_MAX_CHARS = 300
+# 短於此長度的段落（標題、空行間的零碎文字）與下一段合併
+PARAGRAPH_MIN_CHARS = 60
+
+
+def paragraph_table_name(table_name):
+    """段落位置表名稱，以底線開頭避免出現在給 AI 的表格清單中"""
+    return f"_paragraphs_{table_name}"
+
+
+def paragraph_fts_name(table_name):
+    return f"_paragraph_fts_{table_name}"
+
+
+def split_paragraphs(text, max_chars=PARAGRAPH_MAX_CHARS, min_chars=PARAGRAPH_MIN_CHARS):
+    """將判決全文切成段落，回傳 [(起始字元位置, 結束字元位置)]"""
+    spans = []
+    for match in re.finditer(r'[^\n]+', text):
+        start, end = match.span()
+        if not text[start:end].strip():
+            continue
+        while end - start > max_chars:
+            cut = text.rfind('。', start, start + max_chars)
+            cut = cut + 1 if cut > start else start + max_chars
+            spans.append([start, cut])
+            start = cut
+        if start < end:
+            spans.append([start, end])
+
+    merged = []
+    for start, end in spans:
+        if merged and merged[-1][1] - merged[-1][0] < min_chars and end - merged[-1][0] <= max_chars:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [tuple(span) for span in merged]
+
+
+def build_paragraph_index(conn, table_name, columns, rebuild=True):
+    """預先計算每份判決的段落位置（UTF-8 位元組偏移），並為段落建立 contentless FTS5 trigram 索引
+
+    段落文字不另外保存：索引只存 trigram，擷取時依位元組偏移讀取原表欄位（或解壓縮後全文）的片段。
+    段落的 id 與 FTS 的 rowid 相同，依 (case_id, id) 索引查出某案件的段落；
+    同一個 case_id 可能出現在不相鄰的多行，因此段落 id 不一定連續。
+    rebuild=False 時若索引已存在則直接跳過。回傳是否有（重新）建立索引。
+    """
+    paragraphs = quote_identifier(paragraph_table_name(table_name))
+    fts = quote_identifier(paragraph_fts_name(table_name))
+    if not rebuild and conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (paragraph_table_name(table_name),)
+    ).fetchone():
+        return False
+
+    conn.execute(f"DROP TABLE IF EXISTS {paragraphs}")
+    conn.execute(f"DROP TABLE IF EXISTS {fts}")
+    if 'case_id' not in columns or SNIPPET_TEXT_COLUMN not in columns:
+        return False
+
+    conn.execute(f"""
+        CREATE TABLE {paragraphs} (
+            id INTEGER PRIMARY KEY,
+            source_rowid INTEGER NOT NULL,
+            case_id TEXT NOT NULL,
+            paragraph INTEGER NOT NULL,
+            start INTEGER NOT NULL,
+            length INTEGER NOT NULL
+        )
+    """)
+    conn.execute(f"CREATE VIRTUAL TABLE {fts} USING fts5(text, content='', tokenize='trigram')")
+
+    next_id = 1
+    cursor = conn.execute(
+        f"SELECT rowid, case_id, {text_expression(conn, table_name, SNIPPET_TEXT_COLUMN)} "
+        f"FROM {quote_identifier(table_name)} "
+        f"WHERE case_id IS NOT NULL ORDER BY rowid"
+    )
+    # 分批讀取與寫入，記憶體用量只和批次大小有關
+    while batch := cursor.fetchmany(256):
+        positions, texts = [], []
+        for rowid, case_id, text in batch:
+            text = str(text or '')
+            byte_offset, char_offset = 0, 0
+            for number, (start, end) in enumerate(split_paragraphs(text), 1):
+                byte_offset += len(text[char_offset:start].encode('utf-8'))
+                paragraph = text[start:end]
+                length = len(paragraph.encode('utf-8'))
+                positions.append((next_id, rowid, str(case_id), number, byte_offset, length))
+                texts.append((next_id, paragraph))
+                byte_offset += length
+                char_offset = end
+                next_id += 1
+        conn.executemany(f"INSERT INTO {paragraphs} VALUES (?, ?, ?, ?, ?, ?)", positions)
+        conn.executemany(f"INSERT INTO {fts}(rowid, text) VALUES (?, ?)", texts)
+    conn.execute(
+        f"CREATE INDEX {quote_identifier(paragraph_table_name(table_name) + '_case')} ON {paragraphs} (case_id, id)"
+    )
+    return True
+
+
+def drop_paragraph_index(conn, table_name):
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(paragraph_table_name(table_name))}")
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(paragraph_fts_name(table_name))}")
+
+
+def paragraph_tables(conn):
+    """回傳資料庫中有段落索引的原始表格名稱"""
+    prefix = paragraph_table_name('')
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\' ORDER BY name",
+        (prefix.replace('_', '\\_') + '%',),
+    )
+    return [name[len(prefix):] for (name,) in rows]
+
+
+def read_paragraph(conn, table_name, source_rowid, start, length):
+    """以 incremental blob I/O 直接讀取欄位中 [start, start + length) 的位元組，不讀取整份全文"""
+    with conn.blobopen(table_name, SNIPPET_TEXT_COLUMN, source_rowid, readonly=True) as blob:
+        blob.seek(start)
+        return blob.read(length).decode('utf-8', errors='replace')
+
+
+def paragraph_reader(conn, table_name):
+    """回傳讀取段落的函式 (source_rowid, start, length) -> 文字
+
+    全文為一般欄位時以 incremental blob I/O 只讀取該段；全文已壓縮時，
+    每份判決（只有本次查詢的案件）解壓縮一次，之後的段落直接切片。
+    """
+    if not is_compressed(conn, table_name):
+        return lambda source_rowid, start, length: read_paragraph(conn, table_name, source_rowid, start, length)
+    bodies = {}
+
+    def read(source_rowid, start, length):
+        if source_rowid not in bodies:
+            bodies[source_rowid] = read_body_bytes(conn, table_name, source_rowid) or b''
+        return bodies[source_rowid][start:start + length].decode('utf-8', errors='replace')
+    return read
+
+
+def highlight(text, terms):
+    for term in sorted(terms, key=len, reverse=True):
+        text = text.replace(term, f"【{term}】")
+    return ' '.join(text.split())
+
+
+def find_snippets(conn, table_name, case_id, terms, limit=3):
+    """找出某個案件中與關鍵字最相關的段落
+
+    長度 >= 3 的關鍵字以段落 FTS 索引依 bm25 排序，排序前就以 case_id 過濾，
+    只在該案件的段落中取前 limit 段（rowid 範圍只用來縮小 FTS 要讀的 doclist）；
+    只有短關鍵字時，讀取該案件的段落逐段計算出現次數。
+    回傳 (段落總數, [(段落編號, 文字)])，依段落在判決中的順序排列；案件不存在時回傳 None。
+    """
+    paragraphs = quote_identifier(paragraph_table_name(table_name))
+    fts = quote_identifier(paragraph_fts_name(table_name))
+    rows = conn.execute(
+        f"SELECT id, source_rowid, paragraph, start, length FROM {paragraphs} WHERE case_id = ? ORDER BY id",
+        (str(case_id),),
+    ).fetchall()
+    if not rows:
+        return None
+    by_id = {row[0]: row for row in rows}
+
+    read = paragraph_reader(conn, table_name)
+    long_terms = [term for term in terms if len(term) >= TRIGRAM_MIN_LENGTH]
+    scored = []
+    if long_terms:
+        query = ' OR '.join('"' + term.replace('"', '""') + '"' for term in long_terms)
+        scored = conn.execute(
+            f"SELECT rowid FROM {fts} WHERE {fts} MATCH ? AND rowid BETWEEN ? AND ? "
+            f"AND rowid IN (SELECT id FROM {paragraphs} WHERE case_id = ?) "
+            f"ORDER BY bm25({fts}) LIMIT ?",
+            (query, rows[0][0], rows[-1][0], str(case_id), int(limit)),
+        ).fetchall()
+        selected = [by_id[rowid] for (rowid,) in scored]
+    else:
+        counts = []
+        for row in rows:
+            text = read(row[1], row[3], row[4])
+            hits = sum(text.count(term) for term in terms)
+            if hits:
+                counts.append((-hits, row[0], row))
+        selected = [row for _, _, row in sorted(counts)[:limit]]
+
+    snippets = []
+    for _, source_rowid, number, start, length in sorted(selected):
+        snippets.append((number, highlight(read(source_rowid, start, length), terms)))
+    return len(rows), snippets
+
+
+def format_snippets(table_name, case_id, terms, total, snippets):
+    """將段落擷取結果轉成回饋給 AI 的文字"""
+    if not snippets:
+        return f"SNIPPET 結果 ({table_name}, case_id={case_id}, 關鍵字: {' '.join(terms)}): 判決中沒有包含關鍵字的段落"
+    lines = [f"SNIPPET 結果 ({table_name}, case_id={case_id}, 關鍵字: {' '.join(terms)}, "
+             f"判決共 {total} 段, 顯示最相關的 {len(snippets)} 段):"]
+    for number, text in snippets:
+        lines.append(f"[第 {number} 段] {text}")
+    return "\n".join(lines)
+
+
+def parse_snippet_query(text):
+    """SNIPPET 動作參數：case_id 後接關鍵字，回傳 (case_id, terms)"""
+    parts = text.strip().split(None, 1)
+    case_id = parts[0] if parts else ''
+    return case_id, split_terms(parts[1]) if len(parts) > 1 else []
@@ -0,0 +1,174 @@
+import re
+import time
+import sqlite3
+from contextlib import contextmanager
+from telemetry import metrics
+from bodies import BODY_COLUMN, BODY_FUNCTION, body_tables
+
+# AI 的 SQL 允許使用的 PRAGMA（只讀取表格結構）
+READ_PRAGMAS = {'table_info', 'table_xinfo', 'index_list', 'index_info', 'index_xinfo', 'foreign_key_list'}
+# 允許的 authorizer 動作：讀取、查詢、函式與遞迴 CTE
+_ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+_ACTION_NAMES = {
+    getattr(sqlite3, f"SQLITE_{name}"): name.replace('_', ' ')
+    for name in ('INSERT', 'UPDATE', 'DELETE', 'ATTACH', 'DETACH', 'TRANSACTION', 'SAVEPOINT', 'ALTER_TABLE',
+                 'ANALYZE', 'REINDEX', 'CREATE_TABLE', 'CREATE_INDEX', 'CREATE_VIEW', 'CREATE_TRIGGER',
+                 'CREATE_TEMP_TABLE', 'CREATE_TEMP_INDEX', 'CREATE_TEMP_VIEW', 'CREATE_TEMP_TRIGGER',
+                 'CREATE_VTABLE', 'DROP_TABLE', 'DROP_INDEX', 'DROP_VIEW', 'DROP_TRIGGER', 'DROP_TEMP_TABLE',
+                 'DROP_TEMP_INDEX', 'DROP_TEMP_VIEW', 'DROP_TEMP_TRIGGER', 'DROP_VTABLE')
+}
+# 全文已壓縮的表格在查詢連線上是同名的 TEMP VIEW，對它的 DROP 在 authorizer 中會以 TEMP 動作出現，
+# 回報原因時改用 AI 實際寫的（非 TEMP）動作名稱
+_SHADOWED_ACTIONS = {
+    sqlite3.SQLITE_DROP_TEMP_TABLE: sqlite3.SQLITE_DROP_TABLE,
+    sqlite3.SQLITE_DROP_TEMP_VIEW: sqlite3.SQLITE_DROP_VIEW,
+}
+# FROM / JOIN 後的表格名稱與別名，用來把查詢計畫中的別名對回表格
+_TABLE_REFERENCE = re.compile(
+    r'\b(?:FROM|JOIN)\s+(?:"([^"]+)"|`([^`]+)`|\[([^\]]+)\]|(\w+))(?:\s+(?:AS\s+)?(?!(?:ON|USING|WHERE|JOIN|LEFT|'
+    r'RIGHT|INNER|OUTER|CROSS|NATURAL|GROUP|ORDER|LIMIT|UNION|EXCEPT|INTERSECT|WINDOW|HAVING)\b)(\w+))?',
+    re.IGNORECASE,
+)
+
+# 語句以 LIMIT 結尾（不含 OFFSET）時，SQLite 取到足夠的行就會停止掃描
+_TRAILING_LIMIT = re.compile(r'\bLIMIT\s+\d+\s*;?\s*$', re.IGNORECASE)
+# 需要先讀完所有輸入行才能輸出的 VM 指令：排序、聚合 / 視窗函式與暫存 B-tree（DISTINCT、GROUP BY 等）
+_BLOCKING_OPCODES = ('Sort', 'Sorter', 'Agg', 'OpenEphemeral')
+
+SQL_REJECTED = metrics.counter('agent_sql_rejected_total', "被防護機制拒絕或中斷的 SQL 查詢數，依原因分類")
+
+
+class QueryRejected(Exception):
+    """SQL 查詢被拒絕或中斷；訊息即回饋給 AI 的原因"""
+
+    def __init__(self, kind, message):
+        super().__init__(message)
+        self.kind = kind
+
+
+def _authorizer(denied, body_reads, shadowed=frozenset()):
+    def authorize(action, arg1, arg2, db_name, trigger):
+        if action == sqlite3.SQLITE_READ and arg2 == BODY_COLUMN:
+            body_reads.add(arg1)
+        elif action == sqlite3.SQLITE_FUNCTION and arg2 == BODY_FUNCTION and trigger is None:
+            # 直接呼叫 judgement_body（不是經由全文 view 展開）可讀取任何表格的全文
+            body_reads.add('*')
+        if action in _ALLOWED_ACTIONS:
+            return sqlite3.SQLITE_OK
+        if action == sqlite3.SQLITE_PRAGMA and arg1 and arg1.lower() in READ_PRAGMAS:
+            return sqlite3.SQLITE_OK
+        if action in (sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE) \
+                and arg1 in ('sqlite_master', 'sqlite_temp_master'):
+            # CREATE / DROP 會先修改 sqlite_master，之後的 CREATE_* / DROP_* 一定會被拒絕，以後者作為原因
+            return sqlite3.SQLITE_OK
+        if action == sqlite3.SQLITE_PRAGMA:
+            denied.append(f"PRAGMA {arg1}")
+        else:
+            if action in _SHADOWED_ACTIONS and arg1 in shadowed:
+                action = _SHADOWED_ACTIONS[action]
+            name = _ACTION_NAMES.get(action, f"寫入或結構變更（代碼 {action}）")
+            denied.append(f"{name} {arg1}" if arg1 else name)
+        return sqlite3.SQLITE_DENY
+    return authorize
+
+
+def large_tables(table_sizes, max_rows, max_bytes):
+    """table_sizes 為 {表格: (行數, 位元組)}，回傳超過任一上限的表格集合"""
+    return {table for table, (rows, size) in table_sizes.items() if rows >= max_rows or size >= max_bytes}
+
+
+def table_aliases(sql):
+    """回傳 {別名或表格名稱: 表格名稱}"""
+    aliases = {}
+    for match in _TABLE_REFERENCE.finditer(sql):
+        table = next(group for group in match.groups()[:4] if group)
+        aliases[table] = table
+        if match.group(5):
+            aliases[match.group(5)] = table
+    return aliases
+
+
+def stops_at_limit(conn, sql):
+    """語句以 LIMIT 結尾且執行計畫中沒有排序、聚合或暫存 B-tree 時回傳 True
+
+    這類查詢邊讀邊輸出，取到 LIMIT 行就停止，例如 SELECT * FROM 表格 LIMIT 2。
+    """
+    if not _TRAILING_LIMIT.search(sql):
+        return False
+    return not any(opcode.startswith(_BLOCKING_OPCODES) for _, opcode, *_ in conn.execute(f"EXPLAIN {sql}"))
+
+
+def find_full_scans(conn, sql, tables, body_reads=frozenset()):
+    """以 EXPLAIN QUERY PLAN 找出查詢中對 tables 的全表掃描（含建立自動索引時的掃描）
+
+    虛擬表格（全文索引）不算；走覆蓋索引的掃描也不算，除非查詢會讀取該表格的判決全文
+    （body_reads 中有該表格，或有 '*' 表示直接呼叫 judgement_body）：全文已壓縮時覆蓋索引
+    只涵蓋中繼資料欄位，每一行仍要解壓縮全文。取到 LIMIT 行就停止的查詢（見 stops_at_limit）
+    也不算，有 WHERE 條件時最壞仍可能讀完整個表格，由 guard_query 的指令預算與時間上限把關。
+    回傳被全表掃描的表格名稱列表。
+    """
+    aliases = table_aliases(sql)
+    limited = stops_at_limit(conn, sql)
+    scans = []
+    for _, _, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+        words = detail.split()
+        if len(words) < 2 or 'VIRTUAL TABLE' in detail:
+            continue
+        # 經由 view 展開的表格會帶 main. 前綴
+        name = words[1].removeprefix('main.')
+        table = aliases.get(name, name)
+        reads_body = table in body_reads or '*' in body_reads
+        full_scan = words[0] == 'SCAN' and ('COVERING INDEX' not in detail or reads_body) and not limited
+        if not (full_scan or 'AUTOMATIC' in detail):
+            continue
+        if table in tables and table not in scans:
+            scans.append(table)
+    return scans
+
+
+@contextmanager
+def guard_query(conn, max_instructions, timeout, check_every=1000):
+    """在區塊內為連線安裝 authorizer 與 progress handler
+
+    - authorizer 只允許讀取類的語句，其餘在準備語句時就被拒絕
+    - progress handler 每 check_every 個 VM 指令檢查一次，超過指令預算或時間上限時中斷查詢
+    被拒絕或中斷時丟出 QueryRejected；離開區塊時移除兩個 callback，連線可繼續給其他動作使用。
+    區塊取得的集合會記錄準備語句時讀取到判決全文的表格，交給 reject_full_scans 判斷覆蓋索引掃描。
+    """
+    denied = []
+    body_reads = set()
+    state = {"instructions": 0, "reason": None}
+    deadline = time.monotonic() + timeout
+
+    def progress():
+        state["instructions"] += check_every
+        if state["instructions"] > max_instructions:
+            state["reason"] = ('budget', f"查詢超過 {max_instructions:,} 個指令的預算，已中斷")
+        elif time.monotonic() > deadline:
+            state["reason"] = ('timeout', f"查詢超過 {timeout} 秒的時間上限，已中斷")
+        return 1 if state["reason"] else 0
+
+    conn.set_authorizer(_authorizer(denied, body_reads, set(body_tables(conn))))
+    conn.set_progress_handler(progress, check_every)
+    try:
+        yield body_reads
+    except sqlite3.DatabaseError as e:
+        if state["reason"]:
+            kind, message = state["reason"]
+        elif denied:
+            kind, message = 'not_allowed', f"只允許唯讀查詢（SELECT / WITH），不允許 {'、'.join(dict.fromkeys(denied))}"
+        else:
+            raise
+        SQL_REJECTED.inc(reason=kind)
+        raise QueryRejected(kind, message) from e
+    finally:
+        conn.set_authorizer(None)
+        conn.set_progress_handler(None, 0)
+
+
+def reject_full_scans(conn, sql, tables, body_reads=frozenset()):
+    """查詢會全表掃描大型表格時丟出 QueryRejected"""
+    scans = find_full_scans(conn, sql, tables, body_reads)
+    if scans:
+        SQL_REJECTED.inc(reason='full_scan')
+        raise QueryRejected('full_scan', f"查詢會全表掃描大型表格 {', '.join(scans)}")
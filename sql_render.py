@@ -0,0 +1,92 @@
+import re
+import unicodedata
+
+# 可以包成子查詢再加上 LIMIT 的語句開頭
+_WRAPPABLE = re.compile(r'^\s*(?:--[^\n]*\n\s*|/\*.*?\*/\s*)*(SELECT|WITH|VALUES)\b', re.IGNORECASE | re.DOTALL)
+
+
+def strip_statement(sql):
+    """去除結尾的分號與空白，方便包成子查詢"""
+    return sql.strip().rstrip(';').strip()
+
+
+def is_wrappable(sql):
+    return bool(_WRAPPABLE.match(sql))
+
+
+def display_width(text):
+    """字串在等寬字型下的顯示寬度，全形字元算兩格"""
+    return sum(2 if unicodedata.east_asian_width(ch) in ('W', 'F') else 1 for ch in text)
+
+
+def pad(text, width):
+    return text + ' ' * max(width - display_width(text), 0)
+
+
+def format_cell(value, max_column_length):
+    """將欄位值轉為單行文字，超過長度時截斷"""
+    if value is None:
+        return 'None'
+    text = str(value)
+    if len(text) > max_column_length:
+        text = text[:max_column_length] + '...'
+    # 判決書內有大量換行與空白，壓成單一空白以節省篇幅
+    return ' '.join(text.split())
+
+
+def fetch_preview(conn, sql, max_rows=5, count_remaining=False):
+    """執行查詢但最多只取回 max_rows + 1 行，用來判斷是否還有更多資料
+
+    SELECT / WITH / VALUES 語句會包成子查詢加上 LIMIT，讓 SQLite 提早停止；
+    其他語句（如 PRAGMA）則以 fetchmany 限制取回的行數。
+    回傳 (columns, rows, total)，total 只有在 count_remaining=True 且超過 max_rows 時才會計算，否則為 None。
+    """
+    sql = strip_statement(sql)
+    wrappable = is_wrappable(sql)
+    if wrappable:
+        cursor = conn.execute(f"SELECT * FROM (\n{sql}\n) LIMIT {int(max_rows) + 1}")
+    else:
+        cursor = conn.execute(sql)
+    columns = [desc[0] for desc in cursor.description] if cursor.description else []
+    rows = cursor.fetchmany(max_rows + 1) if columns else []
+    cursor.close()
+
+    total = None
+    if len(rows) > max_rows:
+        rows = rows[:max_rows]
+        if count_remaining and wrappable:
+            total = conn.execute(f"SELECT COUNT(*) FROM (\n{sql}\n)").fetchone()[0]
+    else:
+        total = len(rows)
+    return columns, rows, total
+
+
+def render_rows(columns, rows, max_column_length=2000, max_total_length=5000, max_pad_width=40):
+    """將查詢結果排成對齊的文字表格，超過總字數限制時停止輸出後續的行
+
+    欄寬最多對齊到 max_pad_width，避免一個長文字欄位讓其他每一行都補滿空白。
+    """
+    cells = [[format_cell(value, max_column_length) for value in row] for row in rows]
+    index_width = len(str(max(len(rows) - 1, 0)))
+    widths = [display_width(str(col)) for col in columns]
+    for row in cells:
+        for i, cell in enumerate(row):
+            widths[i] = max(widths[i], display_width(cell))
+    widths = [min(width, max_pad_width) for width in widths]
+
+    header = ' ' * index_width + '  ' + '  '.join(pad(str(col), widths[i]) for i, col in enumerate(columns))
+    lines = [header.rstrip()]
+    length = len(lines[0])
+    truncated = False
+    for n, row in enumerate(cells):
+        line = str(n).ljust(index_width) + '  ' + '  '.join(pad(cell, widths[i]) for i, cell in enumerate(row))
+        lines.append(line.rstrip())
+        length += len(line) + 1
+        if length > max_total_length:
+            truncated = True
+            break
+
+    result = "\n".join(lines)
+    if truncated or len(result) > max_total_length:
+        result = result[:max_total_length] + f"\n... (超過 {max_total_length} 字元限制)"
+    return result
@@ -0,0 +1,165 @@
+import re
+from collections import defaultdict
+from search import quote_identifier
+from law_index import extract_articles, format_article
+
+# 可以查詢的統計維度與其來源欄位；表格必須有 case_id 與 guilty（逐案逐爭點的資料）才會建立統計
+STATS_DIMENSIONS = {
+    'issue_type': 'issue_type',
+    'law': 'law_articles',
+    'court': 'court',
+    'year': 'judgement_date',
+}
+# 全部資料的總計以此維度名稱存放
+STATS_TOTAL = 'all'
+
+
+def stats_table_name(table_name):
+    """統計表名稱，以底線開頭避免出現在給 AI 的表格清單中"""
+    return f"_stats_{table_name}"
+
+
+def split_law_articles(text):
+    """將 law_articles 欄位拆成正規化後的法條（只到「條」，例如 刑法第339條之4）"""
+    return [format_article(law, article) for law, article in dict.fromkeys(extract_articles(text))]
+
+
+def judgement_year(text):
+    """從裁判日期取出西元年，支援 2024/11/29 與 民國 113 年 兩種寫法"""
+    text = str(text or '')
+    if match := re.search(r'(\d{4})', text):
+        return match.group(1)
+    if match := re.search(r'(\d{2,3})\s*年', text):
+        return str(int(match.group(1)) + 1911)
+    return None
+
+
+def _dimension_values(dimension, value):
+    if dimension == 'law':
+        return split_law_articles(value)
+    if dimension == 'year':
+        year = judgement_year(value)
+        return [year] if year else []
+    value = str(value).strip() if value is not None else ''
+    return [value] if value else []
+
+
+def _is_guilty(value):
+    """回傳 True / False，無法判斷時回傳 None"""
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    if text in ('1', '1.0', 'true', '有罪'):
+        return True
+    if text in ('0', '0.0', 'false', '無罪'):
+        return False
+    return None
+
+
+def build_stats_table(conn, table_name, columns, rebuild=True):
+    """依爭點、法條、法院與年份計算有罪/無罪件數與有罪率，存成統計表
+
+    每一行資料（一個案件的一個爭點）計入一次；cases 為不重複的 case_id 數。
+    rebuild=False 時若統計表已存在則直接跳過。回傳是否有（重新）建立統計表。
+    """
+    stats = quote_identifier(stats_table_name(table_name))
+    dimensions = {dim: col for dim, col in STATS_DIMENSIONS.items() if col in columns}
+    if not rebuild and conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (stats_table_name(table_name),)
+    ).fetchone():
+        return False
+
+    conn.execute(f"DROP TABLE IF EXISTS {stats}")
+    if 'case_id' not in columns or 'guilty' not in columns:
+        return False
+
+    source_columns = ['case_id', 'guilty'] + list(dimensions.values())
+    counts = defaultdict(lambda: [0, 0, 0, set()])
+    cursor = conn.execute(
+        f"SELECT {', '.join(quote_identifier(col) for col in source_columns)} FROM {quote_identifier(table_name)}"
+    )
+    for row in cursor:
+        case_id, guilty = row[0], _is_guilty(row[1])
+        keys = [(STATS_TOTAL, '全部')]
+        for (dimension, _), value in zip(dimensions.items(), row[2:]):
+            keys += [(dimension, item) for item in dict.fromkeys(_dimension_values(dimension, value))]
+        for key in keys:
+            entry = counts[key]
+            entry[0] += 1
+            if guilty is True:
+                entry[1] += 1
+            elif guilty is False:
+                entry[2] += 1
+            entry[3].add(case_id)
+
+    conn.execute(f"""
+        CREATE TABLE {stats} (
+            dimension TEXT NOT NULL,
+            value TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            guilty INTEGER NOT NULL,
+            not_guilty INTEGER NOT NULL,
+            guilty_rate REAL,
+            cases INTEGER NOT NULL,
+            PRIMARY KEY (dimension, value)
+        ) WITHOUT ROWID
+    """)
+    conn.executemany(
+        f"INSERT INTO {stats} VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (dimension, value, total, guilty, not_guilty,
+             round(guilty / (guilty + not_guilty), 4) if guilty + not_guilty else None, len(cases))
+            for (dimension, value), (total, guilty, not_guilty, cases) in counts.items()
+        ],
+    )
+    return True
+
+
+def drop_stats_table(conn, table_name):
+    conn.execute(f"DROP TABLE IF EXISTS {quote_identifier(stats_table_name(table_name))}")
+
+
+def stats_tables(conn):
+    """回傳資料庫中所有統計表對應的原始表格名稱"""
+    prefix = stats_table_name('')
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\' ORDER BY name",
+        (prefix.replace('_', '\\_') + '%',),
+    )
+    return [name[len(prefix):] for (name,) in rows]
+
+
+def query_stats(conn, table_name, dimension, value_filter=None, limit=20):
+    """查詢統計表，依件數由多到少排序；value_filter 為數值的部分字串
+
+    回傳 (column_names, rows, group_count)。
+    """
+    stats = quote_identifier(stats_table_name(table_name))
+    where = "dimension = ?"
+    params = [dimension]
+    if value_filter:
+        where += " AND value LIKE ?"
+        params.append(f"%{value_filter}%")
+    group_count = conn.execute(f"SELECT COUNT(*) FROM {stats} WHERE {where}", params).fetchone()[0]
+    order = "value" if dimension == 'year' else "total DESC, value"
+    rows = conn.execute(
+        f"SELECT value, total, guilty, not_guilty, guilty_rate, cases FROM {stats} "
+        f"WHERE {where} ORDER BY {order} LIMIT ?",
+        params + [int(limit)],
+    ).fetchall()
+    return ['value', 'total', 'guilty', 'not_guilty', 'guilty_rate', 'cases'], rows, group_count
+
+
+def format_stats_results(table_name, dimension, value_filter, rows, group_count):
+    """將統計結果轉成回饋給 AI 的精簡文字"""
+    target = f"{dimension}" + (f" 包含「{value_filter}」" if value_filter else '')
+    if not rows:
+        return f"STATS 結果 ({table_name}, {target}): 沒有符合的統計資料"
+    lines = [
+        f"STATS 結果 ({table_name}, 依 {target} 分組, 共 {group_count} 組, 顯示 {len(rows)} 組):",
+        "值 | 件數 | 有罪 | 無罪 | 有罪率 | 案件數",
+    ]
+    for value, total, guilty, not_guilty, guilty_rate, cases in rows:
+        rate = f"{guilty_rate:.0%}" if guilty_rate is not None else '-'
+        lines.append(f"{value} | {total} | {guilty} | {not_guilty} | {rate} | {cases}")
+    return "\n".join(lines)
@@ -0,0 +1,83 @@
+# AI 回應格式中使用的標籤（strategy 為前端相容保留）
+STREAM_TAGS = ('think', 'strategy', 'action', 'if_finish', 'content')
+
+
+class TagStreamParser:
+    """增量解析串流中的 <think> / <action> / <if_finish> / <content> 標籤
+
+    每次 feed() 傳入新收到的文字片段，回傳可立即送出的事件：
+    - {"event": "open", "tag": 名稱}
+    - {"event": "text", "tag": 名稱, "text": 新增的文字}
+    - {"event": "close", "tag": 名稱, "text": 標籤內完整文字}
+    每個字元只掃描一次；被切在片段邊界的標籤會暫存到下一個片段再判斷。標籤外的文字會被忽略。
+    """
+
+    def __init__(self, tags=STREAM_TAGS):
+        self.tags = tags
+        self._open_tags = [f"<{tag}>" for tag in tags]
+        self.buffer = ''
+        self.current = None
+        self.parts = []
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        events = []
+        while self.buffer:
+            if self.current is None:
+                start = self.buffer.find('<')
+                if start == -1:
+                    self.buffer = ''
+                    break
+                self.buffer = self.buffer[start:]
+                end = self.buffer.find('>')
+                if end == -1:
+                    # 可能是被切斷的開始標籤，保留到下一個片段
+                    if any(tag.startswith(self.buffer) for tag in self._open_tags):
+                        break
+                    self.buffer = self.buffer[1:]
+                    continue
+                name = self.buffer[1:end]
+                if name in self.tags:
+                    self.buffer = self.buffer[end + 1:]
+                    self.current = name
+                    self.parts = []
+                    events.append({"event": "open", "tag": name})
+                else:
+                    self.buffer = self.buffer[1:]
+                continue
+
+            close_tag = f"</{self.current}>"
+            end = self.buffer.find(close_tag)
+            if end != -1:
+                self._emit_text(self.buffer[:end], events)
+                events.append({"event": "close", "tag": self.current, "text": ''.join(self.parts)})
+                self.buffer = self.buffer[end + len(close_tag):]
+                self.current = None
+                continue
+
+            # 結尾可能是被切斷的結束標籤，只送出確定屬於內容的部分
+            keep = 0
+            last = self.buffer.rfind('<')
+            if last != -1 and close_tag.startswith(self.buffer[last:]):
+                keep = len(self.buffer) - last
+            self._emit_text(self.buffer[:len(self.buffer) - keep], events)
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            break
+        return events
+
+    def _emit_text(self, text, events):
+        if text:
+            self.parts.append(text)
+            events.append({"event": "text", "tag": self.current, "text": text})
+
+    def close(self):
+        """串流結束時呼叫：未閉合的標籤以目前內容結束
+
+        暫存的只會是被切斷的結束標籤（如 "</thi"），串流已結束就直接捨棄，不當成內容送出。
+        """
+        events = []
+        if self.current is not None:
+            events.append({"event": "close", "tag": self.current, "text": ''.join(self.parts)})
+            self.current = None
+        self.buffer = ''
+        return events
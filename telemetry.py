@@ -0,0 +1,271 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+from config import LOG_LEVEL, LOG_FORMAT, PROMPT_DUMP
+
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+# 延遲直方圖的上界（秒）
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CYCLE_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+TOKEN_BUCKETS = (1000, 2500, 5000, 10000, 20000, 40000, 80000, 160000)
+
+_log_lock = threading.Lock()
+
+
+def log(level, event, message='', **fields):
+    """分級的結構化紀錄：text 格式為「[INFO] 訊息 (key=value ...)」，json 格式每行一個 JSON 物件
+
+    低於 config.LOG_LEVEL 的紀錄直接略過，不會組字串。
+    """
+    if LOG_LEVELS[level] < LOG_LEVELS.get(LOG_LEVEL, 20):
+        return
+    if LOG_FORMAT == 'json':
+        line = json.dumps({"ts": round(time.time(), 3), "level": level, "event": event,
+                           "message": message, **fields}, ensure_ascii=False, default=str)
+    else:
+        extra = ' '.join(f"{key}={value}" for key, value in fields.items())
+        line = f"[{level.upper()}] {message or event}" + (f" ({extra})" if extra else '')
+    with _log_lock:
+        print(line)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """只增不減的計數器，可帶標籤"""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """可增可減的即時數值（例如佇列深度），可帶標籤"""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """累積分桶的直方圖（Prometheus 格式），可帶標籤"""
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} "
+                                 f"{cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """收集所有指標並輸出 Prometheus 文字格式
+
+    除了 Counter / Gauge / Histogram 之外，可註冊在輸出時才讀取的快取統計（例如 LRUCache.stats）。
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation):
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation):
+        metric = Gauge(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_cache(self, name, stats):
+        """stats 為回傳含 hits / misses 的 dict 的函式；同名的快取會被取代"""
+        with self._lock:
+            self._caches[name] = stats
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        with self._lock:
+            caches = sorted(self._caches.items())
+        cache_stats = [(name, stats()) for name, stats in caches]
+        for metric, kind, documentation, value in (
+                ('agent_cache_hits_total', 'counter', "快取命中次數", lambda s: s["hits"]),
+                ('agent_cache_misses_total', 'counter', "快取未命中次數", lambda s: s["misses"]),
+                ('agent_cache_hit_ratio', 'gauge', "快取命中率", lambda s: s["hit_rate"]),
+        ):
+            lines += [f"# HELP {metric} {documentation}", f"# TYPE {metric} {kind}"]
+            lines += [f"{metric}{_format_labels((('cache', name),))} {_format_value(value(stats))}"
+                      for name, stats in cache_stats]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+SPAN_SECONDS = metrics.histogram('agent_span_seconds', "每個循環各階段（llm、parse、history 與各種動作）的耗時")
+CYCLE_SECONDS = metrics.histogram('agent_cycle_seconds', "每次 think 循環（組 prompt、LLM、解析、寫入歷史）的耗時")
+LLM_TOKENS = metrics.counter('agent_llm_tokens_total', "LLM 使用的 token 數（依 response.usage）")
+LLM_REQUESTS = metrics.counter('agent_llm_requests_total', "LLM 請求數，依回應來源分類")
+QUESTION_SECONDS = metrics.histogram('agent_question_seconds', "每個問題從提問到結束的時間")
+QUESTION_CYCLES = metrics.histogram('agent_question_cycles', "每個問題使用的循環數", CYCLE_BUCKETS)
+QUESTION_TOKENS = metrics.histogram('agent_question_tokens', "每個問題使用的 token 總數", TOKEN_BUCKETS)
+QUESTIONS = metrics.counter('agent_questions_total', "結束的問題數，依結束原因分類")
+
+
+class CycleTrace:
+    """一次 think 循環的追蹤：記錄各階段 span 的耗時與 LLM token 數
+
+    動作在循環結束後才執行，其 span 仍記在產生該動作的循環底下；多個動作並行時可由不同執行緒同時記錄。
+    """
+
+    def __init__(self, session_id, cycle):
+        self.session_id = session_id
+        self.cycle = cycle
+        self.started = time.perf_counter()
+        self.spans = []
+        self.usage = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self.spans.append((name, seconds))
+            SPAN_SECONDS.observe(seconds, span=name)
+            log('debug', 'span', f"{name} 耗時 {seconds * 1000:.1f} ms",
+                session=self.session_id, cycle=self.cycle, span=name, seconds=round(seconds, 4))
+
+    def record_usage(self, usage, source):
+        self.usage = usage
+        LLM_REQUESTS.inc(source=source)
+        LLM_TOKENS.inc(usage["prompt_tokens"], type='prompt')
+        LLM_TOKENS.inc(usage["completion_tokens"], type='completion')
+
+    def finish(self):
+        """循環（不含之後的動作）結束時呼叫，記錄循環耗時並輸出摘要"""
+        seconds = time.perf_counter() - self.started
+        CYCLE_SECONDS.observe(seconds)
+        with self._lock:
+            spans = {name: round(value, 4) for name, value in self.spans}
+        usage = self.usage or {}
+        log('info', 'cycle', f"循環 #{self.cycle} 完成，耗時 {seconds * 1000:.1f} ms",
+            session=self.session_id, cycle=self.cycle, seconds=round(seconds, 4),
+            prompt_tokens=usage.get("prompt_tokens"), completion_tokens=usage.get("completion_tokens"), **spans)
+        return seconds
+
+
+class QuestionTrace:
+    """一個問題（從使用者提問到 finish）的累計循環數、token 數與耗時"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.cycles = 0
+        self.tokens = 0
+
+    def add_cycle(self, usage):
+        self.cycles += 1
+        self.tokens += usage["total_tokens"]
+
+    def finish(self, outcome):
+        seconds = time.perf_counter() - self.started
+        QUESTION_SECONDS.observe(seconds)
+        QUESTION_CYCLES.observe(self.cycles)
+        QUESTION_TOKENS.observe(self.tokens)
+        QUESTIONS.inc(outcome=outcome)
+        log('info', 'question', f"問題結束（{outcome}），共 {self.cycles} 個循環",
+            session=self.session_id, outcome=outcome, cycles=self.cycles, tokens=self.tokens,
+            seconds=round(seconds, 4))
+
+
+_dump_lock = threading.Lock()
+
+
+def dump_prompt(session_id, cycle, messages, sink=None):
+    """除錯用：輸出完整 prompt；sink 為 'stdout' 或檔案路徑（附加寫入），預設使用 config.PROMPT_DUMP"""
+    sink = sink or PROMPT_DUMP or 'stdout'
+    lines = [f"=== 完整 Prompt (session={session_id}, 循環 #{cycle}) ==="]
+    for message in messages:
+        lines.append(f"\n[{message['role'].upper()}]")
+        lines.append(message["content"])
+    lines.append("\n=== Prompt 結束 ===\n")
+    text = "\n".join(lines)
+    with _dump_lock:
+        if sink == 'stdout':
+            print(text)
+        else:
+            with open(sink, 'a', encoding='utf-8') as f:
+                f.write(text + "\n")
@@ -0,0 +1,52 @@
+import os
+import sys
+import sqlite3
+from types import SimpleNamespace
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent import Agent  # noqa: E402
+from bodies import register_body_function, store_bodies  # noqa: E402
+from db import ConnectionManager  # noqa: E402
+from history_store import HistoryStore  # noqa: E402
+
+RAW_TABLE = 'judgement_raw_20250223_181106'
+
+
+def judgement_text(index):
+    return f"臺灣高等法院刑事判決 第 {index} 號\n\n主文\n被告犯詐欺罪。\n\n理由\n" + "交付帳戶予詐騙集團使用。" * 20
+
+
+def build_raw_table(path, rows=40, compressed=True):
+    """建立與導入流程相同形狀的判決表格：source_file / case_id / judgement_content，case_id 有索引"""
+    conn = sqlite3.connect(path)
+    conn.execute(f'CREATE TABLE "{RAW_TABLE}" (source_file TEXT, case_id TEXT, judgement_content TEXT)')
+    conn.executemany(f'INSERT INTO "{RAW_TABLE}" VALUES (?, ?, ?)',
+                     [('raw.csv', f"112-TW-{index:04d}", judgement_text(index) if index % 7 else None)
+                      for index in range(rows)])
+    conn.execute(f'CREATE INDEX "_case_idx_{RAW_TABLE}" ON "{RAW_TABLE}" (case_id)')
+    if compressed:
+        register_body_function(conn)
+        store_bodies(conn, RAW_TABLE)
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def raw_db(tmp_path):
+    """全文已壓縮的資料庫與其唯讀的 ConnectionManager"""
+    path = str(tmp_path / 'data.db')
+    build_raw_table(path)
+    manager = ConnectionManager(path)
+    manager.refresh_generation()
+    yield manager
+    manager.close()
+
+
+@pytest.fixture
+def agent(raw_db, tmp_path):
+    """使用測試資料庫的 Agent，不執行 CSV 導入也不呼叫 LLM"""
+    resources = SimpleNamespace(llm=object(), db_path=raw_db.db_path, db=raw_db,
+                                history_store=HistoryStore(str(tmp_path / 'history.db')))
+    return Agent(resources=resources)
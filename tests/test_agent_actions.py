@@ -0,0 +1,9 @@
+from conftest import RAW_TABLE
+
+
+def test_sql_count_reports_the_remaining_rows(agent):
+    query = f'SELECT case_id FROM "{RAW_TABLE}"'
+    result = agent.dispatch_action('SQL', query)
+    assert "顯示前 5 行" in result and "SQL_COUNT" in result
+    result = agent.dispatch_action('SQL_COUNT', query)
+    assert "(40 行)" in result and "還有 35 行未顯示" in result
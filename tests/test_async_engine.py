@@ -0,0 +1,83 @@
+import asyncio
+from async_engine import AsyncAgentRunner, run_answer
+
+CONTINUE = "<think>查詢</think><action>SQL SELECT 1</action><if_finish>continue</if_finish>"
+CONTINUE_WITHOUT_ACTION = "<think>再想想</think><if_finish>continue</if_finish>"
+FINISH = "<content>共 3 件</content><if_finish>finish</if_finish>"
+
+
+class ScriptedAgent:
+    """依序回傳 responses 的 Agent，記錄每次 think 的輸入與執行的動作"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.inputs = []
+        self.actions = []
+        self.last_usage = {"total_tokens": 10}
+
+    def think(self, user_input):
+        self.inputs.append(user_input)
+        return self.responses.pop(0)
+
+    async def athink(self, user_input, executor=None):
+        return self.think(user_input)
+
+    def run_actions(self, actions):
+        self.actions.append(actions)
+        return f"結果: {actions[0]}"
+
+
+def test_actions_feed_the_next_cycle():
+    agent = ScriptedAgent(CONTINUE, CONTINUE_WITHOUT_ACTION, FINISH)
+    result = run_answer(agent, "幾件詐欺案？")
+    assert agent.inputs == ["幾件詐欺案？", "結果: SQL SELECT 1", "[ORIGINAL_QUESTION] 幾件詐欺案？"]
+    assert result["reason"] == 'finish'
+    assert result["content"] == "共 3 件"
+    assert result["cycles"] == 3 and len(result["cycle_seconds"]) == 3
+    assert result["tokens"] == 30
+    assert [item["action"] for item in result["actions"]] == ["SQL SELECT 1"]
+
+
+def test_cycle_limit_and_missing_decision():
+    result = run_answer(ScriptedAgent(CONTINUE, CONTINUE, CONTINUE), "問題", max_cycles=2)
+    assert result["reason"] == 'max_cycles' and result["cycles"] == 2
+    result = run_answer(ScriptedAgent("沒有標籤的回應"), "問題")
+    assert result["reason"] == 'no_decision' and result["content"] == "沒有標籤的回應"
+
+
+def test_deadline_is_checked_between_cycles():
+    agent = ScriptedAgent(CONTINUE, FINISH)
+    result = run_answer(agent, "問題", deadline=0)
+    assert result["reason"] == 'deadline'
+    assert agent.inputs == []
+
+
+def test_async_runner_matches_the_sync_loop():
+    runner = AsyncAgentRunner()
+    try:
+        result = asyncio.run(runner.run(ScriptedAgent(CONTINUE, FINISH), "問題"))
+    finally:
+        runner.shutdown()
+    assert result["reason"] == 'finish' and result["cycles"] == 2
+    assert [item["action"] for item in result["actions"]] == ["SQL SELECT 1"]
+
+
+def test_continuing_from_a_previous_response():
+    """前端以 isProcessing 送回上一個回應時，先執行其中的動作，不把回應當成新問題"""
+    runner = AsyncAgentRunner()
+    try:
+        agent = ScriptedAgent(FINISH)
+        result = asyncio.run(runner.run(agent, "幾件詐欺案？", previous_response=CONTINUE))
+        assert agent.actions == [["SQL SELECT 1"]]
+        assert agent.inputs == ["結果: SQL SELECT 1"]
+        assert result["reason"] == 'finish' and result["content"] == "共 3 件"
+
+        agent = ScriptedAgent(FINISH)
+        result = asyncio.run(runner.run(agent, '', previous_response="[ORIGINAL_QUESTION] 幾件詐欺案？"))
+        assert agent.inputs == ["[ORIGINAL_QUESTION] 幾件詐欺案？"]
+
+        agent = ScriptedAgent()
+        result = asyncio.run(runner.run(agent, '', previous_response=FINISH))
+        assert result["response"] == FINISH and result["cycles"] == 0 and result["reason"] == 'finish'
+    finally:
+        runner.shutdown()
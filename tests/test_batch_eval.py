@@ -0,0 +1,79 @@
+import json
+import threading
+import pytest
+from batch_eval import BatchEvaluator, load_completed, load_questions, question_id
+
+
+def write_lines(path, lines):
+    path.write_text(''.join(line + "\n" for line in lines), encoding='utf-8')
+
+
+def result_line(record_id, error=None):
+    return json.dumps({"id": record_id, "question": "問題", "error": error}, ensure_ascii=False)
+
+
+def test_default_ids_follow_the_question_text(tmp_path):
+    path = tmp_path / 'questions.jsonl'
+    write_lines(path, ['"詐欺案件有幾件？"', '', '{"id": 7, "question": "竊盜呢？", "expected": "5"}'])
+    first = load_questions(path)
+    assert [item["id"] for item in first] == [question_id("詐欺案件有幾件？"), "7"]
+    assert first[1]["meta"] == {"expected": "5"}
+    # 在前面插入新問題後，既有問題的 id 不變
+    write_lines(path, ['"新的問題"', '"詐欺案件有幾件？"'])
+    assert load_questions(path)[1]["id"] == first[0]["id"]
+
+
+def test_resume_truncates_a_partial_last_line(tmp_path):
+    path = tmp_path / 'results.jsonl'
+    complete = result_line("a") + "\n" + result_line("b", error="LLMOverloaded: 佇列已滿") + "\n"
+    path.write_bytes((complete + result_line("c")[:20]).encode('utf-8'))
+    assert load_completed(str(path)) == {"a"}
+    assert path.read_bytes() == complete.encode('utf-8')
+    # 截斷後附加的結果各自在獨立的一行
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(result_line("c") + "\n")
+    assert load_completed(str(path)) == {"a", "c"}
+    assert load_completed(str(tmp_path / 'missing.jsonl')) == set()
+
+
+class GatedEvaluator(BatchEvaluator):
+    """不呼叫 LLM 的評估器：fast 以外的問題等到 gate 被設定才完成
+
+    第一次回報進度時模擬 Ctrl+C，稍後才放行進行中的問題，確保尚未開始的問題已被取消。
+    """
+
+    def __init__(self, output_path, workers):
+        super().__init__(resources=None, output_path=output_path, workers=workers)
+        self.gate = threading.Event()
+        self.answered = []
+        self.interrupted = False
+
+    def answer(self, item):
+        self.answered.append(item["id"])
+        if item["id"] != 'fast':
+            self.gate.wait(5)
+        return {"id": item["id"], "question": item["question"], "error": None,
+                "reason": 'finish', "cycles": 1, "seconds": 0.0, "tokens": 0}
+
+    def report(self, record, done, total):
+        if not self.interrupted:
+            self.interrupted = True
+            threading.Timer(0.2, self.gate.set).start()
+            raise KeyboardInterrupt
+
+
+def test_interrupt_waits_for_running_questions(tmp_path):
+    output = str(tmp_path / 'results.jsonl')
+    evaluator = GatedEvaluator(output, workers=2)
+    # fast 完成時兩個 worker 分別在回答 slow 與 next，queued 還在排隊
+    questions = [{"id": id_, "question": id_, "meta": {}} for id_ in ('fast', 'slow', 'next', 'queued')]
+    with pytest.raises(KeyboardInterrupt):
+        evaluator.run(questions)
+    # 進行中的問題完成後仍寫入結果檔，尚未開始的問題被取消
+    assert load_completed(output) == {'fast', 'slow', 'next'}
+    assert 'queued' not in evaluator.answered
+
+    resumed = GatedEvaluator(output, workers=2)
+    resumed.interrupted = True
+    resumed.gate.set()
+    assert [record["id"] for record in resumed.run(questions)] == ['queued']
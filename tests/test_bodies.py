@@ -0,0 +1,185 @@
+import sqlite3
+import zlib
+import pandas as pd
+import pytest
+import bodies
+from bodies import (BODY_COLUMN, compress_text, decompress_body, read_body, is_compressed, text_expression,
+                    apply_body_storage, register_body_function, has_body_store)
+from db import ConnectionManager
+from ingest import ingest_csv_files
+from conftest import RAW_TABLE, build_raw_table, judgement_text
+
+
+def test_compress_round_trip():
+    text = judgement_text(1)
+    blob, length, checksum = compress_text(text)
+    assert len(blob) < length
+    assert decompress_body(blob, length, checksum).decode('utf-8') == text
+
+
+def test_corrupted_body_is_detected():
+    blob, length, checksum = compress_text(judgement_text(1))
+    with pytest.raises(ValueError):
+        decompress_body(blob, length, checksum ^ 1)
+    with pytest.raises(ValueError):
+        decompress_body(zlib.compress("別的內容".encode('utf-8')), length, checksum)
+
+
+def test_store_moves_bodies_out_of_the_table(tmp_path):
+    path = str(tmp_path / 'data.db')
+    build_raw_table(path)
+    conn = sqlite3.connect(path)
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info("{RAW_TABLE}")')]
+    assert BODY_COLUMN not in columns
+    assert is_compressed(conn, RAW_TABLE)
+    rowid = conn.execute(f"SELECT rowid FROM {RAW_TABLE} WHERE case_id = '112-TW-0003'").fetchone()[0]
+    assert read_body(conn, RAW_TABLE, rowid) == judgement_text(3)
+    # 原本就沒有全文的行仍是 NULL
+    rowid = conn.execute(f"SELECT rowid FROM {RAW_TABLE} WHERE case_id = '112-TW-0007'").fetchone()[0]
+    assert read_body(conn, RAW_TABLE, rowid) is None
+    assert text_expression(conn, RAW_TABLE, BODY_COLUMN, 't') == f"judgement_body('{RAW_TABLE}', t.rowid)"
+    assert text_expression(conn, RAW_TABLE, 'case_id') == '"case_id"'
+    conn.close()
+
+
+def test_view_keeps_body_column_queryable(raw_db):
+    conn = raw_db.connection()
+    assert raw_db.schema()[RAW_TABLE] == ['source_file', 'case_id', BODY_COLUMN]
+    rows = conn.execute(f"SELECT case_id, {BODY_COLUMN} FROM {RAW_TABLE} ORDER BY case_id").fetchall()
+    assert len(rows) == 40
+    assert rows[3] == ('112-TW-0003', judgement_text(3))
+    assert rows[7] == ('112-TW-0007', None)
+    # 查詢連線仍然是唯讀的
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute(f"DELETE FROM main.{RAW_TABLE}")
+
+
+def test_views_are_created_on_each_thread(raw_db):
+    import threading
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        raw_db.connection().execute(f"SELECT count({BODY_COLUMN}) FROM {RAW_TABLE}").fetchone()[0]))
+    thread.start()
+    thread.join()
+    assert results == [34]
+
+
+def test_failed_view_creation_is_raised_and_retried(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / 'data.db')
+    build_raw_table(path)
+
+    def broken(*args):
+        raise sqlite3.OperationalError("no such table: _bodies_x")
+
+    manager = ConnectionManager(path)
+    manager.refresh_generation()
+    with monkeypatch.context() as patch:
+        patch.setattr(bodies, 'text_expression', broken)
+        with pytest.raises(sqlite3.OperationalError):
+            manager.connection()
+    assert "[ERROR] 建立判決全文 view 時發生錯誤" in capsys.readouterr().out
+    # 沒有 view 的連線不會被交出去，下一次取得連線時重新建立
+    conn = manager.connection()
+    assert conn.execute(f"SELECT count({BODY_COLUMN}) FROM {RAW_TABLE}").fetchone()[0] == 34
+    manager.close()
+
+
+def test_plain_and_compressed_round_trip(tmp_path):
+    path = str(tmp_path / 'data.db')
+    build_raw_table(path, compressed=False)
+    conn = sqlite3.connect(path)
+    register_body_function(conn)
+    columns = ['source_file', 'case_id', BODY_COLUMN]
+    original = conn.execute(f"SELECT rowid, * FROM {RAW_TABLE} ORDER BY rowid").fetchall()
+
+    assert apply_body_storage(conn, RAW_TABLE, columns, 'compressed')
+    assert not apply_body_storage(conn, RAW_TABLE, columns, 'compressed')
+    assert apply_body_storage(conn, RAW_TABLE, columns, 'plain')
+    assert not apply_body_storage(conn, RAW_TABLE, columns, 'plain')
+
+    assert not has_body_store(conn, RAW_TABLE)
+    restored = conn.execute(f"SELECT rowid, source_file, case_id, {BODY_COLUMN} FROM {RAW_TABLE} "
+                            "ORDER BY rowid").fetchall()
+    assert restored == original
+    with pytest.raises(ValueError):
+        apply_body_storage(conn, RAW_TABLE, columns, 'gzip')
+    conn.close()
+
+
+def write_csv(path, rows):
+    pd.DataFrame({
+        'case_id': [f"112-TW-{index:04d}" for index in range(rows)],
+        BODY_COLUMN: [judgement_text(index) for index in range(rows)],
+    }).to_csv(path, index=False)
+
+
+@pytest.fixture
+def traced_ingest(tmp_path, monkeypatch):
+    """執行導入並回傳 (報告, 執行過的 SQL 語句, 世代編號)"""
+    files_dir = tmp_path / 'files'
+    files_dir.mkdir()
+    db_path = str(files_dir / 'data.db')
+    connect = sqlite3.connect
+
+    def run(body_storage):
+        statements = []
+
+        def traced_connect(*args, **kwargs):
+            conn = connect(*args, **kwargs)
+            conn.set_trace_callback(statements.append)
+            return conn
+
+        monkeypatch.setattr(sqlite3, 'connect', traced_connect)
+        try:
+            report = ingest_csv_files(db_path, str(files_dir), body_storage=body_storage)
+        finally:
+            monkeypatch.setattr(sqlite3, 'connect', connect)
+        conn = connect(db_path)
+        generation = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.close()
+        return report, statements, generation
+
+    return files_dir, db_path, run
+
+
+def test_reload_in_compressed_mode_does_not_vacuum(traced_ingest):
+    files_dir, db_path, run = traced_ingest
+    write_csv(files_dir / 'judgement_raw.csv', 12)
+    report, statements, generation = run('compressed')
+    assert report[0]["status"] == 'loaded' and 'bodies' in report[0]["indexes"]
+    assert 'VACUUM' not in statements
+    assert generation == 1
+
+    report, statements, generation = run('compressed')
+    assert report[0]["status"] == 'unchanged'
+    assert generation == 1
+
+    # 內容改變後重新導入：一樣轉成壓縮存放，但儲存模式沒有改變
+    write_csv(files_dir / 'judgement_raw.csv', 15)
+    report, statements, generation = run('compressed')
+    assert report[0]["status"] == 'loaded'
+    assert 'VACUUM' not in statements
+    assert generation == 2
+
+
+def test_switching_storage_mode_vacuums_once(traced_ingest):
+    files_dir, db_path, run = traced_ingest
+    write_csv(files_dir / 'judgement_raw.csv', 12)
+    run('compressed')
+
+    report, statements, generation = run('plain')
+    assert report[0]["status"] == 'unchanged' and report[0]["indexes"][0] == 'bodies'
+    assert statements.count('VACUUM') == 1
+    assert generation == 2
+
+    report, statements, generation = run('plain')
+    assert 'VACUUM' not in statements
+    assert generation == 2
+
+    manager = ConnectionManager(db_path)
+    try:
+        conn = manager.connection()
+        assert conn.execute(f"SELECT {BODY_COLUMN} FROM judgement_raw WHERE case_id = '112-TW-0004'").fetchone()[0] \
+            == judgement_text(4)
+    finally:
+        manager.close()
@@ -0,0 +1,77 @@
+import sqlite3
+import pytest
+import cache
+from cache import LRUCache, normalize_sql
+from conftest import RAW_TABLE
+
+
+def test_normalize_sql_only_folds_keywords_and_whitespace():
+    assert normalize_sql("SELECT  *\n FROM t WHERE x = 1;") == normalize_sql("select * from t where x = 1")
+    assert normalize_sql("{SELECT 1}") == "select 1"
+
+
+@pytest.mark.parametrize('sql, quoted', [
+    ("SELECT * FROM T WHERE case_id = '112-TW-0001'", "'112-TW-0001'"),
+    ("SELECT * FROM t WHERE note = 'It''s  A  Note'", "'It''s  A  Note'"),
+    ('SELECT "Case  ID" FROM t', '"Case  ID"'),
+    ("SELECT `Case ID` FROM t", "`Case ID`"),
+    ("SELECT [Case ID] FROM t", "[Case ID]"),
+])
+def test_normalize_sql_keeps_literals_and_quoted_identifiers(sql, quoted):
+    normalized = normalize_sql(sql)
+    assert normalized.startswith("select ") and quoted in normalized
+    # 只有引號內大小寫不同的查詢不共用快取鍵
+    assert normalize_sql(sql.replace(quoted, quoted.lower())) != normalized
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    lru = LRUCache(ttl=10)
+    lru.put('a', "結果")
+    clock.now += 9
+    assert lru.get('a') == "結果"
+    clock.now += 2
+    assert lru.get('a') is None
+    assert lru.stats()["expirations"] == 1 and lru.size == 0 and len(lru) == 0
+
+
+def test_least_recently_used_entries_are_evicted_by_count_and_size():
+    lru = LRUCache(max_entries=2, max_size=100, ttl=None)
+    lru.put('a', "1")
+    lru.put('b', "2")
+    lru.get('a')
+    lru.put('c', "3")
+    assert lru.get('b') is None and lru.get('a') == "1" and lru.get('c') == "3"
+
+    lru = LRUCache(max_entries=10, max_size=10, ttl=None)
+    lru.put('a', "x" * 4)
+    lru.put('b', "x" * 4)
+    lru.put('c', "x" * 4)
+    assert lru.get('a') is None and len(lru) == 2 and lru.size == 8
+    # 單一結果超過總大小上限時不放入快取
+    lru.put('d', "x" * 11)
+    assert lru.get('d') is None and lru.stats()["evictions"] == 1
+
+
+def test_generation_bump_misses_the_cache(agent, raw_db):
+    query = f"SELECT source_file FROM {RAW_TABLE} WHERE case_id = '112-TW-0001'"
+    assert "raw.csv" in agent.execute_sql(query)
+    conn = sqlite3.connect(raw_db.db_path)
+    conn.execute(f"UPDATE {RAW_TABLE} SET source_file = 'new.csv' WHERE case_id = '112-TW-0001'")
+    conn.commit()
+    # 同一世代內仍回傳快取的結果
+    assert "raw.csv" in agent.execute_sql(query)
+    conn.execute(f"PRAGMA user_version = {raw_db.generation + 1}")
+    conn.commit()
+    conn.close()
+    raw_db.refresh_generation()
+    assert "new.csv" in agent.execute_sql(query)
@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+from agent import Agent
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_KEEP_RECENT, CONTEXT_SUMMARY_CHARS
+from context_window import ContextWindow
+
+SYSTEM_PROMPT = "你是法律判決分析助手"
+QUESTION = "詐欺案件有幾件？"
+
+
+def exchange(index, tokens):
+    """一組約 tokens 個 token 的對話：SQL 結果與帶有動作的 AI 回應各佔一半"""
+    half = tokens // 2
+    return {
+        "user": f"[SYSTEM] SQL 查詢結果如下:\n第{index}組" + "資" * half,
+        "assistant": f"<think>第{index}組</think><action>SQL SELECT {index}</action>"
+                     f"<if_finish>continue</if_finish><content>" + "內" * half + "</content>",
+    }
+
+
+def window():
+    return ContextWindow(token_budget=CONTEXT_TOKEN_BUDGET, keep_recent=CONTEXT_KEEP_RECENT,
+                         summary_chars=CONTEXT_SUMMARY_CHARS)
+
+
+def history_contents(messages):
+    """去掉 system prompt 與最後的使用者輸入，回傳 [(user, assistant)]"""
+    body = messages[1:-1]
+    return list(zip([m["content"] for m in body[0::2]], [m["content"] for m in body[1::2]]))
+
+
+def test_oldest_summaries_are_dropped_and_recent_stay_verbatim():
+    per_exchange = CONTEXT_TOKEN_BUDGET // (CONTEXT_KEEP_RECENT + 2)
+    history = [exchange(index, per_exchange) for index in range(20)]
+    messages, stats = window().build(SYSTEM_PROMPT, history, QUESTION)
+    assert stats["prompt_tokens"] <= CONTEXT_TOKEN_BUDGET
+    assert stats["verbatim"] == CONTEXT_KEEP_RECENT
+    assert stats["dropped"] > 0 and stats["summarized"] > 0
+    assert stats["dropped"] + stats["summarized"] + stats["verbatim"] == len(history)
+
+    contents = history_contents(messages)
+    recent = history[-CONTEXT_KEEP_RECENT:]
+    assert contents[-CONTEXT_KEEP_RECENT:] == [(item["user"], item["assistant"]) for item in recent]
+    # 留下的是最新的摘要，並且仍保留動作
+    first_kept = len(history) - CONTEXT_KEEP_RECENT - stats["summarized"]
+    assert stats["dropped"] == first_kept
+    assert contents[0][0].startswith(f"[SYSTEM] SQL 查詢結果如下: (舊結果摘要) 第{first_kept}組")
+    assert f"<action>SQL SELECT {first_kept}</action>" in contents[0][1]
+    assert messages[-1] == {"role": "user", "content": QUESTION}
+
+
+def test_recent_exchanges_are_compressed_oldest_first_before_being_dropped():
+    per_exchange = CONTEXT_TOKEN_BUDGET * 2 // CONTEXT_KEEP_RECENT
+    history = [exchange(index, per_exchange) for index in range(CONTEXT_KEEP_RECENT + 2)]
+    messages, stats = window().build(SYSTEM_PROMPT, history, QUESTION)
+    assert stats["prompt_tokens"] <= CONTEXT_TOKEN_BUDGET
+    # 較早的摘要全部捨棄後，最近的對話由舊到新壓縮，只剩最新的保留原文
+    assert stats["dropped"] == 2
+    assert stats["summarized"] == CONTEXT_KEEP_RECENT - 1 and stats["verbatim"] == 1
+    contents = history_contents(messages)
+    assert contents[-1] == (history[-1]["user"], history[-1]["assistant"])
+    assert all("(舊結果摘要)" in user for user, _ in contents[:-1])
+
+
+def test_everything_is_dropped_when_even_summaries_do_not_fit():
+    history = [exchange(index, 1000) for index in range(CONTEXT_KEEP_RECENT + 2)]
+    system_prompt = "規" * CONTEXT_TOKEN_BUDGET
+    messages, stats = window().build(system_prompt, history, QUESTION)
+    assert stats["dropped"] == len(history) and stats["verbatim"] == stats["summarized"] == 0
+    assert [m["role"] for m in messages] == ['system', 'user']
+
+
+def test_multi_line_user_messages_survive_the_history_split():
+    result = "[SYSTEM] SQL 查詢結果如下:\n   case_id\n0  112-TW-0001\n1  112-TW-0002"
+    # 以第一個 "\nAI: " 分隔，AI 回應中再出現的不影響
+    response = "<think>查詢完成</think>\n<content>共 1 件\nAI: 第二行</content>"
+    agent = SimpleNamespace(conversation_history=[
+        f"User: {result}\nAI: {response}",
+        "沒有 User 前綴的紀錄",
+        "User: 問題\nAI: 回答",
+    ])
+    assert Agent.format_history_for_ai(agent) == [
+        {"user": result, "assistant": response},
+        {"user": "問題", "assistant": "回答"},
+    ]
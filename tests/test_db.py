@@ -0,0 +1,30 @@
+import gc
+import threading
+from conftest import RAW_TABLE
+
+
+def test_connections_are_closed_when_threads_finish(raw_db):
+    raw_db.connection()
+    assert raw_db.connection_count() == 1
+
+    def query():
+        raw_db.connection().execute(f"SELECT count(*) FROM {RAW_TABLE}").fetchone()
+
+    for _ in range(20):
+        thread = threading.Thread(target=query)
+        thread.start()
+        thread.join()
+    gc.collect()
+    # 只剩下主執行緒的連線
+    assert raw_db.connection_count() == 1
+
+
+def test_thread_reuses_its_connection(raw_db):
+    assert raw_db.connection() is raw_db.connection()
+
+
+def test_close_closes_all_connections(raw_db):
+    conn = raw_db.connection()
+    raw_db.close()
+    assert raw_db.connection_count() == 0
+    assert raw_db.connection() is not conn
@@ -0,0 +1,52 @@
+import pytest
+from history_store import HistoryStore
+
+SYSTEM_PROMPT = "你是法律判決分析助手"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    yield store
+    store.close()
+
+
+def messages(question):
+    return [{"role": 'system', "content": SYSTEM_PROMPT}, {"role": 'user', "content": question}]
+
+
+def blob_count(store):
+    return store._conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+
+def test_prompts_and_messages_are_stored_once(store):
+    for cycle in range(3):
+        store.append('a', cycle, f"User: 問題\nAI: 回答 {cycle}", system_prompt=SYSTEM_PROMPT,
+                     messages=messages("問題"))
+    # 系統提示與相同的訊息只存一份
+    assert blob_count(store) == 2
+    entry_id = store._conn.execute("SELECT MAX(id) FROM entries").fetchone()[0]
+    assert store.full_context(entry_id) == messages("問題")
+
+
+def test_tail_returns_the_latest_entries_of_one_session(store):
+    for cycle in range(5):
+        store.append('a', cycle, f"a{cycle}")
+        store.append('b', cycle, f"b{cycle}")
+    store.append('a', 5, None)
+    assert store.tail('a', 3) == ["a2", "a3", "a4"]
+    assert store.tail('b', 10) == [f"b{cycle}" for cycle in range(5)]
+    assert store.tail('c', 3) == []
+
+
+def test_reset_clears_one_session_and_prunes_its_blobs(store):
+    store.append('a', 0, "a0", system_prompt=SYSTEM_PROMPT, messages=messages("只有 a 問過"))
+    store.append('b', 0, "b0", system_prompt=SYSTEM_PROMPT, messages=messages("b 的問題"))
+    assert blob_count(store) == 3
+    store.reset('a')
+    assert store.tail('a', 10) == [] and store.count('a') == 0
+    assert store.tail('b', 10) == ["b0"]
+    # 共用的系統提示仍被 b 引用而保留，只有 a 的問題被刪除
+    assert blob_count(store) == 2
+    entry_id = store._conn.execute("SELECT id FROM entries WHERE session_id = 'b'").fetchone()[0]
+    assert store.full_context(entry_id) == messages("b 的問題")
@@ -0,0 +1,71 @@
+import sqlite3
+import pytest
+from law_index import build_law_index, extract_articles, lookup_cases, parse_law_query
+
+
+def test_bracketed_and_known_law_names():
+    text = "依《中華民國刑法》第339條之4及洗錢防制法第 14 條，並參照《自訂條例》第2條"
+    assert extract_articles(text) == [('刑法', '339之4'), ('洗錢防制法', '14'), ('自訂條例', '2')]
+    # 不在列表中且沒有《》的法規名稱不辨識
+    assert extract_articles("某某法第3條") == []
+
+
+def test_same_law_refers_to_the_previous_law():
+    assert extract_articles("刑法第339條、同法第30條") == [('刑法', '339'), ('刑法', '30')]
+    # 前面沒有提到法規時略過
+    assert extract_articles("同法第30條") == []
+
+
+def test_full_width_digits_and_sub_articles():
+    assert extract_articles("刑法第３３９條之４") == [('刑法', '339之4')]
+    assert extract_articles("刑法第339條 之 4、第30條") == [('刑法', '339之4')]
+
+
+@pytest.mark.parametrize('query, expected', [
+    ("刑法第339條之4", ('刑法', '339之4')),
+    ("《洗錢防制法》第14條", ('洗錢防制法', '14')),
+    ("刑法 339之4", ('刑法', '339之4')),
+    ("刑法 第３３９條", ('刑法', '339')),
+    ("刑法", ('刑法', None)),
+    ("刑法 詐欺", None),
+])
+def test_parse_law_query(query, expected):
+    assert parse_law_query(query) == expected
+
+
+@pytest.fixture
+def law_conn():
+    """分析表記錄 A、B、C 三案的爭點；C 在分析表中只有洗錢的爭點，詐欺的法條只出現在判決全文"""
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE analysis (case_id TEXT, issue_type TEXT, guilty INTEGER, law_articles TEXT)")
+    conn.executemany("INSERT INTO analysis VALUES (?, ?, ?, ?)", [
+        ('A', '詐欺', 1, "刑法第339條之4"),
+        ('A', '洗錢', 0, "洗錢防制法第14條"),
+        ('B', '詐欺', 0, "《刑法》第339條之4"),
+        ('C', '洗錢', 1, "洗錢防制法第14條"),
+    ])
+    conn.execute("CREATE TABLE raw (case_id TEXT, judgement_content TEXT)")
+    conn.executemany("INSERT INTO raw VALUES (?, ?)", [
+        ('A', "被告犯刑法第339條之4之罪"),
+        ('C', "刑法第339條之4、同法第339條之4、同法第30條"),
+        (None, "刑法第339條之4"),
+    ])
+    build_law_index(conn, 'analysis', ['case_id', 'issue_type', 'guilty', 'law_articles'])
+    build_law_index(conn, 'raw', ['case_id', 'judgement_content'])
+    yield conn
+    conn.close()
+
+
+def test_lookup_cases_round_trip(law_conn):
+    cases, total = lookup_cases(law_conn, '刑法', '339之4')
+    assert total == 3
+    # 爭點分析多的排前面，其次是判決全文引用次數
+    assert [case["case_id"] for case in cases] == ['A', 'B', 'C']
+    assert cases[0]["issues"] == [('詐欺', 1)] and cases[0]["mentions"] == 1
+    # 只在判決全文引用的案件，以 case_id 補上分析表中的其他爭點
+    assert cases[2]["mentions"] == 2 and cases[2]["issues"] == [('洗錢', 1)]
+
+    cases, total = lookup_cases(law_conn, '刑法', limit=1)
+    assert total == 3 and cases[0]["articles"] == ['刑法第339條之4']
+    cases, _ = lookup_cases(law_conn, '刑法', '30')
+    assert [(case["case_id"], case["articles"]) for case in cases] == [('C', ['刑法第30條'])]
@@ -0,0 +1,233 @@
+import time
+import asyncio
+import threading
+import pytest
+from llm_scheduler import LLMScheduler, LLMOverloaded, TokenBucket, ScheduledBackend, transient_reason
+
+MESSAGES = [{"role": 'user', "content": "判決中有幾件詐欺案？"}]
+
+
+class APIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = type('Response', (), {'headers': headers or {}})()
+
+
+class FakeBackend:
+    """依序丟出 errors 中的錯誤後回傳固定結果；gate 不為 None 時每個請求都等到 gate 被設定"""
+
+    name = 'fake'
+
+    def __init__(self, errors=(), total_tokens=30, gate=None):
+        self.errors = list(errors)
+        self.total_tokens = total_tokens
+        self.gate = gate
+        self.calls = 0
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def _result(self):
+        return {"content": "<if_finish>finish</if_finish>", "usage": {"total_tokens": self.total_tokens}}
+
+    def complete(self, model, messages, **params):
+        with self._lock:
+            self.calls += 1
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            if self.gate is not None:
+                self.gate.wait(5)
+            if self.errors:
+                raise self.errors.pop(0)
+            return self._result()
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    async def acomplete(self, model, messages, **params):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self._result()
+
+    def stream(self, model, messages, **params):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        yield "<if_finish>"
+        yield "finish</if_finish>"
+        return self._result()
+
+
+def scheduler(**options):
+    options.setdefault('retry_base_delay', 0.001)
+    options.setdefault('retry_max_delay', 0.01)
+    return LLMScheduler(**options)
+
+
+def start(target, *args):
+    errors = []
+
+    def run():
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread, errors
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_token_bucket_orders_waits_and_adjusts():
+    bucket = TokenBucket(rate=10, capacity=10)
+    assert bucket.reserve(10) == 0
+    assert bucket.reserve(5) == pytest.approx(0.5, abs=0.01)
+    bucket.adjust(5)
+    assert bucket.reserve(1) == pytest.approx(0.1, abs=0.01)
+    assert TokenBucket(rate=None).reserve(10 ** 6) == 0
+
+
+def test_transient_reasons():
+    assert transient_reason(APIError(429)) == 'rate_limit'
+    assert transient_reason(APIError(503)) == 'server_error'
+    assert transient_reason(ConnectionError()) == 'connection'
+    assert transient_reason(APIError(400)) is None
+    assert transient_reason(ValueError()) is None
+
+
+def test_backoff_is_capped_and_honours_retry_after():
+    llm = LLMScheduler(retry_base_delay=0.5, retry_max_delay=2.0)
+    assert all(0 <= llm.backoff(attempt, APIError(500)) <= 2.0 for attempt in range(10))
+    assert llm.backoff(0, APIError(429, {'retry-after': '3'})) >= 3.0
+    assert llm.backoff(0, APIError(429, {'retry-after-ms': '1500'})) >= 1.5
+
+
+def test_transient_errors_are_retried():
+    backend = FakeBackend(errors=[APIError(500), APIError(429), ConnectionError()])
+    llm = scheduler(max_retries=4)
+    assert llm.complete(backend, 'model', MESSAGES)["usage"]["total_tokens"] == 30
+    assert backend.calls == 4
+    assert llm.in_flight == 0
+
+
+def test_retries_stop_at_the_limit_and_on_permanent_errors():
+    backend = FakeBackend(errors=[APIError(500)] * 3)
+    with pytest.raises(APIError):
+        scheduler(max_retries=2).complete(backend, 'model', MESSAGES)
+    assert backend.calls == 3
+
+    backend = FakeBackend(errors=[APIError(400)])
+    llm = scheduler()
+    with pytest.raises(APIError):
+        llm.complete(backend, 'model', MESSAGES)
+    assert backend.calls == 1
+    assert llm.in_flight == 0
+
+
+def test_usage_settles_the_token_reservation():
+    llm = scheduler(tokens_per_minute=60000, completion_tokens=500)
+    capacity = llm.tokens.capacity
+    llm.complete(FakeBackend(total_tokens=30), 'model', MESSAGES)
+    assert capacity - 30 <= llm.tokens.tokens <= capacity - 29
+
+
+@pytest.mark.parametrize('call', ['complete', 'acomplete', 'stream'])
+def test_failed_requests_refund_the_token_reservation(call):
+    llm = scheduler(tokens_per_minute=60000, completion_tokens=500, max_retries=0)
+    capacity = llm.tokens.capacity
+    backend = FakeBackend(errors=[APIError(400)])
+    with pytest.raises(APIError):
+        if call == 'complete':
+            llm.complete(backend, 'model', MESSAGES)
+        elif call == 'acomplete':
+            asyncio.run(llm.acomplete(backend, 'model', MESSAGES))
+        else:
+            list(llm.stream(backend, 'model', MESSAGES))
+    assert llm.tokens.tokens == capacity
+    assert llm.in_flight == 0
+
+
+def test_stream_returns_the_result_and_settles():
+    llm = scheduler(tokens_per_minute=60000, completion_tokens=500)
+    capacity = llm.tokens.capacity
+    stream = llm.stream(FakeBackend(total_tokens=40), 'model', MESSAGES)
+    chunks = []
+    with pytest.raises(StopIteration) as stop:
+        while True:
+            chunks.append(next(stream))
+    assert ''.join(chunks) == "<if_finish>finish</if_finish>"
+    assert stop.value.value["usage"]["total_tokens"] == 40
+    assert capacity - 40 <= llm.tokens.tokens <= capacity - 39
+    assert llm.in_flight == 0
+
+
+def test_full_queue_rejects_immediately():
+    gate = threading.Event()
+    backend = FakeBackend(gate=gate)
+    llm = scheduler(max_concurrency=1, queue_size=0)
+    thread, errors = start(llm.complete, backend, 'model', MESSAGES)
+    wait_for(lambda: backend.running == 1)
+    with pytest.raises(LLMOverloaded) as overloaded:
+        llm.complete(backend, 'model', MESSAGES)
+    assert overloaded.value.reason == 'queue_full'
+    gate.set()
+    thread.join()
+    assert not errors and llm.in_flight == 0
+
+
+def test_queue_wait_times_out():
+    gate = threading.Event()
+    backend = FakeBackend(gate=gate)
+    llm = scheduler(max_concurrency=1, queue_timeout=0.05)
+    thread, errors = start(llm.complete, backend, 'model', MESSAGES)
+    wait_for(lambda: backend.running == 1)
+    with pytest.raises(LLMOverloaded) as overloaded:
+        llm.complete(backend, 'model', MESSAGES)
+    assert overloaded.value.reason == 'queue_timeout'
+    assert not llm._waiters
+    gate.set()
+    thread.join()
+    assert not errors
+
+
+def test_rate_limit_beyond_the_queue_timeout_is_rejected_and_refunded():
+    llm = scheduler(requests_per_minute=6, queue_timeout=1.0)
+    backend = FakeBackend()
+    llm.complete(backend, 'model', MESSAGES)
+    tokens = llm.requests.tokens
+    with pytest.raises(LLMOverloaded) as overloaded:
+        llm.complete(backend, 'model', MESSAGES)
+    assert overloaded.value.reason == 'rate_limited'
+    assert overloaded.value.retry_after > 1.0
+    assert llm.requests.tokens == pytest.approx(tokens, abs=0.01)
+    assert backend.calls == 1
+    assert llm.in_flight == 0
+
+
+def test_per_session_limit_queues_only_that_session():
+    gate = threading.Event()
+    backend = FakeBackend(gate=gate)
+    llm = scheduler(max_concurrency=4, max_per_session=1)
+    first = ScheduledBackend(backend, llm).for_session('a')
+    threads = [start(first.complete, 'model', MESSAGES) for _ in range(2)]
+    wait_for(lambda: backend.running == 1 and len(llm._waiters) == 1)
+    # 其他 session 不受影響
+    other, errors = start(ScheduledBackend(backend, llm).for_session('b').complete, 'model', MESSAGES)
+    wait_for(lambda: backend.running == 2)
+    gate.set()
+    for thread, thread_errors in threads + [(other, errors)]:
+        thread.join()
+        assert not thread_errors
+    assert backend.calls == 3
+    assert backend.peak == 2
+    assert llm.in_flight == 0 and not llm._per_session
@@ -0,0 +1,89 @@
+import sqlite3
+import pytest
+from bodies import read_body, register_body_function, store_bodies
+from search import bigram_query, bigram_table_name, bigram_text, build_fts_index, search_fts
+from conftest import RAW_TABLE, build_raw_table
+
+THEFT_TEXT = "臺灣高等法院刑事判決\n\n主文\n被告犯竊盜罪，處拘役二十日。\n\n理由\n" + "竊取他人財物。" * 20
+
+
+@pytest.fixture(params=['plain', 'compressed'])
+def search_db(request, tmp_path):
+    """每 3 行改為竊盜判決並建立全文索引，回傳 (連線, judgement_body 讀取過的 rowid 列表)"""
+    path = str(tmp_path / 'data.db')
+    build_raw_table(path, compressed=False)
+    conn = sqlite3.connect(path)
+    conn.execute(f'UPDATE "{RAW_TABLE}" SET judgement_content = ? WHERE rowid % 3 = 0', (THEFT_TEXT,))
+    reads = []
+    if request.param == 'compressed':
+        register_body_function(conn)
+        store_bodies(conn, RAW_TABLE)
+        conn.create_function('judgement_body', 2,
+                             lambda table, rowid: reads.append(rowid) or read_body(conn, table, rowid))
+    build_fts_index(conn, RAW_TABLE, ['source_file', 'case_id', 'judgement_content'])
+    # 建立索引時解壓縮每份全文一次，之後的搜尋才是要檢查的部分
+    reads.clear()
+    yield conn, reads
+    conn.close()
+
+
+# build_raw_table 中 rowid % 7 = 1 的行沒有全文
+THEFT_ROWS = 'rowid % 3 = 0'
+FRAUD_ROWS = 'rowid % 3 != 0 AND rowid % 7 != 1'
+
+
+def rowids(conn, where):
+    return {rowid for (rowid,) in conn.execute(f'SELECT rowid FROM "{RAW_TABLE}" WHERE {where}')}
+
+
+def test_bigram_text_keeps_every_pair_and_the_last_character():
+    assert bigram_text("詐欺罪，A1") == "詐欺 欺罪 罪 A1 1"
+    assert bigram_text(None) == ''
+
+
+def test_bigram_query():
+    assert bigram_query("詐欺") == '"詐欺"'
+    assert bigram_query("詐") == '"詐"*'
+    assert bigram_query("，") is None
+
+
+def test_bigram_index_is_built(search_db):
+    search_conn, _ = search_db
+    names = {row[0] for row in search_conn.execute("SELECT name FROM sqlite_master")}
+    assert bigram_table_name(RAW_TABLE) in names
+    # 兩個索引都在時不重建
+    assert not build_fts_index(search_conn, RAW_TABLE, ['case_id', 'judgement_content'], rebuild=False)
+
+
+@pytest.mark.parametrize('term', ['竊盜', '竊', '拘役'])
+def test_short_terms_match_like_results(search_db, term):
+    search_conn, _ = search_db
+    _, rows = search_fts(search_conn, RAW_TABLE, [term], limit=1000)
+    assert {row[0] for row in rows} == rowids(search_conn, THEFT_ROWS)
+    assert all(f"【{term}】" in row[-1] for row in rows)
+
+
+def test_short_terms_only_read_output_rows(search_db):
+    """短關鍵字由 bigram 索引過濾，不再以 LIKE 解壓縮每份全文"""
+    search_conn, body_reads = search_db
+    statements = []
+    search_conn.set_trace_callback(statements.append)
+    _, rows = search_fts(search_conn, RAW_TABLE, ['詐欺'], limit=3)
+    assert len(rows) == 3
+    assert not any('LIKE' in sql for sql in statements)
+    assert len(body_reads) <= 3
+
+
+def test_short_and_long_terms_are_combined(search_db):
+    search_conn, _ = search_db
+    _, rows = search_fts(search_conn, RAW_TABLE, ['詐欺', '交付帳戶'], limit=1000)
+    assert {row[0] for row in rows} == rowids(search_conn, FRAUD_ROWS)
+    _, rows = search_fts(search_conn, RAW_TABLE, ['竊盜', '交付帳戶'], limit=1000)
+    assert rows == []
+
+
+def test_punctuation_only_terms_return_nothing(search_db):
+    search_conn, _ = search_db
+    columns, rows = search_fts(search_conn, RAW_TABLE, ['，'])
+    assert columns[-2:] == ['bm25', 'snippet']
+    assert rows == []
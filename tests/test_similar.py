@@ -0,0 +1,45 @@
+import os
+import sqlite3
+import pytest
+import similar
+from similar import VectorIndex, build_vector_index, vector_dir, _db_file, _vector_paths
+from conftest import RAW_TABLE, build_raw_table
+
+COLUMNS = ['source_file', 'case_id', 'judgement_content']
+
+
+@pytest.fixture
+def conn(tmp_path):
+    """判決表格中 rowid 為 2、3 的行沒有 case_id"""
+    path = str(tmp_path / 'data.db')
+    build_raw_table(path, rows=20, compressed=False)
+    conn = sqlite3.connect(path)
+    conn.execute(f'UPDATE "{RAW_TABLE}" SET case_id = NULL WHERE rowid IN (2, 3)')
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def vector_index(conn):
+    return VectorIndex(_vector_paths(vector_dir(_db_file(conn)), RAW_TABLE, 'judgement_content'))
+
+
+def test_rows_without_case_id_stay_separate(conn):
+    assert build_vector_index(conn, RAW_TABLE, COLUMNS) == ['judgement_content']
+    index = vector_index(conn)
+    assert 'None' not in index.case_rows
+    assert index.case_vector(None) is None
+    results = index.top_k(index.query_vector("被告犯詐欺罪，交付帳戶予詐騙集團使用"), k=20)
+    rowids = [record['rowid'] for _, record in results]
+    assert {2, 3} <= set(rowids)
+    assert len(rowids) == len(set(rowids))
+
+
+def test_failed_build_leaves_no_temporary_files(conn, monkeypatch):
+    def fail(text):
+        raise MemoryError("模擬建立向量時失敗")
+
+    monkeypatch.setattr(similar, 'term_frequencies', fail)
+    with pytest.raises(MemoryError):
+        build_vector_index(conn, RAW_TABLE, COLUMNS)
+    assert os.listdir(vector_dir(_db_file(conn))) == []
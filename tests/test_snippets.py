@@ -0,0 +1,49 @@
+import sqlite3
+import pytest
+from bodies import register_body_function, store_bodies
+from snippets import build_paragraph_index, find_snippets, split_paragraphs
+from conftest import RAW_TABLE, build_raw_table
+
+CASE_ID = '112-TW-0001'
+FIRST_TEXT = "臺灣高等法院刑事判決\n\n主文\n上訴駁回。\n\n理由\n" + "本案事實與證據均已詳述於原審判決。" * 5
+LAST_TEXT = "補充理由\n\n被告將帳戶交付詐騙集團，並非不知情。" + "其餘部分與原判決相同。" * 5
+
+
+@pytest.fixture(params=['plain', 'compressed'])
+def snippet_conn(request, tmp_path):
+    """CASE_ID 出現在第 2 行與最後一行，中間的其他案件都大量提到詐騙集團"""
+    path = str(tmp_path / 'data.db')
+    build_raw_table(path, compressed=False)
+    conn = sqlite3.connect(path)
+    conn.execute(f'UPDATE "{RAW_TABLE}" SET judgement_content = ? WHERE case_id = ?', (FIRST_TEXT, CASE_ID))
+    conn.execute(f'INSERT INTO "{RAW_TABLE}" VALUES (?, ?, ?)', ('extra.csv', CASE_ID, LAST_TEXT))
+    if request.param == 'compressed':
+        register_body_function(conn)
+        store_bodies(conn, RAW_TABLE)
+    build_paragraph_index(conn, RAW_TABLE, ['source_file', 'case_id', 'judgement_content'])
+    yield conn
+    conn.close()
+
+
+def test_split_paragraphs_merges_short_lines_and_cuts_long_ones():
+    text = "主文\n" + "被告犯詐欺罪。" * 60
+    spans = split_paragraphs(text, max_chars=300, min_chars=60)
+    assert spans[0][0] == 0 and spans[-1][1] == len(text)
+    assert all(end - start <= 300 for start, end in spans)
+    # 「主文」太短，與下一段合併
+    assert text[spans[0][0]:spans[0][1]].startswith("主文\n被告")
+
+
+def test_ranking_is_limited_to_the_case_before_the_limit(snippet_conn):
+    total, snippets = find_snippets(snippet_conn, RAW_TABLE, CASE_ID, ['詐騙集團'], limit=1)
+    paragraphs = snippet_conn.execute(
+        f'SELECT COUNT(*) FROM "_paragraphs_{RAW_TABLE}" WHERE case_id = ?', (CASE_ID,)).fetchone()[0]
+    assert total == paragraphs
+    assert len(snippets) == 1
+    assert "【詐騙集團】" in snippets[0][1]
+
+
+def test_missing_case_and_short_terms(snippet_conn):
+    assert find_snippets(snippet_conn, RAW_TABLE, '999-TW-0000', ['詐騙集團']) is None
+    _, snippets = find_snippets(snippet_conn, RAW_TABLE, CASE_ID, ['帳戶'])
+    assert [text for _, text in snippets] and all("【帳戶】" in text for _, text in snippets)
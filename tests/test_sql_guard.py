@@ -0,0 +1,122 @@
+import pytest
+from sql_guard import QueryRejected, guard_query, reject_full_scans, find_full_scans
+from conftest import RAW_TABLE
+
+LARGE = {RAW_TABLE}
+
+
+def run_guarded(conn, sql, max_instructions=50_000_000, timeout=5):
+    with guard_query(conn, max_instructions, timeout) as body_reads:
+        reject_full_scans(conn, sql, LARGE, body_reads)
+        return conn.execute(sql).fetchall()
+
+
+@pytest.mark.parametrize('sql', [
+    # 覆蓋索引掃描但讀取壓縮全文：每一行都要解壓縮
+    f"SELECT case_id FROM {RAW_TABLE} x WHERE x.judgement_content LIKE '%詐欺%'",
+    f"WITH t AS (SELECT case_id, judgement_content FROM {RAW_TABLE}) "
+    f"SELECT case_id FROM t WHERE judgement_content LIKE '%詐欺%'",
+    f"SELECT case_id FROM (SELECT case_id, judgement_content AS c FROM {RAW_TABLE}) WHERE c LIKE '%詐欺%'",
+    f"SELECT case_id FROM main.{RAW_TABLE} WHERE judgement_body('{RAW_TABLE}', rowid) LIKE '%詐欺%'",
+    f"SELECT * FROM {RAW_TABLE}",
+])
+def test_body_reads_over_large_table_are_rejected(raw_db, sql):
+    conn = raw_db.connection()
+    with pytest.raises(QueryRejected) as excinfo:
+        run_guarded(conn, sql)
+    assert excinfo.value.kind == 'full_scan'
+    assert RAW_TABLE in str(excinfo.value)
+
+
+@pytest.mark.parametrize('sql', [
+    f"SELECT count(*) FROM {RAW_TABLE}",
+    f"SELECT case_id FROM {RAW_TABLE} ORDER BY case_id LIMIT 3",
+    f"SELECT case_id, length(judgement_content) FROM {RAW_TABLE} WHERE case_id = '112-TW-0003'",
+])
+def test_index_only_and_per_case_queries_are_allowed(raw_db, sql):
+    assert run_guarded(raw_db.connection(), sql)
+
+
+def test_limited_scans_are_allowed(raw_db):
+    rows = run_guarded(raw_db.connection(), f"SELECT * FROM {RAW_TABLE} LIMIT 2")
+    assert [row[1] for row in rows] == ['112-TW-0000', '112-TW-0001']
+
+
+@pytest.mark.parametrize('sql', [
+    # 排序、聚合、DISTINCT 都要先讀完整個表格，LIMIT 擋不住
+    f"SELECT * FROM {RAW_TABLE} ORDER BY judgement_content LIMIT 2",
+    f"SELECT count(*) FROM {RAW_TABLE} WHERE judgement_content LIKE '%詐欺%' LIMIT 1",
+    f"SELECT DISTINCT judgement_content FROM {RAW_TABLE} LIMIT 2",
+    f"SELECT * FROM {RAW_TABLE} LIMIT 2 OFFSET 30",
+])
+def test_limit_does_not_hide_blocking_scans(raw_db, sql):
+    with pytest.raises(QueryRejected) as excinfo:
+        run_guarded(raw_db.connection(), sql)
+    assert excinfo.value.kind == 'full_scan'
+
+
+def test_body_is_readable_for_a_single_case(raw_db):
+    rows = run_guarded(raw_db.connection(),
+                       f"SELECT judgement_content FROM {RAW_TABLE} WHERE case_id = '112-TW-0003'")
+    assert rows[0][0].startswith("臺灣高等法院刑事判決 第 3 號")
+
+
+def test_small_tables_may_be_scanned(raw_db):
+    conn = raw_db.connection()
+    sql = f"SELECT case_id FROM {RAW_TABLE} WHERE judgement_content LIKE '%詐欺%'"
+    with guard_query(conn, 50_000_000, 5) as body_reads:
+        assert find_full_scans(conn, sql, set(), body_reads) == []
+
+
+@pytest.mark.parametrize('sql', [
+    # 全文已壓縮時同名的是 TEMP VIEW，直接寫入 main 中的實際表格
+    f"DELETE FROM main.{RAW_TABLE}",
+    f"UPDATE main.{RAW_TABLE} SET case_id = 'x'",
+    "CREATE TABLE t (a)",
+    "PRAGMA query_only = 0",
+    "ATTACH DATABASE ':memory:' AS other",
+])
+def test_writes_are_not_allowed(raw_db, sql):
+    with pytest.raises(QueryRejected) as excinfo:
+        run_guarded(raw_db.connection(), sql)
+    assert excinfo.value.kind == 'not_allowed'
+
+
+def test_read_pragmas_are_allowed(raw_db):
+    rows = run_guarded(raw_db.connection(), f"PRAGMA table_info({RAW_TABLE})")
+    assert 'judgement_content' in [row[1] for row in rows]
+
+
+def test_instruction_budget_interrupts_query(raw_db):
+    sql = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+    with pytest.raises(QueryRejected) as excinfo:
+        run_guarded(raw_db.connection(), sql, max_instructions=100_000)
+    assert excinfo.value.kind == 'budget'
+
+
+def test_timeout_interrupts_query(raw_db):
+    sql = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+    with pytest.raises(QueryRejected) as excinfo:
+        run_guarded(raw_db.connection(), sql, timeout=0.05)
+    assert excinfo.value.kind == 'timeout'
+
+
+def test_connection_is_usable_after_rejection(raw_db):
+    conn = raw_db.connection()
+    with pytest.raises(QueryRejected):
+        run_guarded(conn, f"DELETE FROM main.{RAW_TABLE}")
+    assert conn.execute(f"SELECT count(*) FROM {RAW_TABLE}").fetchone()[0] == 40
+
+
+@pytest.mark.parametrize('sql, action', [
+    # 同名的 TEMP VIEW 遮蔽了 main 中的表格，仍要回報 AI 寫的 DROP TABLE
+    (f"DROP TABLE {RAW_TABLE}", f"DROP TABLE {RAW_TABLE}"),
+    (f"DROP TABLE main.{RAW_TABLE}", f"DROP TABLE {RAW_TABLE}"),
+    (f"DROP VIEW {RAW_TABLE}", f"DROP VIEW {RAW_TABLE}"),
+    (f"DELETE FROM main.{RAW_TABLE}", f"DELETE {RAW_TABLE}"),
+    ("CREATE TABLE t (a)", "CREATE TABLE t"),
+])
+def test_rejection_names_the_attempted_action(raw_db, sql, action):
+    with pytest.raises(QueryRejected) as excinfo:
+        run_guarded(raw_db.connection(), sql)
+    assert str(excinfo.value).endswith(f"不允許 {action}")
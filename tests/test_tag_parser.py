@@ -0,0 +1,68 @@
+import pytest
+from tag_parser import TagStreamParser
+
+RESPONSE = ("<think>先查詢詐欺案件</think>\n<action>SQL SELECT count(*) FROM t</action>\n"
+            "<if_finish>continue</if_finish>")
+
+
+def parse(chunks):
+    parser = TagStreamParser()
+    events = []
+    for chunk in chunks:
+        events.extend(parser.feed(chunk))
+    return events + parser.close()
+
+
+def closed(events):
+    return [(event["tag"], event["text"]) for event in events if event["event"] == 'close']
+
+
+def streamed_text(events, tag):
+    return ''.join(event["text"] for event in events if event["event"] == 'text' and event["tag"] == tag)
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7, len(RESPONSE)])
+def test_any_chunking_gives_the_same_events(size):
+    events = parse([RESPONSE[i:i + size] for i in range(0, len(RESPONSE), size)])
+    assert closed(events) == [('think', "先查詢詐欺案件"), ('action', "SQL SELECT count(*) FROM t"),
+                              ('if_finish', "continue")]
+    # 串流送出的文字與完整內容一致
+    assert streamed_text(events, 'action') == "SQL SELECT count(*) FROM t"
+
+
+def test_tags_split_across_chunks():
+    parser = TagStreamParser()
+    assert parser.feed("說明<act") == []
+    assert parser.feed("ion>SQL SELECT 1</act") == [
+        {"event": "open", "tag": 'action'},
+        {"event": "text", "tag": 'action', "text": "SQL SELECT 1"},
+    ]
+    assert parser.feed("ion>") == [{"event": "close", "tag": 'action', "text": "SQL SELECT 1"}]
+
+
+def test_text_outside_tags_and_unknown_tags_are_ignored():
+    events = parse(["前言 <b>粗體</b> a < b ", "<content>共 3 件</content> 結尾"])
+    assert closed(events) == [('content', "共 3 件")]
+
+
+def test_nested_tags_are_kept_as_content():
+    events = parse(["<think>比較 <action>SQL SELECT 1</action> 與 <b>", "</think>"])
+    assert closed(events) == [('think', "比較 <action>SQL SELECT 1</action> 與 <b>")]
+
+
+def test_unclosed_tag_is_closed_at_end_of_stream():
+    events = parse(["<content>共 3 件", "，其中 2 件有罪"])
+    assert closed(events) == [('content', "共 3 件，其中 2 件有罪")]
+
+
+def test_trailing_partial_tags_at_end_of_stream():
+    # 被切斷的結束標籤不當成內容
+    events = parse(["<content>共 3 件</cont"])
+    assert closed(events) == [('content', "共 3 件")]
+    assert streamed_text(events, 'content') == "共 3 件"
+    # 被切斷的開始標籤沒有任何事件
+    assert parse(["<think>好</think><if_fin"]) == [
+        {"event": "open", "tag": 'think'},
+        {"event": "text", "tag": 'think', "text": "好"},
+        {"event": "close", "tag": 'think', "text": "好"},
+    ]